@@ -0,0 +1,11 @@
+"""
+Async versions of the hot account endpoints, served when ASYNC_API_VIEWS is on.
+"""
+from backend.async_api import AsyncAPIView, json_response
+
+
+class GetUserView(AsyncAPIView):
+    async def get(self, request):
+        return json_response({
+            'username': request.user.username
+        })
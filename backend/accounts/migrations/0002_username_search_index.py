@@ -0,0 +1,24 @@
+# Index for the user directory search (accounts.views.UserSearchView).
+#
+# Case-insensitive prefix search and its keyset order both run on this one
+# btree: under the "C" collation LIKE 'abc%' becomes a range scan and rows
+# come back already sorted. Built concurrently, auth_user stays writable.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY "auth_user_username_search" '
+            'ON "auth_user" ((lower(username) COLLATE "C"), (username COLLATE "C"));',
+            reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS "auth_user_username_search";',
+        ),
+    ]
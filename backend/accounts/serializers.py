@@ -73,3 +73,12 @@ class RestoreSerializer(serializers.ModelSerializer):
         instance.save()
 
         return instance
+
+
+class UserSearchSerializer(serializers.Serializer):
+    """
+    A user directory row, built from plain (id, username) rows rather than
+    model instances.
+    """
+    id = serializers.IntegerField()
+    username = serializers.CharField()
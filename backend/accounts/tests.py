@@ -1,3 +1,39 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
 
-# Create your tests here.
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        for name in ('Alex', 'alfred', 'al_bundy', 'bob', 'ALAN'):
+            User.objects.create(username=name)
+        User.objects.create(username='alma', is_active=False)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get('/users/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_prefix_ignores_case_and_pages_by_username(self):
+        page = self.search(q='AL', limit=2)
+        self.assertEqual([user['username'] for user in page['results']], ['al_bundy', 'ALAN'])
+        self.assertEqual(page['next'], 'ALAN')
+
+        page = self.search(q='al', limit=2, after=page['next'])
+        self.assertEqual([user['username'] for user in page['results']], ['Alex', 'alfred'])
+        self.assertIsNone(page['next'])
+        self.assertEqual(set(page['results'][0]), {'id', 'username'})
+
+    def test_wildcards_are_literal(self):
+        self.assertEqual([user['username'] for user in self.search(q='al_')['results']], ['al_bundy'])
+        self.assertEqual(self.search(q='%')['results'], [])
+
+    @override_settings(USER_SEARCH_MAX_RESULTS=3)
+    def test_limit_is_capped_and_query_required(self):
+        with self.assertNumQueries(1):
+            page = self.search(q='a', limit=1000)
+        self.assertEqual(len(page['results']), 3)
+        self.assertEqual(self.client.get('/users/').status_code, 400)
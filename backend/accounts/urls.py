@@ -1,13 +1,24 @@
 """Module views"""
 
 from rest_framework_simplejwt.views import TokenRefreshView
+from django.conf import settings
 from django.urls import path
-from .views import MyObtainTokenPairView, RegisterView, RestoreView, GetUserView
-
-urlpatterns = [
-    path('login/', MyObtainTokenPairView.as_view(), name='token_obtain_pair'),
-    path('login/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
-    path('register/', RegisterView.as_view(), name='auth-register'),
-    path('restore/<str:username>/', RestoreView.as_view(), name='restore-password'),
-    path('me/', GetUserView.as_view(), name='user-info'),
-]
+from . import async_views, views
+from .views import MyObtainTokenPairView, RegisterView, RestoreView
+
+
+def urlpatterns_for(hot):
+    """
+    The app's routes, with /me/ served from `hot`: async_views or views.
+    """
+    return [
+        path('login/', MyObtainTokenPairView.as_view(), name='token_obtain_pair'),
+        path('login/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+        path('register/', RegisterView.as_view(), name='auth-register'),
+        path('restore/<str:username>/', RestoreView.as_view(), name='restore-password'),
+        path('me/', hot.GetUserView.as_view(), name='user-info'),
+    ]
+
+
+# Native async handlers for the hot endpoints under daphne
+urlpatterns = urlpatterns_for(async_views if settings.ASYNC_API_VIEWS else views)
@@ -2,11 +2,46 @@ from rest_framework.views import APIView
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework import status
+from django.conf import settings
 from django.contrib.auth.models import User
-from .serializers import MyTokenObtainPairSerializer, RegisterSerializer, RestoreSerializer
+from django.db import connections, router
+from backend.replicas import replica_reads
+from .serializers import MyTokenObtainPairSerializer, RegisterSerializer, RestoreSerializer, UserSearchSerializer
 from rest_framework import generics
 
 
+USER_SEARCH_PAGE_SIZE = 20
+
+
+def search_users(query, after=None, limit=USER_SEARCH_PAGE_SIZE, exclude=None):
+    """
+    Active users whose username starts with `query`, ignoring case, ordered by
+    (lowercased username, username) and starting after the username `after`.
+
+    Both the prefix match and the order run on the auth_user_username_search
+    index, so a page costs the same however many users there are. Returns
+    (id, username) rows.
+    """
+    # Raw SQL, so route it as the ORM would
+    connection = connections[router.db_for_read(User)]
+    table = connection.ops.quote_name(User._meta.db_table)
+    key = 'lower(username) COLLATE "C"'
+    sql = f'SELECT id, username FROM {table} WHERE {key} LIKE lower(%s) || \'%%\' AND is_active'
+    params = [connection.ops.prep_for_like_query(query)]
+    if after is not None:
+        sql += f' AND ({key}, username COLLATE "C") > (lower(%s), %s)'
+        params += [after, after]
+    if exclude is not None:
+        sql += ' AND id <> %s'
+        params.append(exclude)
+    sql += f' ORDER BY {key}, username COLLATE "C" LIMIT %s'
+    params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
 # Create your views here.
 class MyObtainTokenPairView(TokenObtainPairView):
     permission_classes = (AllowAny,)
@@ -32,4 +67,33 @@ class GetUserView(APIView):
     def get(self, request):
         return Response({
             'username': request.user.username
-        })
\ No newline at end of file
+        })
+
+
+class UserSearchView(APIView):
+    """
+    GET /users/?q=<prefix>&after=<username>&limit=<n>: people to start a chat
+    with. `next` is the username to pass as `after` for the following page, or
+    None on the last one.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @replica_reads
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        after = request.query_params.get('after')
+        if not query:
+            return Response({'status': 'error', 'message': 'q is required'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', USER_SEARCH_PAGE_SIZE))
+        except ValueError:
+            return Response({'status': 'error', 'message': 'Invalid limit'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, settings.USER_SEARCH_MAX_RESULTS))
+
+        # One extra row tells whether there is a next page
+        rows = search_users(query, after, limit + 1, exclude=request.user.id)
+        users = [{'id': pk, 'username': username} for pk, username in rows[:limit]]
+        return Response({
+            'results': UserSearchSerializer(users, many=True).data,
+            'next': users[-1]['username'] if len(rows) > limit else None,
+        })
@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def create_partitions(sender, using, **kwargs):
+    # Every deploy migrates, so partitions ahead never depend on cron alone
+    from .partitions import ensure_partitions
+    ensure_partitions(using=using)
 
 
 class ApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "api"
+
+    def ready(self):
+        # Register the signal handlers that keep the membership cache fresh
+        from . import membership  # noqa: F401
+        post_migrate.connect(create_partitions, sender=self)
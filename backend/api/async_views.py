@@ -0,0 +1,112 @@
+"""
+Async versions of the hot endpoints in views.py, served when ASYNC_API_VIEWS
+is on (the default under daphne). Responses are the same as the sync views'.
+"""
+from asgiref.sync import sync_to_async
+from rest_framework import status
+
+from backend.async_api import AsyncAPIView, json_response
+from backend.replicas import apin, replica_reads
+from .chat_keys import ensure_chat_keys
+from .conditional import not_modified, with_validators
+from .models import Chat, ChatKey, GroupMessage, InboxVersion, UserKey
+from .pagination import InvalidCursor, apaginate_messages, parse_page_size
+from .serializers import MESSAGE_VALUES, ChatKeySerializer, UserKeySerializer, inbox_entry_data
+from .views import CHAT_KEY_MAX_AGE, history_chats, history_data, history_etag, inbox_entries, user_key_etag
+
+
+def error(message, status):
+    return json_response({'status': 'error', 'message': message}, status=status)
+
+
+class ChatView(AsyncAPIView):
+    @replica_reads
+    async def get(self, request):
+        user = request.user
+
+        # Read first: rows changing after this are sent again next time, never skipped
+        version = await InboxVersion.objects.filter(user=user).values_list('version', flat=True).afirst() or 0
+        try:
+            entries = inbox_entries(user, request.GET.get('since'))
+        except ValueError:
+            return error('Invalid version', status.HTTP_400_BAD_REQUEST)
+
+        return json_response({
+            'status': 'success',
+            'version': version,
+            'chats': [inbox_entry_data(entry, user) async for entry in entries],
+        })
+
+
+class ChatHistoryView(AsyncAPIView):
+    @replica_reads
+    async def get(self, request, chat_id):
+        user = request.user
+
+        chat = await history_chats().filter(id=chat_id).afirst()
+        if chat is None:
+            return error('Chat not found', status.HTTP_404_NOT_FOUND)
+        if user.id != chat.user1_id and user.id != chat.user2_id:
+            return error('You are not a participant in this chat', status.HTTP_403_FORBIDDEN)
+
+        etag = history_etag(chat, user)
+        response = not_modified(request, etag)
+        if response is not None:
+            return with_validators(response, etag, no_cache=True)
+
+        # One bounded page of messages, newest page unless a cursor is given
+        try:
+            messages, prev_cursor, next_cursor = await apaginate_messages(
+                GroupMessage.objects.in_chat(chat).values(*MESSAGE_VALUES),
+                before=request.GET.get('before'),
+                after=request.GET.get('after'),
+                limit=parse_page_size(request.GET.get('limit')),
+            )
+        except InvalidCursor:
+            return error('Invalid cursor', status.HTTP_400_BAD_REQUEST)
+
+        response = json_response(history_data(chat, user, messages, prev_cursor, next_cursor))
+        return with_validators(response, etag, no_cache=True)
+
+
+class ChatKeyView(AsyncAPIView):
+    async def get(self, request, chat_id):
+        key_obj = await ChatKey.objects.filter(chat_id=chat_id, user=request.user).afirst()
+        if key_obj is None:
+            chat = await (
+                Chat.objects.select_related('user1__user_key', 'user2__user_key')
+                .filter(id=chat_id).afirst()
+            )
+            if chat is None or request.user.id not in (chat.user1_id, chat.user2_id):
+                return json_response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+            # Ensure symmetric key exists for this chat and both users
+            keys = await sync_to_async(ensure_chat_keys)(chat)
+            key_obj = next(key for key in keys if key.user_id == request.user.id)
+        etag = str(key_obj.pk)
+        response = not_modified(request, etag) or json_response(ChatKeySerializer(key_obj).data)
+        return with_validators(response, etag, max_age=CHAT_KEY_MAX_AGE)
+
+
+class UserKeyView(AsyncAPIView):
+    @replica_reads
+    async def get(self, request):
+        user_key = await UserKey.objects.filter(user=request.user).afirst()
+        if user_key is None:
+            return json_response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        etag = user_key_etag(user_key)
+        response = (
+            not_modified(request, etag, user_key.updated_at)
+            or json_response(UserKeySerializer(user_key).data)
+        )
+        return with_validators(response, etag, user_key.updated_at, no_cache=True)
+
+    async def post(self, request):
+        serializer = UserKeySerializer(data=self.parse_json(request))
+        if serializer.is_valid():
+            await UserKey.objects.aupdate_or_create(
+                user=request.user,
+                defaults=serializer.validated_data
+            )
+            await apin(request.user.id)
+            return json_response({'status': 'ok'})
+        return json_response(serializer.errors, status=400)
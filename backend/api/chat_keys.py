@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.db import transaction
+
+from backend.cache import TTLCache
+from .models import Chat, ChatKey
+
+
+OAEP = asym_padding.OAEP(
+    mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+# Parsed RSA public keys by (user id, JWK fingerprint)
+public_keys = TTLCache(maxsize=4096, ttl=3600)
+
+# RSA encryption releases the GIL, so participants are wrapped in parallel
+wrap_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='chat-key-wrap')
+
+# Chat id -> Future of the generation running in this process
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def jwk_fingerprint(jwk):
+    return hashlib.sha256(f"{jwk['e']}.{jwk['n']}".encode()).hexdigest()
+
+
+def load_public_key(user):
+    """
+    RSA public key object for the user's JWK, parsed once per key.
+    """
+    jwk = user.user_key.public_key
+    cache_key = (user.id, jwk_fingerprint(jwk))
+    public_key = public_keys.get(cache_key)
+    if public_key is None:
+        # decode e and n from base64url
+        e = int.from_bytes(base64.urlsafe_b64decode(jwk['e'] + '=='), 'big')
+        n = int.from_bytes(base64.urlsafe_b64decode(jwk['n'] + '=='), 'big')
+        public_key = rsa.RSAPublicNumbers(e=e, n=n).public_key()
+        public_keys.set(cache_key, public_key)
+    return public_key
+
+
+def wrap_key(public_key, sym_key):
+    return public_key.encrypt(sym_key, OAEP)
+
+
+def ensure_chat_keys(chat):
+    """
+    Make sure the chat has a symmetric key wrapped for both participants and
+    return its ChatKey rows.
+
+    Concurrent calls for the same chat in this process share one generation;
+    across processes the chat row lock lets only the first writer insert.
+    `chat.user1` / `chat.user2` should come with `user_key` selected.
+    """
+    with _inflight_lock:
+        flight = _inflight.get(chat.id)
+        leader = flight is None
+        if leader:
+            flight = _inflight[chat.id] = Future()
+    if not leader:
+        return flight.result()
+
+    try:
+        keys = _provision(chat)
+    except Exception as e:
+        flight.set_exception(e)
+        raise
+    else:
+        flight.set_result(keys)
+        return keys
+    finally:
+        with _inflight_lock:
+            del _inflight[chat.id]
+
+
+def _provision(chat):
+    keys = list(ChatKey.objects.filter(chat=chat))
+    if keys:
+        return keys
+
+    # Generate and wrap outside the transaction so the row lock stays short
+    participants = [chat.user1, chat.user2]
+    sym_key = os.urandom(32)  # 256-bit AES key
+    recipient_keys = [load_public_key(user) for user in participants]
+    wrapped = wrap_executor.map(wrap_key, recipient_keys, [sym_key] * len(recipient_keys))
+    new_keys = [
+        ChatKey(
+            chat=chat,
+            user=user,
+            encrypted_key=encrypted,
+            iv=os.urandom(12)
+        )
+        for user, encrypted in zip(participants, wrapped)
+    ]
+
+    with transaction.atomic():
+        Chat.objects.select_for_update().get(id=chat.id)
+        keys = list(ChatKey.objects.filter(chat=chat))
+        if keys:
+            # Another process got there first; its key wins
+            return keys
+        return ChatKey.objects.bulk_create(new_keys)
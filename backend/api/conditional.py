@@ -0,0 +1,36 @@
+"""
+Conditional GET for responses whose validators are cheaper to read than the
+body is to build: key material and chat history pages.
+
+    response = not_modified(request, etag) or build_response()
+    return with_validators(response, etag, no_cache=True)
+"""
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+def _timestamp(last_modified):
+    return int(last_modified.timestamp()) if last_modified is not None else None
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    304 Not Modified if the request's If-None-Match / If-Modified-Since still
+    match `etag` and `last_modified` (a datetime), else None.
+    """
+    return get_conditional_response(request, etag=quote_etag(etag), last_modified=_timestamp(last_modified))
+
+
+def with_validators(response, etag, last_modified=None, **cache_control):
+    """
+    Add the validators and Cache-Control to a 200 or 304 response. Responses
+    vary on Authorization since each one is for a single user.
+    """
+    if response.status_code not in (200, 304):
+        return response
+    response.headers['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(_timestamp(last_modified))
+    patch_cache_control(response, private=True, **cache_control)
+    patch_vary_headers(response, ['Authorization'])
+    return response
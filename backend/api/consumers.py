@@ -1,98 +1,388 @@
+import asyncio
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .models import Chat, GroupMessage
-from channels.db import database_sync_to_async
+from django.conf import settings
+from backend import metrics
+from . import protocol
+from .models import Chat, ChatReadState, GroupMessage
+from .membership import chat_members
+from .write_behind import message_writer
+from backend.db import db_sync_to_async
+from backend.replicas import apin
+
+
+def chat_group(chat_id):
+    return f"chat_{chat_id}"
+
+
+def user_group(user_id):
+    # Every socket of a user, for events that are not tied to an open chat
+    return f"user_{user_id}"
+
+
+class MessagingConsumer(AsyncWebsocketConsumer):
+    """
+    Saving, broadcasting and acknowledging chat messages, shared by the
+    per-chat and the per-user sockets. Membership of `chat_id` must have been
+    checked at connect.
+    """
+    binary = False
 
-class ChatroomConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope['user']
+        # Acknowledgements still waiting for their write-behind batch
+        self.pending_acks = set()
+        # Highest read mark per chat not yet written, and the timer writing them
+        self.read_marks = {}
+        self.read_flush = None
+        self.counted_open = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        if settings.METRICS_ENABLED:
+            metrics.open_sockets.labels(type(self).__name__).inc()
+            self.counted_open = True
+
+    async def disconnect(self, close_code):
+        if self.counted_open:
+            metrics.open_sockets.labels(type(self).__name__).dec()
+            self.counted_open = False
+        # Let buffered messages of this socket reach the database
+        if self.pending_acks:
+            await asyncio.gather(*self.pending_acks, return_exceptions=True)
+        if self.read_flush is not None:
+            self.read_flush.cancel()
+            await self.flush_read_marks()
+
+    async def handle_frame(self, chat_id, frame):
+        if isinstance(frame, protocol.ReadMark):
+            self.mark_read(chat_id, frame.seq)
+        else:
+            await self.post_message(chat_id, frame.ct, frame.iv, frame.client_id)
+
+    async def post_message(self, chat_id, ct, iv, client_id):
+        received = metrics.clock()
+        message_id = seq = None
+        if settings.MESSAGE_WRITE_BEHIND:
+            # Queue the message for the next batch and broadcast right away
+            durable = await message_writer.add(
+                GroupMessage(group_id=chat_id, author=self.user, body=ct, iv=iv)
+            )
+        else:
+            # Save AES-encrypted message and iv
+            message_id, seq = await self.save_message(chat_id, ct, iv)
+        # The sender's next history and inbox reads must include it
+        await apin(self.user.id)
+
+        # Broadcast encrypted message to group
+        event = {
+            'type': 'chat_message',
+            'chat_id': chat_id,
+            'ct': ct,
+            'iv': iv,
+            'author': self.user.username,
+            'author_id': self.user.id,
+            'message_id': message_id,
+            'seq': seq,
+        }
+        # Encoded here once rather than by every JSON socket it reaches
+        event['json'] = protocol.encode_json(event)
+        await self.broadcast(chat_group(chat_id), event)
+        metrics.observe(metrics.message_broadcast_seconds, received)
+
+        if settings.MESSAGE_WRITE_BEHIND:
+            ack = asyncio.ensure_future(self.acknowledge(durable, chat_id, client_id))
+            self.pending_acks.add(ack)
+            ack.add_done_callback(self.pending_acks.discard)
+
+    async def send_error(self, message, client_id=None):
+        if self.binary:
+            await self.send(bytes_data=protocol.encode_binary_error(message))
+        else:
+            await self.send(text_data=json.dumps({
+                'error': message,
+                **({'client_id': client_id} if client_id is not None else {}),
+            }))
+
+    async def acknowledge(self, durable, chat_id, client_id):
+        # Tell the sender its message is stored, or that it was lost
+        try:
+            message_id, seq = await durable
+        except Exception as e:
+            await self.send_error(f'Message was not saved: {e}', client_id)
+            return
+        # The message went out with no seq; give it to everyone in the chat
+        # so their resume point and read marks keep up
+        await self.broadcast(
+            chat_group(chat_id),
+            {
+                'type': 'chat_stored',
+                'chat_id': chat_id,
+                'author_id': self.user.id,
+                'message_id': message_id,
+                'seq': seq,
+            }
+        )
+        if self.binary:
+            await self.send(bytes_data=protocol.encode_binary_ack(message_id, client_id, seq))
+        else:
+            await self.send(text_data=json.dumps({
+                'ack': message_id,
+                'chat_id': chat_id,
+                'client_id': client_id,
+                'seq': seq,
+            }))
+
+    def mark_read(self, chat_id, seq):
+        # Marks sent within READ_RECEIPT_DELAY_MS collapse into one write per chat
+        if seq > self.read_marks.get(chat_id, 0):
+            self.read_marks[chat_id] = seq
+        if self.read_flush is None:
+            self.read_flush = asyncio.ensure_future(
+                self.flush_read_marks(settings.READ_RECEIPT_DELAY_MS / 1000)
+            )
+
+    async def flush_read_marks(self, delay=0):
+        await asyncio.sleep(delay)
+        marks, self.read_marks, self.read_flush = self.read_marks, {}, None
+        for chat_id, seq in marks.items():
+            read_seq = await self.save_read_mark(chat_id, seq)
+            if read_seq is None:
+                continue
+            await apin(self.user.id)
+            # Let the other participant (and this user's other sockets) see it
+            await self.broadcast(
+                chat_group(chat_id),
+                {
+                    'type': 'chat_read',
+                    'chat_id': chat_id,
+                    'user': self.user.username,
+                    'user_id': self.user.id,
+                    'read_seq': read_seq,
+                }
+            )
+
+    async def broadcast(self, group, event):
+        start = metrics.clock()
+        await self.channel_layer.group_send(group, event)
+        metrics.observe(metrics.group_send_seconds, start, event['type'])
+
+    @db_sync_to_async
+    def save_read_mark(self, chat_id, seq):
+        return ChatReadState.objects.advance(chat_id, self.user.id, seq)
+
+    @db_sync_to_async
+    def save_message(self, chat_id, ct, iv):
+        start = metrics.clock()
+        # Chat and author were validated at connect, so this is a single INSERT
+        message = GroupMessage.objects.create_in_sequence(
+            group_id=chat_id,
+            author=self.user,
+            body=ct,
+            iv=iv
+        )
+        metrics.observe(metrics.save_message_seconds, start)
+        return message.id, message.seq
+
+
+class ChatroomConsumer(MessagingConsumer):
+    """
+    A socket for one chat. Clients reconnecting with ?last_seq=N first get the
+    messages after N, in batches, and then live ones.
+    """
+
+    async def connect(self):
+        await super().connect()
+        # Highest seq the client has after the replay; live events up to it are duplicates
+        self.replayed_seq = 0
+        self.binary = protocol.BINARY_SUBPROTOCOL in self.scope.get('subprotocols', [])
         self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.room_group_name = f"chat_{self.chat_id}"
-        self.chat = await self.get_chat()
+        self.room_group_name = chat_group(self.chat_id)
+        members = await self.get_members()
 
-        if self.user.id in (self.chat.user1_id, self.chat.user2_id):
+        # Membership is settled here; the message path relies on it without re-reading
+        if members and self.user.id in members:
             # Connect to the group
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
-            await self.accept()
+            # Binary frames for clients that ask for them, JSON otherwise
+            if self.binary:
+                await self.accept(subprotocol=protocol.BINARY_SUBPROTOCOL)
+            else:
+                await self.accept()
+            # Joined before replaying, so live messages wait in the channel
+            # queue and nothing falls between the replay and live delivery
+            last_seq = self.requested_seq()
+            if last_seq is not None:
+                await self.replay(last_seq)
         else:
             await self.close()
 
 
     async def disconnect(self, close_code):
+        await super().disconnect(close_code)
+
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            if not text_data.strip():
-                raise ValueError("Empty message received")
+            if self.binary:
+                frame = protocol.decode_binary(bytes_data or b'')
+            else:
+                frame = protocol.decode_json(text_data or '')
+            await self.handle_frame(self.chat_id, frame)
+        except json.JSONDecodeError:
+            await self.send_error('Invalid JSON format')
+        except Exception as e:
+            await self.send_error(str(e))
+            await self.close()
 
-            data = json.loads(text_data)
-            # Expect AES-GCM ciphertext and iv
-            ct = data.get('ct')
-            iv = data.get('iv')
-            if not ct or not iv:
-                raise ValueError("Invalid message format: missing ct or iv")
+    async def chat_message(self, event):
+        if event.get('seq') is not None and event['seq'] <= self.replayed_seq:
+            return
+        # Send AES ciphertext and iv to client
+        if self.binary:
+            await self.send(bytes_data=protocol.encode_binary(event))
+        else:
+            await self.send(text_data=protocol.encode_json(event))
 
-            print("User:", self.user)
-            print("Is Anonymous:", self.user.is_anonymous)
-            print("Message:", ct)
+    async def chat_read(self, event):
+        if self.binary:
+            await self.send(bytes_data=protocol.encode_binary_read(event))
+        else:
+            await self.send(text_data=protocol.encode_read_json(event))
 
-            # Save AES-encrypted message and iv
-            await self.save_message(ct, iv)
+    async def chat_stored(self, event):
+        # Replayed with its seq already
+        if event['seq'] <= self.replayed_seq:
+            return
+        if self.binary:
+            await self.send(bytes_data=protocol.encode_binary_stored(event))
+        else:
+            await self.send(text_data=protocol.encode_stored_json(event))
 
-            # Broadcast encrypted message to group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'ct': ct,
-                    'iv': iv,
-                    'author': self.user.username,
-                }
-            )
+    def requested_seq(self):
+        values = parse_qs(self.scope['query_string'].decode()).get('last_seq')
+        try:
+            return int(values[0]) if values else None
+        except ValueError:
+            return None
+
+    async def replay(self, last_seq):
+        # Bounded queries along the (group, seq) index: cost follows the gap
+        batch_size = settings.MESSAGE_RESUME_BATCH_SIZE
+        self.replayed_seq = last_seq
+        while True:
+            events = await self.load_missed(last_seq, batch_size)
+            for event in events:
+                await self.chat_message(event)
+            if events:
+                last_seq = self.replayed_seq = events[-1]['seq']
+            if len(events) < batch_size:
+                break
+
+    @db_sync_to_async
+    def load_missed(self, after_seq, limit):
+        rows = (
+            GroupMessage.objects
+            .filter(group_id=self.chat_id, seq__gt=after_seq)
+            .order_by('seq')
+            .values_list('id', 'seq', 'body', 'iv', 'author_id', 'author__username')[:limit]
+        )
+        return [
+            {
+                'type': 'chat_message',
+                'chat_id': self.chat_id,
+                'ct': bytes(body),
+                'iv': bytes(iv),
+                'author': author,
+                'author_id': author_id,
+                'message_id': message_id,
+                'seq': seq,
+            }
+            for message_id, seq, body, iv, author_id, author in rows
+        ]
+
+    async def get_members(self):
+        members = chat_members.get(self.chat_id)
+        if members is None:
+            members = await self.load_members()
+            if members is not None:
+                chat_members.set(self.chat_id, members)
+        return members
+
+    @db_sync_to_async
+    def load_members(self):
+        return Chat.objects.filter(id=self.chat_id).values_list('user1_id', 'user2_id').first()
+
+
+class StreamConsumer(MessagingConsumer):
+    """
+    One socket per user for all of their chats: it joins every chat group and
+    the user's own group, and tags frames in both directions with chat_id.
+    """
+
+    async def connect(self):
+        await super().connect()
+        self.chat_ids = set()
+        if self.user.is_anonymous:
+            await self.close()
+            return
+
+        self.chat_ids = set(await self.load_chat_ids())
+        groups = [user_group(self.user.id)] + [chat_group(chat_id) for chat_id in self.chat_ids]
+        await asyncio.gather(*(
+            self.channel_layer.group_add(group, self.channel_name) for group in groups
+        ))
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await super().disconnect(close_code)
+        if self.user.is_anonymous:
+            return
+
+        groups = [user_group(self.user.id)] + [chat_group(chat_id) for chat_id in self.chat_ids]
+        await asyncio.gather(*(
+            self.channel_layer.group_discard(group, self.channel_name) for group in groups
+        ))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            frame = protocol.decode_stream_json(text_data or '')
+            if frame.chat_id not in self.chat_ids:
+                await self.send_error('You are not a participant in this chat', getattr(frame, 'client_id', None))
+                return
+            await self.handle_frame(frame.chat_id, frame)
         except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                'error': 'Invalid JSON format'
-            }))
+            await self.send_error('Invalid JSON format')
         except Exception as e:
-            await self.send(text_data=json.dumps({
-                'error': str(e)
-            }))
+            await self.send_error(str(e))
             await self.close()
 
     async def chat_message(self, event):
-        # Send AES ciphertext and iv to client
-        await self.send(text_data=json.dumps({
-            'ct': event['ct'],
-            'iv': event['iv'],
-            'author': event['author'],
-        }))
-
-    @database_sync_to_async
-    def get_chat(self):
-        return Chat.objects.get(id=self.chat_id)
-
-    @database_sync_to_async
-    def save_message(self, ct, iv):
-        try:
-            chat = Chat.objects.get(id=self.chat_id)
-        except Chat.DoesNotExist:
-            raise Exception("Chat does not exist")
+        await self.send(text_data=protocol.encode_stream_json(event))
 
-        if self.user.is_anonymous:
-            raise Exception("Anonymous users cannot send messages")
+    async def chat_read(self, event):
+        await self.send(text_data=protocol.encode_stream_read_json(event))
 
-        # Save ciphertext and iv
-        GroupMessage.objects.create(
-            group=chat,
-            author=self.user,
-            body=ct,
-            iv=iv
-        )
\ No newline at end of file
+    async def chat_stored(self, event):
+        await self.send(text_data=protocol.encode_stream_stored_json(event))
+
+    async def chat_created(self, event):
+        # Start following a chat that was created after this socket connected
+        chat_id = event['chat_id']
+        if chat_id not in self.chat_ids:
+            self.chat_ids.add(chat_id)
+            await self.channel_layer.group_add(chat_group(chat_id), self.channel_name)
+        await self.send(text_data=json.dumps({'chat_created': chat_id}))
+
+    @db_sync_to_async
+    def load_chat_ids(self):
+        return list(Chat.objects.values_list('id', flat=True).for_user(self.user))
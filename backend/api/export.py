@@ -0,0 +1,53 @@
+"""
+Full chat export as NDJSON: a {"type": "chat"} line, then one {"type": "message"}
+line per message in seq order.
+
+Rows are read through a server-side cursor in EXPORT_CHUNK_SIZE batches
+(QuerySet.aiterator), encoded from plain values without model instances or
+serializers, and yielded a batch at a time, so memory does not depend on the
+size of the chat and the first lines go out before the last rows are read.
+"""
+import base64
+import json
+
+from .models import GroupMessage
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _message_line(row):
+    return json.dumps({
+        'type': 'message',
+        'id': row['id'],
+        'seq': row['seq'],
+        'body': base64.b64encode(row['body']).decode(),
+        'iv': base64.b64encode(row['iv']).decode(),
+        'author': row['author__username'],
+        'timestamp': row['created'].isoformat(),
+    }) + '\n'
+
+
+async def export_lines(chat):
+    yield json.dumps({
+        'type': 'chat',
+        'id': chat.id,
+        'user1': chat.user1.username,
+        'user2': chat.user2.username,
+        'created_at': chat.created_at.isoformat(),
+    }) + '\n'
+
+    # Walks the (group, seq) index of each partition in turn
+    rows = (
+        GroupMessage.objects.in_chat(chat)
+        .order_by('seq')
+        .values('id', 'seq', 'body', 'iv', 'author__username', 'created')
+    )
+    lines = []
+    async for row in rows.aiterator(chunk_size=EXPORT_CHUNK_SIZE):
+        lines.append(_message_line(row))
+        if len(lines) == EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
@@ -0,0 +1,28 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.partitions import archive_partitions, month_start
+
+
+class Command(BaseCommand):
+    help = (
+        "Detach message partitions older than the hot window and move them to "
+        "the archive schema, e.g. for pg_dump and DROP. Their messages leave "
+        "history, export and sync."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=settings.MESSAGE_HOT_MONTHS,
+                            help="Whole months kept online before the current one")
+        parser.add_argument('--schema', default=settings.MESSAGE_ARCHIVE_SCHEMA)
+        parser.add_argument('--tablespace', help="Also move archived partitions to this tablespace")
+
+    def handle(self, *args, **options):
+        before = month_start(datetime.now(timezone.utc), -options['keep_months'])
+        archived = archive_partitions(before, options['schema'], options['tablespace'])
+        for name in archived:
+            self.stdout.write(f"Archived {name} to {options['schema']}")
+        if not archived:
+            self.stdout.write(f"No partition ends before {before:%Y-%m-%d}")
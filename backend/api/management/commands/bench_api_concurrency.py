@@ -0,0 +1,168 @@
+import asyncio
+import json
+import statistics
+import time
+from types import ModuleType
+
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.urls import path
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts import async_views as account_async_views, views as account_views
+from api import async_views, views
+from api.models import Chat, ChatKey, GroupMessage, UserKey
+from backend.middleware.jwt_auth import user_cache
+
+
+def urlconf(name, api, accounts):
+    module = ModuleType(name)
+    module.urlpatterns = [
+        path('api/chat/', api.ChatView.as_view()),
+        path('api/chat/<int:chat_id>/history/', api.ChatHistoryView.as_view()),
+        path('api/chat/<int:chat_id>/key/', api.ChatKeyView.as_view()),
+        path('api/keys/', api.UserKeyView.as_view()),
+        path('auth/me/', accounts.GetUserView.as_view()),
+    ]
+    return module
+
+
+URLCONFS = {
+    'sync': urlconf('bench_sync_urls', views, account_views),
+    'async': urlconf('bench_async_urls', async_views, account_async_views),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the hot REST endpoints as DRF views and as native async views: "
+        "requests/s and latency with many concurrent clients, driven in-process "
+        "through Django's ASGI handler as daphne would."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=50,
+                            help="Messages per chat, one history page")
+
+    def handle(self, *args, **options):
+        targets = self.seed(options['users'], options['messages'])
+        results = {}
+        for label, conf in URLCONFS.items():
+            user_cache.clear()
+            with override_settings(ROOT_URLCONF=conf):
+                results[label] = asyncio.run(self.run(targets, options['requests'], options['clients']))
+        self.stdout.write(json.dumps({
+            'clients': options['clients'],
+            'requests': options['requests'],
+            'results': results,
+        }))
+
+    def seed(self, count, messages):
+        """
+        (user, path) pairs over every endpoint for users paired into chats.
+        """
+        users = [User.objects.get_or_create(username=f'bench_api_{i}')[0] for i in range(count)]
+        targets = []
+        for user1, user2 in zip(users[::2], users[1::2]):
+            chat = Chat.objects.filter(user1=user1, user2=user2).first()
+            if chat is None:
+                chat = Chat.objects.create(user1=user1, user2=user2)
+                for user in (user1, user2):
+                    ChatKey.objects.create(chat=chat, user=user, encrypted_key=b'k' * 32, iv=b'i' * 12)
+                GroupMessage.objects.bulk_create_in_sequence([
+                    GroupMessage(group=chat, author=(user1, user2)[i % 2], body=b'b' * 96, iv=b'i' * 12)
+                    for i in range(messages)
+                ])
+            for user in (user1, user2):
+                UserKey.objects.get_or_create(user=user, defaults={
+                    'public_key': {'kty': 'RSA'}, 'encrypted_private_key': b'x', 'salt': b's', 'iv': b'i',
+                })
+                targets += [
+                    (user, '/api/chat/'),
+                    (user, f'/api/chat/{chat.id}/history/'),
+                    (user, f'/api/chat/{chat.id}/key/'),
+                    (user, '/api/keys/'),
+                    (user, '/auth/me/'),
+                ]
+        return targets
+
+    async def run(self, targets, requests, clients):
+        # Fresh tokens per run, as access tokens are short-lived
+        tokens = {user: f'Bearer {AccessToken.for_user(user)}'.encode() for user, _ in targets}
+        return await drive([(tokens[user], url) for user, url in targets], requests, clients)
+
+
+async def asgi_get(handler, token, url):
+    """
+    Status of a GET through an ASGI handler, with a bearer `token` (bytes).
+    """
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': query.encode(), 'root_path': '', 'server': ('bench', 80), 'client': ('bench', 0),
+        'headers': [(b'host', b'localhost'), (b'authorization', token)],
+    }
+    received = []
+
+    async def receive():
+        if received:
+            # Nothing more to read; wait as a client that stays connected would
+            await asyncio.Event().wait()
+        received.append(True)
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    statuses = []
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    await handler(scope, receive, send)
+    return statuses[0]
+
+
+def latency_stats(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'p50_ms': None, 'p99_ms': None}
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000, 2),
+    }
+
+
+async def drive(targets, requests, clients):
+    """
+    `requests` GETs over (token, url) `targets` in turn from `clients`
+    concurrent clients, through Django's ASGI handler.
+    """
+    handler = ASGIHandler()
+    pending = iter(range(requests))
+    latencies = []
+    errors = 0
+
+    async def client():
+        nonlocal errors
+        for i in pending:
+            token, url = targets[i % len(targets)]
+            start = time.perf_counter()
+            status = await asgi_get(handler, token, url)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    return {
+        'seconds': round(elapsed, 2),
+        'requests_per_second': round(requests / elapsed, 1),
+        **latency_stats(latencies),
+        'errors': errors,
+    }
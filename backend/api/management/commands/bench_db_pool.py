@@ -0,0 +1,48 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from .bench_suite import Command as Suite
+
+
+class Command(BaseCommand):
+    help = (
+        "Messages/s and latency of the chat sockets with the database pool on "
+        "and off (DB_POOL), each in a fresh process over the same seeded chats. "
+        "Messages are saved before broadcast, so every one takes a connection."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=50, help="Messages sent per socket")
+        parser.add_argument('--body-bytes', type=int, default=96)
+        parser.add_argument('--child', action='store_true', help="Run one measurement in this process")
+
+    def handle(self, *args, **options):
+        if options['child']:
+            suite = Suite()
+            chats = suite.seed(options['chats'] * 2, options['chats'], 0, options['body_bytes'])
+            result = asyncio.run(suite.sockets(chats, options['messages'], options['body_bytes']))
+            self.stdout.write(json.dumps(result))
+            return
+
+        results = {}
+        for pool in ('False', 'True'):
+            env = dict(os.environ, DB_POOL=pool, MESSAGE_WRITE_BEHIND='False')
+            child = subprocess.run(
+                [sys.executable, sys.argv[0], 'bench_db_pool', '--child',
+                 '--chats', str(options['chats']), '--messages', str(options['messages']),
+                 '--body-bytes', str(options['body_bytes'])],
+                env=env, capture_output=True, text=True, check=True,
+            )
+            results['pool' if pool == 'True' else 'no_pool'] = json.loads(child.stdout.splitlines()[-1])
+        self.stdout.write(json.dumps({
+            'db_executor_workers': settings.DB_EXECUTOR_WORKERS,
+            'db_pool_max_size': settings.DB_POOL_MAX_SIZE,
+            **results,
+        }))
@@ -0,0 +1,104 @@
+import base64
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+TABLE = 'bench_message_{}'
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare message storage as base64 text and as bytea on a synthetic table: "
+        "table/index size and latency of reading and serializing a history page. "
+        "Uses temporary tables, so nothing is left behind."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000000)
+        parser.add_argument('--chats', type=int, default=10000)
+        parser.add_argument('--body-bytes', type=int, default=96,
+                            help="Ciphertext size per message")
+        parser.add_argument('--pages', type=int, default=2000,
+                            help="History pages read per storage format")
+        parser.add_argument('--page-size', type=int, default=50)
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        results = {}
+        with connection.cursor() as cursor:
+            for kind in ('text', 'bytea'):
+                start = time.perf_counter()
+                self.populate(cursor, kind, options)
+                results[kind] = {
+                    'populate_seconds': round(time.perf_counter() - start, 2),
+                    **self.sizes(cursor, kind),
+                    **self.read(cursor, kind, options),
+                }
+        self.stdout.write(json.dumps({
+            'rows': options['rows'],
+            'body_bytes': options['body_bytes'],
+            'results': results,
+        }))
+
+    def populate(self, cursor, kind, options):
+        # Random-looking bytes built server-side from md5 digests
+        digests = ' || '.join(
+            f"md5((g * {i + 1})::text)" for i in range(-(-options['body_bytes'] // 16))
+        )
+        body = f"substring(decode({digests}, 'hex') from 1 for {options['body_bytes']})"
+        iv = "substring(decode(md5((g + 1)::text), 'hex') from 1 for 12)"
+        if kind == 'text':
+            body = f"translate(encode({body}, 'base64'), E'\\n', '')"
+            iv = f"encode({iv}, 'base64')"
+
+        table = TABLE.format(kind)
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {table} ("
+            f"id bigserial PRIMARY KEY, group_id bigint NOT NULL, "
+            f"created timestamptz NOT NULL, body {kind} NOT NULL, iv {kind} NOT NULL)"
+        )
+        cursor.execute(
+            f"INSERT INTO {table} (group_id, created, body, iv) "
+            f"SELECT 1 + (g %% %s), now() - (%s - g) * interval '1 second', {body}, {iv} "
+            f"FROM generate_series(1, %s) AS g",
+            [options['chats'], options['rows'], options['rows']]
+        )
+        cursor.execute(f"CREATE INDEX ON {table} (group_id, created, id)")
+        cursor.execute(f"ANALYZE {table}")
+
+    def sizes(self, cursor, kind):
+        table = TABLE.format(kind)
+        cursor.execute(
+            "SELECT pg_table_size(%s), pg_indexes_size(%s), pg_total_relation_size(%s)",
+            [table] * 3
+        )
+        heap, indexes, total = cursor.fetchone()
+        return {'table_bytes': heap, 'index_bytes': indexes, 'total_bytes': total}
+
+    def read(self, cursor, kind, options):
+        table = TABLE.format(kind)
+        query = (
+            f"SELECT id, created, body, iv FROM {table} "
+            f"WHERE group_id = %s ORDER BY created DESC, id DESC LIMIT %s"
+        )
+        chats = [random.randint(1, options['chats']) for _ in range(options['pages'])]
+        start = time.perf_counter()
+        for chat in chats:
+            cursor.execute(query, [chat, options['page_size']])
+            rows = cursor.fetchall()
+            # What the history view hands to JSON: base64 strings either way
+            if kind == 'bytea':
+                page = [
+                    {'id': pk, 'body': base64.b64encode(body).decode(), 'iv': base64.b64encode(iv).decode()}
+                    for pk, _, body, iv in rows
+                ]
+            else:
+                page = [{'id': pk, 'body': body, 'iv': iv} for pk, _, body, iv in rows]
+            json.dumps(page)
+        elapsed = time.perf_counter() - start
+        return {'us_per_page': round(elapsed / len(chats) * 1e6, 1)}
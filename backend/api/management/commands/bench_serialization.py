@@ -0,0 +1,94 @@
+import io
+import json
+import os
+import timeit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from api import protocol
+from api.models import GroupMessage
+from api.serializers import ChatMessageSerializer, message_data, message_values
+from backend import renderers
+from backend.renderers import ORJSONParser, ORJSONRenderer
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmarks of the serialization paths, CPU per message: socket "
+        "fan-out encoding per recipient vs once per message, ChatMessageSerializer "
+        "vs values() rows for history pages, and DRF's JSON renderer and parser "
+        "vs the orjson ones. No database access."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, nargs='+', default=[2, 4, 16],
+                            help="Sockets a broadcast reaches")
+        parser.add_argument('--body-bytes', type=int, default=256)
+        parser.add_argument('--page-size', type=int, default=50, help="Messages per history page")
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        author = User(id=1, username='bench_author')
+        now = timezone.now()
+        messages = [
+            GroupMessage(id=i, seq=i, body=os.urandom(options['body_bytes']), iv=os.urandom(12),
+                         author=author, created=now)
+            for i in range(1, options['page_size'] + 1)
+        ]
+        page = options['page_size']
+
+        event = {
+            'type': 'chat_message', 'chat_id': 42, 'ct': messages[0].body, 'iv': messages[0].iv,
+            'author': author.username, 'author_id': author.id, 'message_id': 1, 'seq': 1,
+        }
+        fanout = []
+        for recipients in options['recipients']:
+            def per_recipient():
+                for _ in range(recipients):
+                    protocol.encode_stream_json(event)
+
+            def once():
+                encoded = dict(event, json=protocol.encode_json(event))
+                for _ in range(recipients):
+                    protocol.encode_stream_json(encoded)
+
+            fanout.append({
+                'recipients': recipients,
+                'per_recipient_us': self.time(per_recipient, iterations),
+                'encoded_once_us': self.time(once, iterations),
+            })
+
+        rows = [message_values(message) for message in messages]
+        data = {'messages': [message_data(row) for row in rows], 'read_seq': {author.username: page}}
+        rendered = JSONRenderer().render(data)
+        key = json.dumps({
+            'public_key': {'kty': 'RSA', 'e': 'AQAB', 'n': 'x' * 342},
+            'encrypted_private_key': 'eA==' * 400, 'salt': 'cw==', 'iv': 'aQ==',
+        }).encode()
+        self.stdout.write(json.dumps({
+            'orjson': renderers.orjson is not None,
+            'fanout_us_per_message': fanout,
+            'history_us_per_message': {
+                'model_serializer': self.time(lambda: ChatMessageSerializer(messages, many=True).data,
+                                              iterations, page),
+                'values_rows': self.time(lambda: [message_data(row) for row in rows], iterations, page),
+            },
+            'render_us_per_message': {
+                'drf_json': self.time(lambda: JSONRenderer().render(data), iterations, page),
+                'orjson': self.time(lambda: ORJSONRenderer().render(data), iterations, page),
+            },
+            'parse_us_per_request': {
+                'drf_json': self.time(lambda: JSONParser().parse(io.BytesIO(key)), iterations),
+                'orjson': self.time(lambda: ORJSONParser().parse(io.BytesIO(key)), iterations),
+            },
+            'page_bytes': len(rendered),
+        }))
+
+    def time(self, func, iterations, per=1):
+        best = min(timeit.repeat(func, number=iterations, repeat=3))
+        return round(best / iterations / per * 1e6, 3)
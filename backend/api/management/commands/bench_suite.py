@@ -0,0 +1,247 @@
+import asyncio
+import base64
+import json
+import os
+import resource
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.models import Chat, ChatKey, GroupMessage, UserKey
+from .bench_api_concurrency import drive, latency_stats
+
+
+def rss_bytes():
+    # Current resident set size; Linux only, None elsewhere
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test of the chat sockets and the REST endpoints on a seeded dataset: "
+        "connects/s and memory per socket, messages/s and end-to-end latency "
+        "between chat participants, requests/s and latency of ChatView, "
+        "ChatHistoryView and ChatKeyView, and the cost of writers sharing a chat's "
+        "seq counter. Prints one JSON object, and appends it to --output to track "
+        "results across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--chats', type=int, default=1000,
+                            help="Chats seeded, and both sides of each are connected")
+        parser.add_argument('--history', type=int, default=200,
+                            help="Messages seeded per chat")
+        parser.add_argument('--messages', type=int, default=20,
+                            help="Messages sent per socket during the run")
+        parser.add_argument('--body-bytes', type=int, default=96)
+        parser.add_argument('--rest-requests', type=int, default=2000,
+                            help="Requests per REST endpoint")
+        parser.add_argument('--rest-clients', type=int, default=100)
+        parser.add_argument('--seq-writers', type=int, default=8,
+                            help="Threads saving messages at once in the seq counter run; at most --chats, "
+                                 "and below DB_POOL_MAX_SIZE with the pool on")
+        parser.add_argument('--seq-messages', type=int, default=200,
+                            help="Messages saved per thread in the seq counter run")
+        parser.add_argument('--output', help="JSON lines file to append the result to")
+
+    def handle(self, *args, **options):
+        if options['seq_writers'] > options['chats']:
+            raise CommandError('--seq-writers needs a chat per writer, so it cannot exceed --chats')
+        started = timezone.now()
+        chats = self.seed(options['users'], options['chats'], options['history'], options['body_bytes'])
+        results = {
+            'sockets': asyncio.run(self.sockets(chats, options['messages'], options['body_bytes'])),
+            'rest': asyncio.run(self.rest(chats, options['rest_requests'], options['rest_clients'])),
+            'sequence': self.sequence(chats, options['seq_writers'], options['seq_messages'], options['body_bytes']),
+        }
+        report = json.dumps({
+            'commit': git_commit(),
+            'started': started.isoformat(),
+            'options': {key: options[key] for key in (
+                'users', 'chats', 'history', 'messages', 'body_bytes', 'rest_requests', 'rest_clients',
+                'seq_writers', 'seq_messages',
+            )},
+            'results': results,
+        })
+        if options['output']:
+            with open(options['output'], 'a') as output:
+                output.write(report + '\n')
+        self.stdout.write(report)
+
+    def seed(self, users, chats, history, body_bytes):
+        """
+        `chats` chats between `users` bench users, each with keys and `history`
+        messages. Rows from an earlier run with the same sizes are reused.
+        """
+        names = [f'bench_suite_{i}' for i in range(users)]
+        User.objects.bulk_create([User(username=name) for name in names], ignore_conflicts=True)
+        people = list(User.objects.filter(username__in=names).order_by('id'))
+        UserKey.objects.bulk_create([
+            UserKey(user=user, public_key={'kty': 'RSA', 'e': 'AQAB', 'n': 'x' * 342},
+                    encrypted_private_key=os.urandom(1232), salt=os.urandom(16), iv=os.urandom(12))
+            for user in people
+        ], ignore_conflicts=True)
+
+        # Each user talks to the next few, so chats spread over everyone
+        pairs = []
+        for step in range(1, len(people)):
+            for i in range(len(people)):
+                if len(pairs) == chats:
+                    break
+                j = i + step
+                if j < len(people):
+                    pairs.append((people[i], people[j]))
+            if len(pairs) == chats:
+                break
+
+        seeded = []
+        for user1, user2 in pairs:
+            chat = Chat.objects.filter(user1=user1, user2=user2).first()
+            if chat is None:
+                with transaction.atomic():
+                    chat = Chat.objects.create(user1=user1, user2=user2)
+                    ChatKey.objects.bulk_create([
+                        ChatKey(chat=chat, user=user, encrypted_key=os.urandom(60), iv=os.urandom(12))
+                        for user in (user1, user2)
+                    ])
+                    GroupMessage.objects.bulk_create_in_sequence([
+                        GroupMessage(group=chat, author=(user1, user2)[i % 2],
+                                     body=os.urandom(body_bytes), iv=os.urandom(12))
+                        for i in range(history)
+                    ])
+            seeded.append((chat.id, user1, user2))
+        return seeded
+
+    async def sockets(self, chats, messages, body_bytes):
+        from backend.asgi import application
+
+        tokens = {}
+        for _, user1, user2 in chats:
+            for user in (user1, user2):
+                tokens.setdefault(user.id, str(AccessToken.for_user(user)))
+
+        async def connect(chat_id, user):
+            communicator = WebsocketCommunicator(application, f'/ws/chatroom/{chat_id}/?token={tokens[user.id]}')
+            connected, _ = await communicator.connect(timeout=60)
+            if not connected:
+                raise RuntimeError(f'Socket to chat {chat_id} was refused')
+            return communicator
+
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        sockets = await asyncio.gather(*(
+            asyncio.gather(connect(chat_id, user1), connect(chat_id, user2))
+            for chat_id, user1, user2 in chats
+        ))
+        connect_seconds = time.perf_counter() - start
+        rss_after = rss_bytes()
+
+        latencies = []
+        padding = b'\0' * max(body_bytes - 8, 0)
+
+        async def receive_from_peer(communicator, username):
+            # Skips acknowledgements and the receiver's own messages coming back
+            while True:
+                frame = json.loads(await communicator.receive_from(timeout=60))
+                if 'ct' in frame and frame['author'] != username:
+                    return frame
+
+        async def converse(pair, chat):
+            # Participants take turns, each message timed until the peer has it
+            _, user1, user2 = chat
+            sides = [(pair[0], pair[1], user2.username), (pair[1], pair[0], user1.username)]
+            for i in range(messages * 2):
+                sender, receiver, receiver_name = sides[i % 2]
+                ct = base64.b64encode(struct.pack('!d', time.perf_counter()) + padding).decode()
+                await sender.send_to(text_data=json.dumps({'ct': ct, 'iv': 'aXZpdml2aXZpdml2'}))
+                frame = await receive_from_peer(receiver, receiver_name)
+                sent, = struct.unpack('!d', base64.b64decode(frame['ct'])[:8])
+                latencies.append(time.perf_counter() - sent)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(converse(pair, chat) for pair, chat in zip(sockets, chats)))
+        message_seconds = time.perf_counter() - start
+
+        await asyncio.gather(*(communicator.disconnect() for pair in sockets for communicator in pair))
+
+        count = len(sockets) * 2
+        return {
+            'sockets': count,
+            'connects_per_second': round(count / connect_seconds, 1),
+            'rss_bytes_per_socket': (rss_after - rss_before) // count if rss_before is not None else None,
+            'messages': len(latencies),
+            'messages_per_second': round(len(latencies) / message_seconds, 1),
+            **latency_stats(latencies),
+        }
+
+    async def rest(self, chats, requests, clients):
+        tokens = {}
+        targets = {'chats': [], 'history': [], 'chat_key': []}
+        for chat_id, user1, user2 in chats:
+            for user in (user1, user2):
+                token = tokens.setdefault(user.id, f'Bearer {AccessToken.for_user(user)}'.encode())
+                targets['chats'].append((token, '/api/chat/'))
+                targets['history'].append((token, f'/api/chat/{chat_id}/history/'))
+                targets['chat_key'].append((token, f'/api/chat/{chat_id}/key/'))
+        return {
+            name: await drive(endpoint_targets, requests, clients)
+            for name, endpoint_targets in targets.items()
+        }
+
+    def sequence(self, chats, writers, messages, body_bytes):
+        """
+        Messages/s and save latency of `writers` threads saving messages one at
+        a time, all into one chat, so they queue on its ChatSequence row, and
+        each into a chat of its own, so they do not.
+        """
+        def run(targets):
+            latencies = []
+            start_line = threading.Barrier(writers)
+
+            def write(chat_id, author):
+                start_line.wait()
+                try:
+                    for _ in range(messages):
+                        start = time.perf_counter()
+                        GroupMessage.objects.create_in_sequence(
+                            group_id=chat_id, author=author, body=os.urandom(body_bytes), iv=os.urandom(12),
+                        )
+                        latencies.append(time.perf_counter() - start)
+                finally:
+                    connection.close()
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(writers) as pool:
+                list(pool.map(lambda target: write(*target), targets))
+            seconds = time.perf_counter() - start
+            return {'messages_per_second': round(len(latencies) / seconds, 1), **latency_stats(latencies)}
+
+        own_chats = [(chat_id, user1) for chat_id, user1, _ in chats[:writers]]
+        return {
+            'writers': writers,
+            'one_chat': run([own_chats[0]] * writers),
+            'own_chats': run(own_chats),
+        }
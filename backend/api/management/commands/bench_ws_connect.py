@@ -0,0 +1,76 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from jwt import decode as jwt_decode
+from rest_framework_simplejwt.tokens import AccessToken, UntypedToken
+
+from backend.middleware import jwt_auth
+from backend.middleware.jwt_auth import JWTAuthMiddleware, user_cache
+
+
+class DoubleDecodedToken(UntypedToken):
+    # What the middleware did before: validate, then decode again with PyJWT
+    def __init__(self, token, *args, **kwargs):
+        super().__init__(token, *args, **kwargs)
+        jwt_decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+
+
+async def accept(scope, receive, send):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure WebSocket connects per second through JWTAuthMiddleware, "
+        "with the authenticated-user cache disabled and enabled, and with the "
+        "cache enabled but each token decoded twice as before."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connects', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--users', type=int, default=50,
+                            help="Distinct users reconnecting, as after a deploy")
+
+    def handle(self, *args, **options):
+        users = [
+            User.objects.get_or_create(username=f'bench_ws_{i}')[0]
+            for i in range(options['users'])
+        ]
+        tokens = [str(AccessToken.for_user(user)).encode() for user in users]
+
+        results = {}
+        for label, maxsize in (('uncached', 0), ('cached', user_cache.maxsize)):
+            user_cache.clear()
+            user_cache.maxsize = maxsize
+            results[label] = asyncio.run(self.run(tokens, options['connects'], options['concurrency']))
+        # The cache is warm here, so the token decodes are most of what is left
+        with mock.patch.object(jwt_auth, 'UntypedToken', DoubleDecodedToken):
+            results['cached_double_decode'] = asyncio.run(
+                self.run(tokens, options['connects'], options['concurrency'])
+            )
+        self.stdout.write(json.dumps(results))
+
+    async def run(self, tokens, connects, concurrency):
+        middleware = JWTAuthMiddleware(accept)
+        pending = iter(range(connects))
+
+        async def client():
+            for i in pending:
+                scope = {'type': 'websocket', 'query_string': b'token=' + tokens[i % len(tokens)]}
+                await middleware(scope, None, None)
+                assert scope['user'].is_authenticated
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        return {
+            'connects': connects,
+            'seconds': round(elapsed, 4),
+            'connects_per_second': round(connects / elapsed, 1),
+        }
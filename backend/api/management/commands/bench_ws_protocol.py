@@ -0,0 +1,62 @@
+import base64
+import json
+import os
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from api import protocol
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the JSON and binary chatroom protocols: bytes on the wire and "
+        "server CPU per message (decode the sender's frame, encode it for one recipient)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[64, 512, 4096],
+                            help="Ciphertext sizes in bytes")
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        results = []
+        for size in options['sizes']:
+            ct, iv = os.urandom(size), os.urandom(12)
+            event = {
+                'ct': ct,
+                'iv': iv,
+                'author': 'bench_author',
+                'author_id': 123456,
+                'message_id': 987654321,
+                'seq': 4321,
+            }
+            json_in = json.dumps({'ct': base64.b64encode(ct).decode(), 'iv': base64.b64encode(iv).decode()})
+            binary_in = protocol.HEADER.pack(protocol.MESSAGE, iv, 0, 1, 0) + ct
+
+            def json_round():
+                protocol.decode_json(json_in)
+                protocol.encode_json(event)
+
+            def binary_round():
+                protocol.decode_binary(binary_in)
+                protocol.encode_binary(event)
+
+            results.append({
+                'ciphertext_bytes': size,
+                'json': {
+                    'inbound_bytes': len(json_in.encode()),
+                    'outbound_bytes': len(protocol.encode_json(event).encode()),
+                    'us_per_message': self.time(json_round, options['iterations']),
+                },
+                'binary': {
+                    'inbound_bytes': len(binary_in),
+                    'outbound_bytes': len(protocol.encode_binary(event)),
+                    'us_per_message': self.time(binary_round, options['iterations']),
+                },
+            })
+        self.stdout.write(json.dumps(results))
+
+    def time(self, func, iterations):
+        best = min(timeit.repeat(func, number=iterations, repeat=3))
+        return round(best / iterations * 1e6, 3)
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.partitions import ensure_partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the missing monthly message partitions from this month to "
+        "MESSAGE_PARTITION_MONTHS_AHEAD months ahead. Safe to run at any time; "
+        "schedule it daily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=settings.MESSAGE_PARTITION_MONTHS_AHEAD)
+
+    def handle(self, *args, **options):
+        for name in ensure_partitions(options['months_ahead']):
+            self.stdout.write(f"Created {name}")
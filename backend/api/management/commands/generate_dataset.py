@@ -0,0 +1,204 @@
+import base64
+import bisect
+import itertools
+import json
+import os
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.models import Chat, ChatKey, ChatReadState, ChatSequence, GroupMessage, InboxEntry, InboxVersion, UserKey
+
+
+def quote(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def random_bytes_sql(size, seed):
+    # Random-looking bytes built server-side from md5 digests of `seed`
+    digests = ' || '.join(f"md5(({seed}) * {i + 1} || 'x')" for i in range(-(-size // 16)))
+    return f"substring(decode({digests}, 'hex') from 1 for {size})"
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def public_jwk():
+    # Shaped like the browser's RSA-OAEP-256 export: random odd 2048-bit modulus
+    modulus = bytearray(os.urandom(256))
+    modulus[0] |= 0x80
+    modulus[-1] |= 1
+    return {
+        'alg': 'RSA-OAEP-256', 'e': 'AQAB', 'ext': True,
+        'key_ops': ['encrypt'], 'kty': 'RSA', 'n': b64url(bytes(modulus)),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a large synthetic dataset: users with key pairs, chats with "
+        "both chat keys, and messages whose activity follows a power law "
+        "(a few users and chats carry most of the traffic). Messages are built "
+        "server-side with INSERT ... SELECT in large batches, numbered per chat, "
+        "and inbox rows, read marks and sequences are filled in to match."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--chats', type=int, default=100000)
+        parser.add_argument('--messages', type=int, default=10000000)
+        parser.add_argument('--prefix', default='load',
+                            help="Usernames are <prefix>_<n>; must not exist yet")
+        parser.add_argument('--user-skew', type=float, default=1.1,
+                            help="Zipf exponent of how many chats a user has")
+        parser.add_argument('--chat-skew', type=float, default=2.5,
+                            help="Messages concentrate on the first chats as random() ** skew")
+        parser.add_argument('--days', type=int, default=365,
+                            help="Messages are spread over this many days up to now")
+        parser.add_argument('--body-bytes', type=int, default=96, help="Average ciphertext size")
+        parser.add_argument('--batch-size', type=int, default=1000000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['chats'] > options['users'] * (options['users'] - 1) // 2:
+            raise CommandError("More chats than pairs of users")
+        if User.objects.filter(username__startswith=f"{options['prefix']}_").exists():
+            raise CommandError(f"Users named {options['prefix']}_* exist already; pick another --prefix")
+        random.seed(options['seed'])
+
+        timings = {}
+        for phase in ('users', 'chats', 'messages', 'inbox'):
+            start = time.perf_counter()
+            getattr(self, f'create_{phase}')(options)
+            timings[phase] = round(time.perf_counter() - start, 1)
+            self.stderr.write(f"{phase}: {timings[phase]}s")
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.stdout.write(json.dumps({
+            'users': options['users'],
+            'chats': options['chats'],
+            'messages': options['messages'],
+            'seconds': timings,
+        }))
+
+    def create_users(self, options):
+        # Unusable passwords: these accounts are for load, not for logging in
+        users = User.objects.bulk_create([
+            User(username=f"{options['prefix']}_{i}", password='!')
+            for i in range(options['users'])
+        ], batch_size=5000)
+        UserKey.objects.bulk_create([
+            UserKey(
+                user=user, public_key=public_jwk(),
+                # AES-GCM over the private JWK, as the client stores it
+                encrypted_private_key=os.urandom(1700), salt=os.urandom(16), iv=os.urandom(12),
+            )
+            for user in users
+        ], batch_size=5000)
+        # Rank 0 is the most active user
+        self.users = [user.id for user in users]
+
+    def create_chats(self, options):
+        # First participant by Zipf rank, second uniformly
+        weights = itertools.accumulate(1 / (rank + 1) ** options['user_skew'] for rank in range(len(self.users)))
+        weights = list(weights)
+        pairs = {}
+        while len(pairs) < options['chats']:
+            rank = bisect.bisect(weights, random.random() * weights[-1])
+            other = random.randrange(len(self.users))
+            if other == rank:
+                continue
+            pair = tuple(sorted((self.users[rank], self.users[other])))
+            pairs.setdefault(pair, rank)
+
+        # Chats of more active users come first and get more messages
+        ordered = sorted(pairs, key=lambda pair: (pairs[pair], random.random()))
+        Chat.objects.bulk_create([Chat(user1_id=a, user2_id=b) for a, b in ordered], batch_size=5000)
+
+        chat = quote(Chat)
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS dataset_chats")
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE dataset_chats AS "
+                f"SELECT (row_number() OVER (ORDER BY id) - 1)::int AS idx, id AS chat_id, "
+                f"user1_id, user2_id, 0::bigint AS last_seq "
+                f"FROM {chat} WHERE user1_id = ANY(%s)",
+                [self.users]
+            )
+            cursor.execute("ALTER TABLE dataset_chats ADD PRIMARY KEY (idx)")
+            cursor.execute("CREATE UNIQUE INDEX ON dataset_chats (chat_id)")
+            # Messages go back --days, and none may predate its chat
+            cursor.execute(
+                f"UPDATE {chat} SET created_at = now() - %s * interval '1 day' "
+                f"WHERE id IN (SELECT chat_id FROM dataset_chats)",
+                [options['days'] + 1]
+            )
+            cursor.execute(
+                f"INSERT INTO {quote(ChatKey)} (chat_id, user_id, encrypted_key, iv) "
+                f"SELECT c.chat_id, p.user_id, {random_bytes_sql(256, 'c.chat_id + p.user_id')}, "
+                f"{random_bytes_sql(12, 'c.chat_id - p.user_id')} "
+                f"FROM dataset_chats c CROSS JOIN LATERAL (VALUES (c.user1_id), (c.user2_id)) AS p (user_id)"
+            )
+
+    def create_messages(self, options):
+        total = options['messages']
+        # Lengths vary around the average like real ciphertexts do
+        body = random_bytes_sql(options['body_bytes'] * 2, 'n.g')
+        body = f"substring({body} from 1 for {options['body_bytes'] // 2} + (n.g %% {options['body_bytes'] + 1}))"
+        insert = (
+            f"WITH picked AS ("
+            f"  SELECT g, floor(%(chats)s * power(random(), %(skew)s))::int AS idx, random() < 0.5 AS first"
+            f"  FROM generate_series(%(low)s, %(high)s) AS g"
+            f"), numbered AS ("
+            f"  SELECT p.g, c.chat_id, c.last_seq + row_number() OVER (PARTITION BY c.chat_id ORDER BY p.g) AS seq,"
+            f"         CASE WHEN p.first THEN c.user1_id ELSE c.user2_id END AS author_id"
+            f"  FROM picked p JOIN dataset_chats c ON c.idx = p.idx"
+            f"), inserted AS ("
+            f"  INSERT INTO {quote(GroupMessage)} (group_id, author_id, body, iv, created, seq, is_read, is_edited)"
+            f"  SELECT n.chat_id, n.author_id, {body}, {random_bytes_sql(12, 'n.g + 1')},"
+            f"         now() - %(days)s * interval '1 day' * (1 - n.g::float / %(total)s), n.seq, false, false"
+            f"  FROM numbered n"
+            f") "
+            f"UPDATE dataset_chats c SET last_seq = t.last_seq "
+            f"FROM (SELECT chat_id, max(seq) AS last_seq FROM numbered GROUP BY chat_id) AS t "
+            f"WHERE c.chat_id = t.chat_id"
+        )
+        with connection.cursor() as cursor:
+            for low in range(1, total + 1, options['batch_size']):
+                high = min(low + options['batch_size'] - 1, total)
+                cursor.execute(insert, {
+                    'chats': options['chats'], 'skew': options['chat_skew'], 'low': low, 'high': high,
+                    'days': options['days'], 'total': total,
+                })
+                self.stderr.write(f"  messages {high}/{total}")
+
+    def create_inbox(self, options):
+        chats = 'dataset_chats'
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {quote(ChatSequence)} (chat_id, last_seq) "
+                f"SELECT chat_id, last_seq FROM {chats} WHERE last_seq > 0"
+            )
+            # Everyone has read up to the end of their chats
+            cursor.execute(
+                f"INSERT INTO {quote(ChatReadState)} (chat_id, user_id, read_seq) "
+                f"SELECT c.chat_id, p.user_id, c.last_seq FROM {chats} c "
+                f"CROSS JOIN LATERAL (VALUES (c.user1_id), (c.user2_id)) AS p (user_id) WHERE c.last_seq > 0"
+            )
+            cursor.execute(
+                f"INSERT INTO {quote(InboxVersion)} (user_id, version) SELECT unnest(%s::int[]), 1",
+                [self.users]
+            )
+            cursor.execute(
+                f"INSERT INTO {quote(InboxEntry)} "
+                f"(user_id, chat_id, last_message_id, last_activity, unread_count, version) "
+                f"SELECT p.user_id, c.chat_id, m.id, COALESCE(m.created, ch.created_at), 0, 1 "
+                f"FROM {chats} c JOIN {quote(Chat)} ch ON ch.id = c.chat_id "
+                f"CROSS JOIN LATERAL (VALUES (c.user1_id), (c.user2_id)) AS p (user_id) "
+                f"LEFT JOIN {quote(GroupMessage)} m ON m.group_id = c.chat_id AND m.seq = c.last_seq"
+            )
@@ -0,0 +1,66 @@
+import asyncio
+import base64
+import json
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Run one side of a cross-process delivery check: connect to a chatroom "
+        "through the full ASGI stack and either send or receive a burst of messages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('role', choices=['send', 'receive'])
+        parser.add_argument('--chat', type=int, required=True)
+        parser.add_argument('--token', required=True)
+        parser.add_argument('--count', type=int, default=1000)
+        parser.add_argument('--timeout', type=float, default=10)
+
+    def handle(self, *args, **options):
+        from backend.asgi import application
+
+        result = asyncio.run(self.run(application, **options))
+        # Last line of stdout is the machine-readable result
+        self.stdout.write(json.dumps(result))
+
+    async def run(self, application, role, chat, token, count, timeout, **options):
+        communicator = WebsocketCommunicator(application, f"/ws/chatroom/{chat}/?token={token}")
+        connected, _ = await communicator.connect()
+        if not connected:
+            return {'role': role, 'error': 'connection rejected'}
+
+        if role == 'receive':
+            self.stdout.write('ready')
+            self.stdout.flush()
+
+        # The receiver starts timing at the first message, not while the sender boots
+        start = time.perf_counter() if role == 'send' else None
+        if role == 'send':
+            iv = base64.b64encode(bytes(12)).decode()
+            for i in range(count):
+                ct = base64.b64encode(f'probe-{i}'.encode()).decode()
+                await communicator.send_json_to({'ct': ct, 'iv': iv})
+
+        # The sender drains its own echoes so the result covers the full broadcast
+        received = 0
+        try:
+            while received < count:
+                await communicator.receive_json_from(timeout=timeout)
+                if start is None:
+                    start = time.perf_counter()
+                received += 1
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - start if start is not None else 0
+        await communicator.disconnect()
+
+        return {
+            'role': role,
+            'received': received,
+            'seconds': round(elapsed, 4),
+            'messages_per_second': round(received / elapsed, 1) if elapsed else None,
+        }
@@ -0,0 +1,15 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from backend.cache import TTLCache
+from .models import Chat
+
+
+# Chat id -> (user1_id, user2_id). Participants of a chat never change, so an
+# entry only goes stale when its chat is deleted.
+chat_members = TTLCache(maxsize=10000, ttl=300)
+
+
+@receiver(post_delete, sender=Chat)
+def forget_deleted_chat(sender, instance, **kwargs):
+    chat_members.invalidate(instance.id)
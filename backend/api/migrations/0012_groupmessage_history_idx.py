@@ -0,0 +1,22 @@
+# Generated by Django 5.1.15 on 2026-10-18 20:03
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the index without blocking writes to a large message table
+    atomic = False
+
+    dependencies = [
+        ('api', '0011_groupmessage_iv_chatkey'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'created', 'id'], name='groupmessage_history_idx'),
+        ),
+    ]
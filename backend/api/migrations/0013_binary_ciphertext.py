@@ -0,0 +1,98 @@
+# Moves ciphertext, IV, salt and wrapped-key columns from base64 text to bytea.
+#
+# The migration is non-atomic so the table is never locked for the whole run:
+#   1. add nullable bytea columns next to the text ones (metadata-only),
+#   2. backfill them in committed id-range chunks, decoding base64 in SQL,
+#      then sweep up rows written by still-running old code,
+#   3. make them NOT NULL behind a validated CHECK constraint, so Postgres
+#      skips the full-table scan under an exclusive lock,
+#   4. drop the text columns and rename the bytea ones into place.
+
+from django.db import migrations, models
+
+
+BACKFILL_CHUNK = 10000
+
+# Strict base64; anything else (e.g. the '0' IV default of migration 0011) is
+# kept as its UTF-8 bytes instead of failing the migration.
+BASE64 = r'^([A-Za-z0-9+/]{4})*([A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?$'
+
+CONVERTED = {
+    'groupmessage': ('api_groupmessage', ['body', 'iv']),
+    'userkey': ('api_userkey', ['encrypted_private_key', 'salt', 'iv']),
+    'chatkey': ('api_chatkey', ['encrypted_key', 'iv']),
+}
+
+
+def raw(field):
+    return f'{field}_raw'
+
+
+def backfill(apps, schema_editor):
+    quote = schema_editor.quote_name
+    with schema_editor.connection.cursor() as cursor:
+        for table, fields in CONVERTED.values():
+            assignments = ', '.join(
+                f"{quote(raw(field))} = CASE WHEN {quote(field)} ~ %s "
+                f"THEN decode({quote(field)}, 'base64') "
+                f"ELSE convert_to({quote(field)}, 'UTF8') END"
+                for field in fields
+            )
+            update = (
+                f"UPDATE {quote(table)} SET {assignments} "
+                f"WHERE id >= %s AND id < %s AND {quote(raw(fields[0]))} IS NULL"
+            )
+            params = [BASE64] * len(fields)
+
+            cursor.execute(f"SELECT min(id), max(id) FROM {quote(table)}")
+            low, high = cursor.fetchone()
+            if low is not None:
+                # Each chunk commits on its own, holding row locks only briefly
+                for start in range(low, high + 1, BACKFILL_CHUNK):
+                    cursor.execute(update, params + [start, start + BACKFILL_CHUNK])
+
+            # Rows inserted by old code while the backfill ran
+            while True:
+                cursor.execute(
+                    f"SELECT min(id) FROM {quote(table)} WHERE {quote(raw(fields[0]))} IS NULL"
+                )
+                (start,) = cursor.fetchone()
+                if start is None:
+                    break
+                cursor.execute(update, params + [start, start + BACKFILL_CHUNK])
+
+
+def build_operations():
+    add, swap = [], []
+    for model_name, (table, fields) in CONVERTED.items():
+        for field in fields:
+            check = f'{table}_{field}_raw_not_null'
+            add.append(
+                migrations.AddField(model_name=model_name, name=raw(field), field=models.BinaryField(null=True))
+            )
+            swap += [
+                migrations.RunSQL(
+                    f'ALTER TABLE "{table}" ADD CONSTRAINT "{check}" CHECK ("{raw(field)}" IS NOT NULL) NOT VALID;'
+                    f'ALTER TABLE "{table}" VALIDATE CONSTRAINT "{check}";',
+                    reverse_sql=migrations.RunSQL.noop,
+                ),
+                migrations.AlterField(model_name=model_name, name=raw(field), field=models.BinaryField()),
+                migrations.RunSQL(
+                    f'ALTER TABLE "{table}" DROP CONSTRAINT "{check}";',
+                    reverse_sql=migrations.RunSQL.noop,
+                ),
+                migrations.RemoveField(model_name=model_name, name=field),
+                migrations.RenameField(model_name=model_name, old_name=raw(field), new_name=field),
+            ]
+    # Base64 cannot be restored from the dropped columns, so no reverse
+    return add + [migrations.RunPython(backfill)] + swap
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('api', '0012_groupmessage_history_idx'),
+    ]
+
+    operations = build_operations()
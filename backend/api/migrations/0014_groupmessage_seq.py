@@ -0,0 +1,98 @@
+# Numbers every chat's messages 1, 2, 3, ... in (created, id) order.
+#
+# Non-atomic like 0013: seq is added nullable, each chat is numbered in its own
+# short transaction (looping until rows written by old code are covered too),
+# NOT NULL goes on behind a validated CHECK, and the unique (group, seq) index
+# is built concurrently before being attached as a constraint.
+
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+
+
+RESERVE = (
+    'INSERT INTO "api_chatsequence" (chat_id, last_seq) VALUES (%s, %s) '
+    'ON CONFLICT (chat_id) DO UPDATE SET last_seq = "api_chatsequence".last_seq + EXCLUDED.last_seq '
+    'RETURNING last_seq'
+)
+
+NUMBER = (
+    'UPDATE "api_groupmessage" AS m SET seq = %s + n.rn FROM ('
+    '  SELECT id, row_number() OVER (ORDER BY created, id) AS rn'
+    '  FROM "api_groupmessage" WHERE group_id = %s AND seq IS NULL'
+    ') AS n WHERE m.id = n.id'
+)
+
+
+def backfill(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute('SELECT DISTINCT group_id FROM "api_groupmessage" WHERE seq IS NULL')
+            chats = [chat_id for (chat_id,) in cursor.fetchall()]
+            if not chats:
+                break
+            for chat_id in chats:
+                with transaction.atomic(using=connection.alias):
+                    # Locks the counter while this chat is numbered
+                    cursor.execute(RESERVE, [chat_id, 0])
+                    (last_seq,) = cursor.fetchone()
+                    cursor.execute(NUMBER, [last_seq, chat_id])
+                    cursor.execute(RESERVE, [chat_id, cursor.rowcount])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('api', '0013_binary_ciphertext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatSequence',
+            fields=[
+                ('chat', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sequence', serialize=False, to='api.chat')),
+                ('last_seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='seq',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        migrations.RunSQL(
+            'ALTER TABLE "api_groupmessage" ADD CONSTRAINT "api_groupmessage_seq_not_null" CHECK (seq IS NOT NULL) NOT VALID;'
+            'ALTER TABLE "api_groupmessage" VALIDATE CONSTRAINT "api_groupmessage_seq_not_null";',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='groupmessage',
+            name='seq',
+            field=models.BigIntegerField(),
+        ),
+        migrations.RunSQL(
+            'ALTER TABLE "api_groupmessage" DROP CONSTRAINT "api_groupmessage_seq_not_null";',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    'CREATE UNIQUE INDEX CONCURRENTLY "groupmessage_group_seq_uniq" '
+                    'ON "api_groupmessage" (group_id, seq);',
+                    reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS "groupmessage_group_seq_uniq";',
+                ),
+                migrations.RunSQL(
+                    'ALTER TABLE "api_groupmessage" ADD CONSTRAINT "groupmessage_group_seq_uniq" '
+                    'UNIQUE USING INDEX "groupmessage_group_seq_uniq";',
+                    reverse_sql='ALTER TABLE "api_groupmessage" DROP CONSTRAINT "groupmessage_group_seq_uniq";',
+                ),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='groupmessage',
+                    constraint=models.UniqueConstraint(fields=('group', 'seq'), name='groupmessage_group_seq_uniq'),
+                ),
+            ],
+        ),
+    ]
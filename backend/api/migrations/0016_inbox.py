@@ -0,0 +1,58 @@
+# Generated by Django 5.1.15 on 2026-10-18 20:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Inbox rows for existing chats, pointing at their latest message
+BACKFILL = '''
+INSERT INTO "api_inboxversion" (user_id, version)
+SELECT user1_id, 1 FROM "api_chat" UNION SELECT user2_id, 1 FROM "api_chat"
+ON CONFLICT (user_id) DO NOTHING;
+
+INSERT INTO "api_inboxentry" (user_id, chat_id, last_message_id, last_activity, unread_count, version)
+SELECT p.user_id, c.id, m.id, COALESCE(m.created, c.created_at),
+       CASE WHEN m.id IS NULL THEN 0 ELSE GREATEST(s.last_seq - COALESCE(r.read_seq, 0), 0) END, 1
+FROM "api_chat" c
+CROSS JOIN LATERAL (VALUES (c.user1_id), (c.user2_id)) AS p (user_id)
+LEFT JOIN "api_chatsequence" s ON s.chat_id = c.id
+LEFT JOIN "api_groupmessage" m ON m.group_id = c.id AND m.seq = s.last_seq
+LEFT JOIN "api_chatreadstate" r ON r.chat_id = c.id AND r.user_id = p.user_id;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_chatreadstate'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxVersion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='inbox_version', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity', models.DateTimeField()),
+                ('unread_count', models.IntegerField(default=0)),
+                ('version', models.BigIntegerField()),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='api.chat')),
+                ('last_message', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.groupmessage')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_activity'], name='inbox_activity_idx'), models.Index(fields=['user', 'version'], name='inbox_version_idx')],
+                'unique_together': {('user', 'chat')},
+            },
+        ),
+        migrations.RunSQL(BACKFILL, reverse_sql=migrations.RunSQL.noop),
+    ]
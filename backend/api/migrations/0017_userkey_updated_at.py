@@ -0,0 +1,20 @@
+# Generated by Django 5.1.15 on 2026-10-18 21:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userkey',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,143 @@
+# Turns api_groupmessage into a table partitioned by month of `created`.
+#
+# The existing table is not copied: it becomes the first partition,
+# api_groupmessage_legacy, holding everything before the start of next month,
+# and new monthly partitions follow it. The indexes the partitioned table needs
+# are built concurrently beforehand and a validated CHECK proves the partition
+# bound, so the swap itself takes one short exclusive lock and scans nothing.
+#
+# A partitioned table's unique constraints must contain `created`, so the
+# primary key becomes (id, created) and (group, seq) is indexed without being
+# unique; seq stays unique through ChatSequence (MessageSequenceTests checks it
+# under concurrent writers). Partitions ahead of time are created after every
+# migrate (see api/partitions.py) and by create_message_partitions.
+
+from datetime import datetime, timezone
+
+from django.db import migrations, models, transaction
+
+
+def next_month():
+    now = datetime.now(timezone.utc)
+    return datetime(now.year + now.month // 12, now.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def existing(constraints, columns, **flags):
+    # Name of the index or constraint on exactly `columns` with the given flags
+    for name, info in constraints.items():
+        if info['columns'] == columns and all(info[key] == value for key, value in flags.items()):
+            return name
+    raise LookupError(f'No {flags} on {columns}')
+
+
+def partition(apps, schema_editor):
+    cutoff = next_month()
+    after = datetime(cutoff.year + cutoff.month // 12, cutoff.month % 12 + 1, 1, tzinfo=timezone.utc)
+    connection = schema_editor.connection
+    quote = schema_editor.quote_name
+    GroupMessage = apps.get_model('api', 'GroupMessage')
+    author, group = GroupMessage._meta.get_field('author'), GroupMessage._meta.get_field('group')
+    with connection.cursor() as cursor:
+        # Names Django or Postgres gave the table's own index and constraints
+        # depend on how it was created, so they are looked up, not assumed
+        constraints = connection.introspection.get_constraints(cursor, 'api_groupmessage')
+        pkey = existing(constraints, ['id'], primary_key=True)
+        author_index = existing(constraints, ['author_id'], index=True, unique=False)
+        group_index = existing(constraints, ['group_id'], index=True, unique=False)
+
+        # Proves every row is before the cutoff, so ATTACH does not scan
+        cursor.execute(
+            'ALTER TABLE "api_groupmessage" ADD CONSTRAINT "api_groupmessage_legacy_bound" '
+            'CHECK (created < %s) NOT VALID', [cutoff]
+        )
+        cursor.execute('ALTER TABLE "api_groupmessage" VALIDATE CONSTRAINT "api_groupmessage_legacy_bound"')
+
+        with transaction.atomic(using=connection.alias):
+            cursor.execute('LOCK TABLE "api_groupmessage" IN ACCESS EXCLUSIVE MODE')
+            cursor.execute('SELECT COALESCE(max(id), 0) + 1 FROM "api_groupmessage"')
+            (next_id,) = cursor.fetchone()
+            for statement in (
+                'ALTER TABLE "api_groupmessage" RENAME TO "api_groupmessage_legacy"',
+                # Index names are per schema; the parent takes over the old ones
+                'ALTER INDEX "groupmessage_history_idx" RENAME TO "api_groupmessage_legacy_history"',
+                f'ALTER INDEX {quote(author_index)} RENAME TO "api_groupmessage_legacy_author"',
+                f'ALTER INDEX {quote(group_index)} RENAME TO "api_groupmessage_legacy_group"',
+                f'ALTER TABLE "api_groupmessage_legacy" DROP CONSTRAINT {quote(pkey)}',
+                'ALTER TABLE "api_groupmessage_legacy" ADD CONSTRAINT "api_groupmessage_legacy_pkey" '
+                'PRIMARY KEY USING INDEX "api_groupmessage_legacy_pkey"',
+                'ALTER TABLE "api_groupmessage_legacy" DROP CONSTRAINT "groupmessage_group_seq_uniq"',
+                'ALTER TABLE "api_groupmessage_legacy" ALTER COLUMN id DROP IDENTITY',
+
+                'CREATE TABLE "api_groupmessage" (LIKE "api_groupmessage_legacy" INCLUDING DEFAULTS) '
+                'PARTITION BY RANGE (created)',
+                'ALTER TABLE "api_groupmessage" ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY',
+                'ALTER TABLE "api_groupmessage" ADD PRIMARY KEY (id, created)',
+                # Named as Django names them, so later schema changes find them
+                *(
+                    f'ALTER TABLE "api_groupmessage" ADD CONSTRAINT '
+                    f'{schema_editor._fk_constraint_name(GroupMessage, field, "_fk_%(to_table)s_%(to_column)s")} '
+                    f'FOREIGN KEY ({quote(field.column)}) REFERENCES {quote(field.related_model._meta.db_table)} '
+                    f'({quote(field.target_field.column)}) '
+                    f'DEFERRABLE INITIALLY DEFERRED'
+                    for field in (author, group)
+                ),
+                *(
+                    f'CREATE INDEX {quote(schema_editor._create_index_name("api_groupmessage", [field.column]))} '
+                    f'ON "api_groupmessage" ({quote(field.column)})'
+                    for field in (author, group)
+                ),
+                'CREATE INDEX "groupmessage_history_idx" ON "api_groupmessage" (group_id, created, id)',
+                'CREATE INDEX "groupmessage_seq_idx" ON "api_groupmessage" (group_id, seq)',
+            ):
+                cursor.execute(statement)
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence('\"api_groupmessage\"', 'id'), %s, false)", [next_id]
+            )
+            # Existing indexes and foreign keys are matched, not rebuilt
+            cursor.execute(
+                'ALTER TABLE "api_groupmessage" ATTACH PARTITION "api_groupmessage_legacy" '
+                'FOR VALUES FROM (MINVALUE) TO (%s)', [cutoff]
+            )
+            cursor.execute('ALTER TABLE "api_groupmessage_legacy" DROP CONSTRAINT "api_groupmessage_legacy_bound"')
+            cursor.execute(
+                'CREATE TABLE "api_groupmessage_p{:%Y_%m}" PARTITION OF "api_groupmessage" '
+                'FOR VALUES FROM (%s) TO (%s)'.format(cutoff), [cutoff, after]
+            )
+            # Rows past the last partition land here rather than failing
+            cursor.execute('CREATE TABLE "api_groupmessage_default" PARTITION OF "api_groupmessage" DEFAULT')
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('api', '0017_userkey_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX CONCURRENTLY "api_groupmessage_legacy_pkey" '
+            'ON "api_groupmessage" (id, created);',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY "api_groupmessage_legacy_seq" '
+            'ON "api_groupmessage" (group_id, seq);',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(partition),
+            ],
+            state_operations=[
+                migrations.RemoveConstraint(
+                    model_name='groupmessage',
+                    name='groupmessage_group_seq_uniq',
+                ),
+                migrations.AddIndex(
+                    model_name='groupmessage',
+                    index=models.Index(fields=['group', 'seq'], name='groupmessage_seq_idx'),
+                ),
+            ],
+        ),
+    ]
@@ -1,4 +1,5 @@
-from django.db import models
+from collections import Counter
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 from rest_framework.exceptions import ValidationError
 from django.db.models import JSONField
@@ -32,6 +33,17 @@ from django.db.models import JSONField
 #         return reciever_profile
 
 
+class ChatQuerySet(models.QuerySet):
+    def for_user(self, user):
+        """
+        Chats the user takes part in, as a UNION ALL of two index lookups
+        (user1 and user2 sides are disjoint) instead of an OR over both columns.
+        Further filtering, select_related() and annotations must be applied
+        before calling this, since a combined query only allows ordering and slicing.
+        """
+        return self.filter(user1=user).union(self.filter(user2=user), all=True)
+
+
 class Chat(models.Model):
     """
     Represents a one-to-one conversation between two users.
@@ -40,6 +52,8 @@ class Chat(models.Model):
     user2 = models.ForeignKey(User, related_name='chats_as_user2', on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ChatQuerySet.as_manager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['user1', 'user2'], name = 'unique_pair')
@@ -64,39 +78,298 @@ class Chat(models.Model):
 
         if self.user1.id > self.user2.id:
             self.user1, self.user2 = self.user2, self.user1
-        super().save(*args, **kwargs)
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Both participants see the new chat in their inbox right away
+            if adding:
+                InboxEntry.objects.add_chat(self)
 
     def __str__(self):
         return f"Chat between {self.user1.username} and {self.user2.username}"
 
 
+class ChatSequence(models.Model):
+    """
+    Last sequence number handed out in a chat. Kept apart from Chat so that
+    bumping it never rewrites the chat row, and created on the first message.
+
+    Bumping the counter locks its row until the transaction commits, so
+    writers to one chat take turns. This is deliberate: seq must have no gaps
+    and follow commit order, or a client resuming after seq N could miss a
+    message N - 1 that committed later. Numbers reserved ahead of time or in
+    a separate transaction would lose both properties. The lock is kept
+    short instead. A single send is one autocommitted statement, and
+    write-behind takes the lock once per chat per batch rather than per
+    message. Chats only contend with themselves.
+    """
+    chat = models.OneToOneField(Chat, primary_key=True, related_name='sequence', on_delete=models.CASCADE)
+    last_seq = models.BigIntegerField(default=0)
+
+
+class ChatReadStateQuerySet(models.QuerySet):
+    def upsert_sql(self, rows):
+        """
+        Statement raising watermarks from `rows`, a SELECT or VALUES producing
+        (chat_id, user_id, read_seq). Watermarks never move backwards.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        return (
+            f"INSERT INTO {table} (chat_id, user_id, read_seq) {rows} "
+            f"ON CONFLICT (chat_id, user_id) DO UPDATE SET read_seq = EXCLUDED.read_seq "
+            f"WHERE {table}.read_seq < EXCLUDED.read_seq"
+        )
+
+    def advance(self, chat_id, user_id, seq):
+        """
+        Mark the chat read up to `seq`, capped at its last message. Returns the
+        new watermark, or None if it was already there.
+        """
+        quote = connection.ops.quote_name
+        sequences = quote(ChatSequence._meta.db_table)
+        inbox = quote(InboxEntry._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"WITH mark AS ("
+                + self.upsert_sql(f"SELECT chat_id, %s, LEAST(%s, last_seq) FROM {sequences} WHERE chat_id = %s")
+                + f" RETURNING chat_id, user_id, read_seq), "
+                f"versions AS ({InboxEntry.objects.bump_sql('mark')}) "
+                f"UPDATE {inbox} SET unread_count = GREATEST(s.last_seq - mark.read_seq, 0), version = v.version "
+                f"FROM mark JOIN versions v USING (user_id) JOIN {sequences} s USING (chat_id) "
+                f"WHERE {inbox}.user_id = mark.user_id AND {inbox}.chat_id = mark.chat_id "
+                f"RETURNING mark.read_seq",
+                [user_id, seq, chat_id]
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+
+class ChatReadState(models.Model):
+    """
+    Read receipt of one user in one chat: every message with seq <= read_seq
+    has been read. A single row per user and chat replaces per-message flags.
+    """
+    chat = models.ForeignKey(Chat, related_name='read_states', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    read_seq = models.BigIntegerField(default=0)
+
+    objects = ChatReadStateQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('chat', 'user')
+
+
+class GroupMessageQuerySet(models.QuerySet):
+    def in_chat(self, chat):
+        # Nothing predates the chat, and saying so lets Postgres skip the
+        # monthly partitions from before it was created
+        return self.filter(group=chat, created__gte=chat.created_at)
+
+    def _reserve_sql(self):
+        # Upsert that bumps a chat's counter by n and returns the new last_seq
+        table = connection.ops.quote_name(ChatSequence._meta.db_table)
+        return (
+            f"INSERT INTO {table} (chat_id, last_seq) VALUES (%s, %s) "
+            f"ON CONFLICT (chat_id) DO UPDATE SET last_seq = {table}.last_seq + EXCLUDED.last_seq "
+            f"RETURNING last_seq"
+        )
+
+    def create_in_sequence(self, **kwargs):
+        """
+        Save a message with the next sequence number of its chat. Reserving the
+        number and inserting the row is a single statement, so outside an
+        atomic block the counter row is locked only for that statement (see
+        ChatSequence for why it is locked at all) and numbers commit in order.
+        The same statement moves the author's read watermark to the message
+        and updates both participants' inbox rows.
+        """
+        message = self.model(**kwargs)
+        quote = connection.ops.quote_name
+        fields = [f for f in self.model._meta.concrete_fields if not f.primary_key and f.attname != 'seq']
+        values = [f.get_db_prep_save(f.pre_save(message, True), connection) for f in fields]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"WITH reserved AS ({self._reserve_sql()}), "
+                f"message AS ("
+                f"INSERT INTO {quote(self.model._meta.db_table)} "
+                f"({', '.join(quote(f.column) for f in fields)}, seq) "
+                f"SELECT {', '.join(['%s'] * len(fields))}, last_seq FROM reserved "
+                f"RETURNING id, group_id, author_id, created, seq), "
+                f"watermark AS ({ChatReadState.objects.upsert_sql('SELECT %s, %s, seq FROM message')}), "
+                f"{InboxEntry.objects.record_sql('message')} "
+                f"SELECT id, seq FROM message",
+                [message.group_id, 1] + values + [message.group_id, message.author_id]
+            )
+            message.id, message.seq = cursor.fetchone()
+        message._state.adding = False
+        return message
+
+    def bulk_create_in_sequence(self, messages):
+        """
+        bulk_create() that numbers the messages in list order, reserving one
+        block of sequence numbers per chat in the batch. Each chat's counter
+        stays locked until the batch commits, one lock per chat and batch
+        rather than per message; see ChatSequence.
+        """
+        if not messages:
+            return []
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Fixed lock order, so concurrent batches cannot deadlock
+            for chat_id, count in sorted(Counter(m.group_id for m in messages).items()):
+                cursor.execute(self._reserve_sql(), [chat_id, count])
+                (seq,) = cursor.fetchone()
+                seq -= count
+                for message in messages:
+                    if message.group_id == chat_id:
+                        seq += 1
+                        message.seq = seq
+            created = self.bulk_create(messages)
+            # Authors have read their chats up to their last message
+            watermarks = {}
+            for message in messages:
+                watermarks[message.group_id, message.author_id] = message.seq
+            cursor.executemany(
+                ChatReadState.objects.upsert_sql('VALUES (%s, %s, %s)'),
+                [(chat_id, user_id, seq) for (chat_id, user_id), seq in sorted(watermarks.items())]
+            )
+            # Inbox rows point at the last message of each chat in the batch
+            latest = {message.group_id: message for message in messages}
+            rows = ', '.join(['(%s, %s, %s, %s::timestamptz, %s)'] * len(latest))
+            cursor.execute(
+                f"WITH message (id, group_id, author_id, created, seq) AS (VALUES {rows}), "
+                f"{InboxEntry.objects.record_sql('message')} "
+                f"SELECT 1",
+                [value for chat_id in sorted(latest) for value in (
+                    latest[chat_id].id, chat_id, latest[chat_id].author_id, latest[chat_id].created, latest[chat_id].seq
+                )]
+            )
+            return created
+
+
 class GroupMessage(models.Model):
     group = models.ForeignKey(Chat, related_name='chat_messages', on_delete=models.CASCADE)
     author = models.ForeignKey(User, on_delete=models.CASCADE)
-    body = models.TextField()  # base64 ciphertext of message
-    iv = models.CharField(max_length=24)  # base64-encoded AES-GCM nonce
+    body = models.BinaryField()  # AES-GCM ciphertext of message
+    iv = models.BinaryField()  # AES-GCM nonce
     created = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
     is_edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
+    # Position in the chat, gap-free and in commit order; see create_in_sequence()
+    seq = models.BigIntegerField()
+
+    objects = GroupMessageQuerySet.as_manager()
 
     def __str__(self):
-        return f'{self.author.username} : {self.body}, {self.group}'
+        return f'{self.author.username} : {len(self.body)} bytes, {self.group}'
 
     class Meta:
         ordering = ['-created']
-        # indexes = [
-        #     models.Index(fields=['chat', 'created_at']),
-        #     models.Index(fields=['sender']),
-        # ]
+        # The table is partitioned by month of `created` (see api/partitions.py),
+        # so its primary key is really (id, created), and (group, seq) cannot be
+        # unique across partitions; ChatSequence alone keeps seq unique
+        indexes = [
+            # Keyset pagination of chat history over (created, id)
+            models.Index(fields=['group', 'created', 'id'], name='groupmessage_history_idx'),
+            # Resuming a chat from a sequence number
+            models.Index(fields=['group', 'seq'], name='groupmessage_seq_idx'),
+        ]
+
+
+class InboxVersion(models.Model):
+    """
+    Per-user counter stamped on inbox rows as they change. Taking it locks
+    the user's row, so versions are committed in order and a client syncing
+    from its last version cannot skip a change.
+    """
+    user = models.OneToOneField(User, primary_key=True, related_name='inbox_version', on_delete=models.CASCADE)
+    version = models.BigIntegerField(default=0)
+
+
+class InboxEntryQuerySet(models.QuerySet):
+    def bump_sql(self, source):
+        # Upsert taking the next version of every user_id in `source`
+        table = connection.ops.quote_name(InboxVersion._meta.db_table)
+        return (
+            f"INSERT INTO {table} (user_id, version) "
+            f"SELECT DISTINCT user_id, 1 FROM {source} ORDER BY user_id "
+            f"ON CONFLICT (user_id) DO UPDATE SET version = {table}.version + 1 "
+            f"RETURNING user_id, version"
+        )
+
+    def record_sql(self, source):
+        """
+        CTEs pointing both participants' inbox rows at the messages in
+        `source` (id, group_id, author_id, created, seq; one per chat).
+        Unread counts follow the read watermarks; authors have read their own.
+        """
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        return (
+            f"inbox_users AS ("
+            f"SELECT m.*, p.user_id FROM {source} m "
+            f"JOIN {quote(Chat._meta.db_table)} c ON c.id = m.group_id "
+            f"CROSS JOIN LATERAL (VALUES (c.user1_id), (c.user2_id)) AS p (user_id)), "
+            f"inbox_versions AS ({self.bump_sql('inbox_users')}), "
+            f"inbox AS ("
+            f"INSERT INTO {table} (user_id, chat_id, last_message_id, last_activity, unread_count, version) "
+            f"SELECT u.user_id, u.group_id, u.id, u.created, "
+            f"CASE WHEN u.user_id = u.author_id THEN 0 ELSE u.seq - COALESCE(("
+            f"SELECT read_seq FROM {quote(ChatReadState._meta.db_table)} r "
+            f"WHERE r.chat_id = u.group_id AND r.user_id = u.user_id), 0) END, v.version "
+            f"FROM inbox_users u JOIN inbox_versions v USING (user_id) "
+            f"ON CONFLICT (user_id, chat_id) DO UPDATE SET "
+            f"last_message_id = EXCLUDED.last_message_id, last_activity = EXCLUDED.last_activity, "
+            f"unread_count = EXCLUDED.unread_count, version = EXCLUDED.version)"
+        )
+
+    def add_chat(self, chat):
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"WITH members (user_id) AS (VALUES (%s), (%s)), "
+                f"versions AS ({self.bump_sql('members')}) "
+                f"INSERT INTO {table} (user_id, chat_id, last_activity, unread_count, version) "
+                f"SELECT user_id, %s, %s, 0, version FROM versions "
+                f"ON CONFLICT (user_id, chat_id) DO NOTHING",
+                [chat.user1_id, chat.user2_id, chat.id, chat.created_at]
+            )
+
+
+class InboxEntry(models.Model):
+    """
+    A user's view of one chat, kept up to date as messages are saved and read,
+    so the chat list is read from here instead of being rebuilt per request.
+    """
+    user = models.ForeignKey(User, related_name='inbox', on_delete=models.CASCADE)
+    chat = models.ForeignKey(Chat, related_name='inbox_entries', on_delete=models.CASCADE)
+    # Plain column in the database, so writing it adds no lookup of the message
+    last_message = models.ForeignKey(
+        GroupMessage, null=True, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False
+    )
+    last_activity = models.DateTimeField()
+    unread_count = models.IntegerField(default=0)
+    version = models.BigIntegerField()
+
+    objects = InboxEntryQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('user', 'chat')
+        indexes = [
+            # Chat list ordered by activity, and delta sync since a version
+            models.Index(fields=['user', '-last_activity'], name='inbox_activity_idx'),
+            models.Index(fields=['user', 'version'], name='inbox_version_idx'),
+        ]
 
 
 class UserKey(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='user_key')
     public_key = JSONField()
-    encrypted_private_key = models.TextField()
-    salt = models.CharField(max_length=64)  # наприклад, base64-строка
-    iv = models.CharField(max_length=24)    # base64-ініціалізаційний вектор для AES-GCM
+    encrypted_private_key = models.BinaryField()
+    salt = models.BinaryField()  # PBKDF2 salt
+    iv = models.BinaryField()    # ініціалізаційний вектор для AES-GCM
+    # Lets sync clients pick up rotated public keys of their peers
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return f"Key pair for {self.user.username}"
@@ -105,8 +378,8 @@ class UserKey(models.Model):
 class ChatKey(models.Model):
     chat = models.ForeignKey(Chat, related_name='keys', on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    encrypted_key = models.TextField()
-    iv = models.CharField(max_length=24)
+    encrypted_key = models.BinaryField()
+    iv = models.BinaryField()
 
     class Meta:
         unique_together = ('chat', 'user')
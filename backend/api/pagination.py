@@ -0,0 +1,101 @@
+import base64
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(row):
+    """
+    Opaque cursor for a message's position in its chat: (created, id) of its
+    values() row.
+    """
+    raw = f"{row['created'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created, pk = raw.rsplit('|', 1)
+        created = parse_datetime(created)
+        pk = int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+    if created is None:
+        raise InvalidCursor(cursor)
+    return created, pk
+
+
+def parse_page_size(value):
+    if value is None:
+        return HISTORY_PAGE_SIZE
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        raise InvalidCursor(value)
+    return max(1, min(size, HISTORY_MAX_PAGE_SIZE))
+
+
+def paginate_messages(queryset, before=None, after=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Keyset pagination over (created, id), served by the (group, created, id) index.
+
+    The redundant `created__lte` / `created__gte` bound lets the planner start
+    the index range scan at the cursor instead of filtering from the chat's end,
+    so every page costs the same regardless of chat length.
+
+    `queryset` yields values() rows with at least `created` and `id`.
+    Returns (rows in ascending order, prev_cursor, next_cursor); prev points
+    at older messages, next at newer ones, and either is None when exhausted.
+    """
+    queryset = _page_queryset(queryset, before, after, limit)
+    return _page(list(queryset), before, after, limit)
+
+
+async def apaginate_messages(queryset, before=None, after=None, limit=HISTORY_PAGE_SIZE):
+    """
+    paginate_messages() for async views.
+    """
+    queryset = _page_queryset(queryset, before, after, limit)
+    return _page([message async for message in queryset], before, after, limit)
+
+
+def _page_queryset(queryset, before, after, limit):
+    if after is not None:
+        created, pk = decode_cursor(after)
+        return (
+            queryset.filter(created__gte=created)
+            .filter(Q(created__gt=created) | Q(id__gt=pk))
+            .order_by('created', 'id')[:limit + 1]
+        )
+    if before is not None:
+        created, pk = decode_cursor(before)
+        queryset = (
+            queryset.filter(created__lte=created)
+            .filter(Q(created__lt=created) | Q(id__lt=pk))
+        )
+    return queryset.order_by('-created', '-id')[:limit + 1]
+
+
+def _page(rows, before, after, limit):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after is not None:
+        prev_cursor = encode_cursor(rows[0]) if rows else after
+        next_cursor = encode_cursor(rows[-1]) if has_more else None
+        return rows, prev_cursor, next_cursor
+
+    rows.reverse()
+    prev_cursor = encode_cursor(rows[0]) if has_more else None
+    if before is None:
+        next_cursor = None
+    else:
+        next_cursor = encode_cursor(rows[-1]) if rows else before
+    return rows, prev_cursor, next_cursor
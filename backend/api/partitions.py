@@ -0,0 +1,153 @@
+"""
+Monthly range partitions of the message table by `created` (migration 0018).
+
+Partitions are named <table>_pYYYY_MM and cover one calendar month in UTC.
+They are created MESSAGE_PARTITION_MONTHS_AHEAD months ahead after every
+migrate and by create_message_partitions, which is meant to run daily. Rows
+past the last partition go to <table>_default; creating their month later
+moves them into it.
+
+archive_partitions() detaches partitions that ended before a cutoff and moves
+them to the MESSAGE_ARCHIVE_SCHEMA schema, out of the planner's and
+autovacuum's way. Archived messages no longer appear in history, export or
+sync; chat sequences continue after them.
+"""
+import re
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .models import GroupMessage
+
+
+BOUND = re.compile(r"FROM \((MINVALUE|'[^']+')\) TO \((MAXVALUE|'[^']+')\)")
+
+
+def table():
+    return GroupMessage._meta.db_table
+
+
+def month_start(value, months=0):
+    """
+    First instant of the month `months` after the one containing `value`, in UTC.
+    """
+    value = value.astimezone(timezone.utc)
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _bound(text):
+    if text in ('MINVALUE', 'MAXVALUE'):
+        return None
+    # e.g. '2026-11-01 00:00:00+00'; Django keeps the session in UTC
+    return datetime.fromisoformat(text.strip("'"))
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", [table()])
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def partitions(cursor):
+    """
+    (name, lower, upper) of each range partition, oldest first; None is unbounded.
+    """
+    cursor.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+        [table()]
+    )
+    result = []
+    for name, bound in cursor.fetchall():
+        match = BOUND.search(bound)
+        if match:
+            result.append((name, _bound(match.group(1)), _bound(match.group(2))))
+    return sorted(result, key=lambda p: p[1] or datetime.min.replace(tzinfo=timezone.utc))
+
+
+def ensure_partitions(months_ahead=None, now=None, using=DEFAULT_DB_ALIAS):
+    """
+    Create the monthly partitions from the current month to `months_ahead`
+    months later that are missing. Returns the names created.
+    """
+    if months_ahead is None:
+        months_ahead = settings.MESSAGE_PARTITION_MONTHS_AHEAD
+    now = now or datetime.now(timezone.utc)
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    parent, default = table(), f'{table()}_default'
+    created = []
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor):
+            return created
+        for months in range(months_ahead + 1):
+            lower, upper = month_start(now, months), month_start(now, months + 1)
+            covered = any(
+                (low is None or low < upper) and (high is None or high > lower)
+                for _, low, high in partitions(cursor)
+            )
+            if covered:
+                continue
+            name = f'{parent}_p{lower:%Y_%m}'
+            with transaction.atomic(using=using):
+                cursor.execute(
+                    f"SELECT EXISTS (SELECT 1 FROM {quote(default)} WHERE created >= %s AND created < %s)",
+                    [lower, upper]
+                )
+                if cursor.fetchone()[0]:
+                    # Rows of this month went to the default partition; move them first
+                    cursor.execute(f"CREATE TABLE {quote(name)} (LIKE {quote(parent)} INCLUDING DEFAULTS)")
+                    cursor.execute(
+                        f"WITH moved AS (DELETE FROM {quote(default)} WHERE created >= %s AND created < %s "
+                        f"RETURNING *) INSERT INTO {quote(name)} SELECT * FROM moved",
+                        [lower, upper]
+                    )
+                    cursor.execute(
+                        f"ALTER TABLE {quote(parent)} ATTACH PARTITION {quote(name)} FOR VALUES FROM (%s) TO (%s)",
+                        [lower, upper]
+                    )
+                else:
+                    cursor.execute(
+                        f"CREATE TABLE {quote(name)} PARTITION OF {quote(parent)} FOR VALUES FROM (%s) TO (%s)",
+                        [lower, upper]
+                    )
+            created.append(name)
+    return created
+
+
+def archive_partitions(before, schema=None, tablespace=None, using=DEFAULT_DB_ALIAS):
+    """
+    Detach every partition whose range ends on or before `before` and move it
+    to `schema` (and `tablespace`, if given). Returns the names archived.
+    """
+    schema = schema or settings.MESSAGE_ARCHIVE_SCHEMA
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    archived = []
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor):
+            return archived
+        for name, _, upper in partitions(cursor):
+            if upper is None or upper > before:
+                continue
+            with transaction.atomic(using=using):
+                # DETACH locks the parent exclusively; give up rather than queue behind long reads
+                cursor.execute("SET LOCAL lock_timeout = '5s'")
+                # ALTER TABLE refuses tables with deferred FK checks still pending in the transaction
+                cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+                cursor.execute(f"ALTER TABLE {quote(table())} DETACH PARTITION {quote(name)}")
+                # Archived rows must not block deleting their chats and users
+                cursor.execute(
+                    "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'f'", [name]
+                )
+                for (constraint,) in cursor.fetchall():
+                    cursor.execute(f"ALTER TABLE {quote(name)} DROP CONSTRAINT {quote(constraint)}")
+                cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {quote(schema)}")
+                cursor.execute(f"ALTER TABLE {quote(name)} SET SCHEMA {quote(schema)}")
+            if tablespace:
+                # Rewrites the table, but nothing reads it any more
+                cursor.execute(f"ALTER TABLE {quote(schema)}.{quote(name)} SET TABLESPACE {quote(tablespace)}")
+            archived.append(name)
+    return archived
@@ -0,0 +1,180 @@
+"""
+Wire formats of the chatroom WebSocket.
+
+Messages are handled as raw ciphertext and IV bytes, the form they are stored
+in; only the JSON protocol converts to and from base64.
+
+JSON text frames are the default: clients send {"ct", "iv"} with base64 values
+and receive {"ct", "iv", "author", "seq"}; the iv is always IV_SIZE (12) bytes.
+Clients that offer the BINARY_SUBPROTOCOL in Sec-WebSocket-Protocol exchange
+binary frames instead: a fixed HEADER followed by the raw ciphertext, with no
+base64 and no JSON on either side.
+
+"seq" numbers the messages of a chat; a client reconnecting with
+?last_seq=<highest seen> first receives the messages it missed. It is null
+for messages broadcast before they were saved (write-behind mode); once such
+a message is committed every participant receives {"stored": <message id>,
+"seq": <seq>} (binary: a STORED frame), and its sender an ack with the seq.
+
+Read receipts: clients send {"read": <seq>} (binary: a READ frame with the seq
+in the header) to mark the chat read up to that message, and receive
+{"read": <seq>, "user": <username>} when a participant's watermark moves.
+
+The per-user stream socket speaks JSON only, with a "chat_id" on every frame.
+
+A message is encoded to JSON once, by the sender's consumer, and the text
+travels in the channel layer event as "json"; recipients send it as is, or
+with the chat id spliced in front on the stream socket.
+"""
+import base64
+import binascii
+import json
+import struct
+from collections import namedtuple
+
+
+BINARY_SUBPROTOCOL = 'messenger.bin.v1'
+
+# AES-GCM IVs are 96 bits; the header has room for exactly that, and the JSON
+# protocol and the REST serializers accept no other length
+IV_SIZE = 12
+
+# kind, AES-GCM IV, author id, message id, seq
+HEADER = struct.Struct(f'!B{IV_SIZE}sQQQ')
+
+# Frame kinds. Clients send MESSAGE frames with author id 0 and may put a
+# correlation id in the message id; a seq of 0 means not yet known. ACK frames carry the stored message id
+# and seq, and the client's correlation id as an 8-byte payload; ERROR frames carry
+# UTF-8 text; READ frames carry the reader's user id (0 from clients) and seq;
+# STORED frames carry the author id, message id and seq of a write-behind message.
+MESSAGE = 1
+ACK = 2
+ERROR = 3
+READ = 4
+STORED = 5
+
+# Decoded client frames; chat_id is None on the per-chat socket
+Message = namedtuple('Message', 'chat_id ct iv client_id')
+ReadMark = namedtuple('ReadMark', 'chat_id seq')
+
+
+def _load_json(text_data):
+    if not text_data.strip():
+        raise ValueError("Empty message received")
+    return json.loads(text_data)
+
+
+def _decode_ciphertext(data):
+    # Expect AES-GCM ciphertext and iv
+    ct = data.get('ct')
+    iv = data.get('iv')
+    if not ct or not iv:
+        raise ValueError("Invalid message format: missing ct or iv")
+    try:
+        ct, iv = base64.b64decode(ct, validate=True), base64.b64decode(iv, validate=True)
+    except (binascii.Error, TypeError):
+        raise ValueError("Invalid message format: ct and iv must be base64")
+    if len(iv) != IV_SIZE:
+        raise ValueError(f"Invalid message format: iv must be {IV_SIZE} bytes")
+    return ct, iv
+
+
+def _decode_frame(data, chat_id=None):
+    if 'read' in data:
+        seq = data['read']
+        if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+            raise ValueError("Invalid read mark: read must be a message seq")
+        return ReadMark(chat_id, seq)
+    ct, iv = _decode_ciphertext(data)
+    return Message(chat_id, ct, iv, data.get('client_id'))
+
+
+def decode_json(text_data):
+    return _decode_frame(_load_json(text_data))
+
+
+def encode_json(event):
+    # Pre-encoded by the sender for live messages; replayed ones are encoded here
+    frame = event.get('json')
+    if frame is None:
+        frame = json.dumps({
+            'ct': base64.b64encode(event['ct']).decode(),
+            'iv': base64.b64encode(event['iv']).decode(),
+            'author': event['author'],
+            'seq': event.get('seq'),
+        })
+    return frame
+
+
+def decode_stream_json(text_data):
+    """
+    Frames of the per-user stream socket are tagged with the chat they belong to.
+    """
+    data = _load_json(text_data)
+    chat_id = data.get('chat_id')
+    if not isinstance(chat_id, int):
+        raise ValueError("Invalid message format: missing chat_id")
+    return _decode_frame(data, chat_id)
+
+
+def encode_stream_json(event):
+    # The per-chat frame with the chat id as its first key
+    return f'{{"chat_id": {int(event["chat_id"])}, {encode_json(event)[1:]}'
+
+
+def encode_read_json(event):
+    return json.dumps({'read': event['read_seq'], 'user': event['user']})
+
+
+def encode_stream_read_json(event):
+    return json.dumps({'chat_id': event['chat_id'], 'read': event['read_seq'], 'user': event['user']})
+
+
+def encode_stored_json(event):
+    return json.dumps({'stored': event['message_id'], 'seq': event['seq']})
+
+
+def encode_stream_stored_json(event):
+    return json.dumps({'chat_id': event['chat_id'], 'stored': event['message_id'], 'seq': event['seq']})
+
+
+def decode_binary(bytes_data):
+    if len(bytes_data) < HEADER.size:
+        raise ValueError("Invalid message format: frame too short")
+    kind, iv, _, client_id, seq = HEADER.unpack_from(bytes_data)
+    if kind == READ:
+        return ReadMark(None, seq)
+    if kind != MESSAGE:
+        raise ValueError(f"Unexpected frame kind {kind}")
+    if len(bytes_data) == HEADER.size:
+        raise ValueError("Invalid message format: frame too short")
+    return Message(None, bytes_data[HEADER.size:], iv, client_id)
+
+
+def encode_binary(event):
+    # struct would pad or cut any other length, and the peer could not decrypt
+    if len(event['iv']) != IV_SIZE:
+        raise ValueError(f"Invalid message: iv must be {IV_SIZE} bytes")
+    return HEADER.pack(
+        MESSAGE,
+        event['iv'],
+        event['author_id'],
+        event.get('message_id') or 0,
+        event.get('seq') or 0,
+    ) + event['ct']
+
+
+def encode_binary_ack(message_id, client_id, seq=0):
+    return HEADER.pack(ACK, b'', 0, message_id, seq or 0) + struct.pack('!Q', client_id or 0)
+
+
+def encode_binary_read(event):
+    return HEADER.pack(READ, b'', event['user_id'], 0, event['read_seq'])
+
+
+def encode_binary_stored(event):
+    return HEADER.pack(STORED, b'', event['author_id'], event['message_id'], event['seq'])
+
+
+def encode_binary_error(text):
+    return HEADER.pack(ERROR, b'', 0, 0, 0) + text.encode()
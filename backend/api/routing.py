@@ -1,6 +1,7 @@
 from django.urls import path
-from .consumers import ChatroomConsumer
+from .consumers import ChatroomConsumer, StreamConsumer
 
 websocket_urlpatterns = [
     path("ws/chatroom/<int:chat_id>/", ChatroomConsumer.as_asgi()),
+    path("ws/stream/", StreamConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -1,34 +1,116 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import GroupMessage, Chat, UserKey, ChatKey
+from .protocol import IV_SIZE
 from django.db import models
+import base64
+import binascii
+
+
+class Base64BinaryField(serializers.Field):
+    """
+    Binary model field exposed to JSON clients as standard base64.
+    """
+    default_error_messages = {
+        'invalid': 'Enter valid base64 data.',
+        'max_length': 'Ensure this field has no more than {max_length} bytes.',
+        'min_length': 'Ensure this field has at least {min_length} bytes.',
+    }
+
+    def __init__(self, max_length=None, min_length=None, **kwargs):
+        self.max_length = max_length
+        self.min_length = min_length
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return base64.b64encode(value).decode()
+
+    def to_internal_value(self, data):
+        if not isinstance(data, str):
+            self.fail('invalid')
+        try:
+            value = base64.b64decode(data, validate=True)
+        except binascii.Error:
+            self.fail('invalid')
+        if self.max_length is not None and len(value) > self.max_length:
+            self.fail('max_length', max_length=self.max_length)
+        if self.min_length is not None and len(value) < self.min_length:
+            self.fail('min_length', min_length=self.min_length)
+        return value
 
 
 class ChatMessageSerializer(serializers.ModelSerializer):
     author = serializers.ReadOnlyField(source='author.username')
     timestamp = serializers.DateTimeField(source='created', read_only=True)
+    body = Base64BinaryField()
+    iv = Base64BinaryField(min_length=IV_SIZE, max_length=IV_SIZE)
 
     class Meta:
         model = GroupMessage
-        fields = ['id', 'body', 'iv', 'author', 'timestamp', 'group']
-        read_only_fields = ['id', 'author', 'timestamp']
+        fields = ['id', 'seq', 'body', 'iv', 'author', 'timestamp', 'group']
+        read_only_fields = ['id', 'seq', 'author', 'timestamp']
         extra_kwargs = {
             'group': {'write_only': True},
-            'body': {
-                'max_length': 300,
-                'style': {
-                    'input_type': 'text',
-                    'placeholder': 'Add message',
-                    'class': 'p-4 text-black',
-                    'autofocus': True
-                }
-            }
         }
 
     def create(self, validated_data):
         # Add author from request.user
         validated_data['author'] = self.context['request'].user
-        return super().create(validated_data)
+        return GroupMessage.objects.create_in_sequence(**validated_data)
+
+
+# Columns message_data() reads, for QuerySet.values()
+MESSAGE_VALUES = ('id', 'seq', 'body', 'iv', 'author__username', 'created')
+
+_timestamp = serializers.DateTimeField()
+
+
+def message_data(row):
+    """
+    What ChatMessageSerializer renders, from a values(*MESSAGE_VALUES) row:
+    history pages and inbox items skip building a serializer per message.
+    """
+    return {
+        'id': row['id'],
+        'seq': row['seq'],
+        'body': base64.b64encode(row['body']).decode(),
+        'iv': base64.b64encode(row['iv']).decode(),
+        'author': row['author__username'],
+        'timestamp': _timestamp.to_representation(row['created']),
+    }
+
+
+def message_values(message):
+    # The values(*MESSAGE_VALUES) row of a message loaded with its author
+    return {
+        'id': message.id, 'seq': message.seq, 'body': message.body, 'iv': message.iv,
+        'author__username': message.author.username, 'created': message.created,
+    }
+
+
+def inbox_entry_data(entry, user):
+    """
+    Chat list item for `user` from an InboxEntry loaded with its chat, both
+    participants' keys and the last message's author.
+    """
+    chat = entry.chat
+    other_user = chat.user2 if chat.user1_id == user.id else chat.user1
+
+    # Get public key (JSONField yields dict) or None
+    try:
+        public_key = other_user.user_key.public_key
+    except UserKey.DoesNotExist:
+        public_key = None
+
+    latest = [message_data(message_values(entry.last_message))] if entry.last_message_id else []
+    return {
+        'id': chat.id,
+        'other_user': other_user.username,
+        'public_key': public_key,
+        'latest_message': latest,
+        'unread_count': entry.unread_count,
+        'last_activity': entry.last_activity,
+    }
 
 
 class ChatSerializer(serializers.ModelSerializer):
@@ -40,16 +122,15 @@ class ChatSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'user1', 'user2', 'created_at']
 
     def validate_user2_username(self, value):
+        # The user found here is what create() gets, so it is looked up once
         try:
-            User.objects.get(username=value)
+            return User.objects.get(username=value)
         except User.DoesNotExist:
             raise serializers.ValidationError("User with this username does not exist.")
-        return value
 
     def create(self, validated_data):
         user1 = self.context['request'].user
-        user2_username = validated_data.pop('user2_username')
-        user2 = User.objects.get(username=user2_username)
+        user2 = validated_data.pop('user2_username')
 
         # Check if a chat already exists between these users
         existing_chat = Chat.objects.filter(
@@ -68,6 +149,9 @@ class ChatSerializer(serializers.ModelSerializer):
 
 class UserKeySerializer(serializers.ModelSerializer):
     public_key = serializers.JSONField()
+    encrypted_private_key = Base64BinaryField()
+    salt = Base64BinaryField(max_length=48)
+    iv = Base64BinaryField(min_length=IV_SIZE, max_length=IV_SIZE)
 
     class Meta:
         model = UserKey
@@ -75,6 +159,9 @@ class UserKeySerializer(serializers.ModelSerializer):
 
 
 class ChatKeySerializer(serializers.ModelSerializer):
+    encrypted_key = Base64BinaryField()
+    iv = Base64BinaryField(min_length=IV_SIZE, max_length=IV_SIZE)
+
     class Meta:
         model = ChatKey
         fields = ['encrypted_key', 'iv']
\ No newline at end of file
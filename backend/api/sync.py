@@ -0,0 +1,144 @@
+"""
+Cold-start sync: what changed in all of a user's chats since a cursor, as one
+bounded stream of JSON lines instead of a request per chat.
+
+Lines are {"type": ...} records: "chat" (inbox rows that changed), "chat_key"
+(the user's keys of new chats), "public_key" (peers' keys rotated since) and
+"message", ending with a "cursor" record. When "more" is true the client asks
+again with that cursor right away.
+
+The set of changed chats comes from the inbox version, which is exact. Messages
+and public keys are selected by time, reaching SYNC_OVERLAP_SECONDS back so that
+rows committed late (e.g. from a write-behind batch) are not missed; clients
+drop messages they already have by id.
+"""
+import base64
+import json
+from datetime import timedelta
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Chat, ChatKey, GroupMessage, InboxEntry, InboxVersion, UserKey
+from .pagination import InvalidCursor
+from .serializers import MESSAGE_VALUES, ChatKeySerializer, inbox_entry_data, message_data
+
+
+SYNC_CHUNK_SIZE = 500
+
+
+def encode_sync_cursor(version, since, after=None):
+    """
+    Opaque cursor: inbox version, sync time and, while a sync is cut short by
+    SYNC_MAX_MESSAGES, the (created, id) of the last message sent.
+    """
+    raw = {'v': version, 't': since.isoformat()}
+    if after is not None:
+        raw['a'] = [after['created'].isoformat(), after['id']]
+    return base64.urlsafe_b64encode(json.dumps(raw).encode()).decode().rstrip('=')
+
+
+def decode_sync_cursor(cursor):
+    """
+    (version, since, after) of a cursor; (0, None, None) starts from scratch.
+    """
+    if not cursor:
+        return 0, None, None
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        version, since = int(raw['v']), parse_datetime(raw['t'])
+        after = (parse_datetime(raw['a'][0]), int(raw['a'][1])) if 'a' in raw else None
+    except (ValueError, TypeError, KeyError, IndexError, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+    if since is None or (after is not None and after[0] is None):
+        raise InvalidCursor(cursor)
+    return version, since, after
+
+
+def sync_records(user, version, since, after):
+    """
+    Records of one sync response. Starting without a cursor returns every
+    chat, key and peer key, and the latest message of each chat only.
+    """
+    started = timezone.now()
+    # Read first: changes after this are sent again next time, never skipped
+    current_version = InboxVersion.objects.filter(user=user).values_list('version', flat=True).first() or 0
+
+    # Chats changed after the cursor's version, from the (user, version) index
+    entries = list(
+        InboxEntry.objects.filter(user=user, version__gt=version)
+        .select_related('chat__user1__user_key', 'chat__user2__user_key', 'last_message__author')
+    )
+    window = since - timedelta(seconds=settings.SYNC_OVERLAP_SECONDS) if since else None
+
+    # Inbox rows and keys go out once, not again with every continuation
+    if after is None:
+        for entry in entries:
+            yield {'type': 'chat', **inbox_entry_data(entry, user)}
+
+        new_chats = [entry.chat_id for entry in entries if window is None or entry.chat.created_at >= window]
+        for key in ChatKey.objects.filter(user=user, chat_id__in=new_chats):
+            yield {'type': 'chat_key', 'chat_id': key.chat_id, **ChatKeySerializer(key).data}
+
+        if window is None:
+            peers = [entry.chat.user2 if entry.chat.user1_id == user.id else entry.chat.user1 for entry in entries]
+            keys = [(peer.username, peer.user_key) for peer in peers if hasattr(peer, 'user_key')]
+        else:
+            # Recently rotated keys (updated_at index) of users sharing a chat
+            keys = (
+                UserKey.objects.filter(updated_at__gte=window)
+                .filter(
+                    Exists(Chat.objects.filter(user1=OuterRef('user'), user2=user))
+                    | Exists(Chat.objects.filter(user2=OuterRef('user'), user1=user))
+                )
+                .select_related('user')
+            )
+            keys = [(key.user.username, key) for key in keys]
+        for username, key in keys:
+            yield {'type': 'public_key', 'user': username, 'public_key': key.public_key}
+
+    last = None
+    more = False
+    if window is not None and entries:
+        # Messages of the changed chats only, along the (group, created, id) index
+        messages = (
+            GroupMessage.objects.filter(group_id__in=[entry.chat_id for entry in entries], created__gte=window)
+            .order_by('created', 'id')
+            .values('group_id', *MESSAGE_VALUES)
+        )
+        if after is not None:
+            messages = messages.filter(Q(created__gt=after[0]) | Q(created=after[0], id__gt=after[1]))
+        limit = settings.SYNC_MAX_MESSAGES
+        for count, message in enumerate(messages[:limit + 1].iterator(chunk_size=500)):
+            if count == limit:
+                more = True
+                break
+            last = message
+            yield {'type': 'message', 'chat_id': message['group_id'], **message_data(message)}
+
+    if more:
+        cursor = encode_sync_cursor(version, since, last)
+    else:
+        cursor = encode_sync_cursor(current_version, started)
+    yield {'type': 'cursor', 'cursor': cursor, 'more': more}
+
+
+async def sync_lines(records):
+    """
+    `records` as JSON lines, SYNC_CHUNK_SIZE to a chunk. Each chunk is read in
+    one sync_to_async call, on the same thread and so the same connection and
+    server-side cursor as the last; under ASGI a sync iterator would be read
+    to the end before the first byte went out.
+    """
+    encoder = JSONEncoder()
+
+    def chunk():
+        return ''.join(encoder.encode(record) + '\n' for record in islice(records, SYNC_CHUNK_SIZE))
+
+    while lines := await sync_to_async(chunk)():
+        yield lines
@@ -1,3 +1,726 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+import unittest.mock
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connection, connections, router
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+import accounts.urls
+import accounts.views
+import backend.urls
+from backend import renderers, replicas
+from backend.db import db_sync_to_async
+from backend.metrics import registry
+from backend.renderers import ORJSONRenderer
+from . import protocol, urls, views
+from .models import Chat, ChatKey, ChatReadState, GroupMessage, UserKey
+from .partitions import archive_partitions, ensure_partitions, month_start
+from .serializers import MESSAGE_VALUES, ChatMessageSerializer, message_data
+from .write_behind import message_writer
 
-# Create your tests here.
+
+class ChatViewTests(TestCase):
+    def setUp(self):
+        # Created first so that chats with it store the owner as user2
+        self.peer = User.objects.create(username='peer')
+        self.user = User.objects.create(username='owner')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_chat(self, username):
+        other = User.objects.create(username=username)
+        UserKey.objects.create(user=other, public_key={'kty': 'RSA'}, encrypted_private_key=b'x', salt=b's', iv=b'i')
+        chat = Chat.objects.create(user1=self.user, user2=other)
+        GroupMessage.objects.create_in_sequence(group=chat, author=other, body=b'ct', iv=b'iv')
+        return chat
+
+    def test_query_count_does_not_grow_with_chats(self):
+        self.add_chat('first')
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/chat/')
+        self.assertEqual(len(response.json()['chats']), 1)
+
+        for i in range(10):
+            self.add_chat(f'other{i}')
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/chat/')
+        self.assertEqual(len(response.json()['chats']), 11)
+
+    def test_lists_chats_from_both_sides(self):
+        self.add_chat('later')
+        chat = Chat.objects.create(user1=self.user, user2=self.peer)
+        self.assertEqual(chat.user2_id, self.user.id)
+
+        response = self.client.get('/api/chat/')
+        chats = {entry['other_user']: entry for entry in response.json()['chats']}
+        self.assertEqual(set(chats), {'later', 'peer'})
+        self.assertEqual(chats['later']['public_key'], {'kty': 'RSA'})
+        self.assertEqual(chats['later']['latest_message'][0]['author'], 'later')
+        self.assertEqual(chats['later']['unread_count'], 1)
+        self.assertIsNone(chats['peer']['public_key'])
+        self.assertEqual(chats['peer']['latest_message'], [])
+        self.assertEqual(chats['peer']['unread_count'], 0)
+
+    def test_since_returns_only_changed_chats_by_activity(self):
+        first = self.add_chat('first')
+        self.add_chat('second')
+        version = self.client.get('/api/chat/').json()['version']
+
+        response = self.client.get('/api/chat/', {'since': version})
+        self.assertEqual(response.json()['chats'], [])
+        self.assertEqual(response.json()['version'], version)
+
+        GroupMessage.objects.create_in_sequence(group=first, author=first.user2, body=b'ct2', iv=b'iv')
+        response = self.client.get('/api/chat/', {'since': version})
+        self.assertEqual([entry['other_user'] for entry in response.json()['chats']], ['first'])
+        self.assertEqual(response.json()['chats'][0]['unread_count'], 2)
+        self.assertGreater(response.json()['version'], version)
+
+        ChatReadState.objects.advance(first.id, self.user.id, 1)
+        response = self.client.get('/api/chat/', {'since': response.json()['version']})
+        self.assertEqual(response.json()['chats'][0]['unread_count'], 1)
+
+        response = self.client.get('/api/chat/')
+        self.assertEqual([entry['other_user'] for entry in response.json()['chats']], ['first', 'second'])
+        self.assertEqual(self.client.get('/api/chat/', {'since': 'x'}).status_code, 400)
+
+    def test_history_revalidates_until_the_chat_changes(self):
+        chat = self.add_chat('other')
+        url = f'/api/chat/{chat.id}/history/'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(len(response.json()['messages']), 1)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        ChatReadState.objects.advance(chat.id, self.user.id, 1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['read_seq']['owner'], 1)
+        etag = response['ETag']
+
+        GroupMessage.objects.create_in_sequence(group=chat, author=self.user, body=b'ct2', iv=b'iv')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.json()['messages']), 2)
+
+    def test_keys_revalidate(self):
+        chat = self.add_chat('other')
+        key = ChatKey.objects.create(chat=chat, user=self.user, encrypted_key=b'k', iv=b'i')
+        response = self.client.get(f'/api/chat/{chat.id}/key/')
+        self.assertEqual(response['ETag'], f'"{key.pk}"')
+        self.assertIn('max-age', response['Cache-Control'])
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/chat/{chat.id}/key/', HTTP_IF_NONE_MATCH=f'"{key.pk}"')
+        self.assertEqual(response.status_code, 304)
+
+        user_key = UserKey.objects.create(
+            user=self.user, public_key={'kty': 'RSA'}, encrypted_private_key=b'x', salt=b's', iv=b'i'
+        )
+        response = self.client.get('/api/keys/')
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/api/keys/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(
+            self.client.get('/api/keys/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304
+        )
+        user_key.save()
+        self.assertEqual(self.client.get('/api/keys/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class SyncHotViewURLs:
+    # The routes ASYNC_API_VIEWS=False serves: the DRF views of the hot
+    # endpoints, then everything else as usual
+    urlpatterns = [
+        path('auth/', include(accounts.urls.urlpatterns_for(accounts.views))),
+        path('api/', include(urls.urlpatterns_for(views))),
+        *backend.urls.urlpatterns,
+    ]
+
+
+@override_settings(ROOT_URLCONF=SyncHotViewURLs)
+class SyncChatViewTests(ChatViewTests):
+    pass
+
+
+class AsyncApiViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def test_bearer_token_authentication(self):
+        self.assertEqual(self.client.get('/api/chat/').status_code, 401)
+        self.assertEqual(self.client.get('/api/chat/', HTTP_AUTHORIZATION='Bearer nope').status_code, 401)
+        response = self.client.get('/auth/me/', **self.auth)
+        self.assertEqual(response.json(), {'username': 'owner'})
+
+    def test_user_key_round_trip(self):
+        self.assertEqual(self.client.get('/api/keys/', **self.auth).status_code, 404)
+        key = {'public_key': {'kty': 'RSA'}, 'encrypted_private_key': 'eA==', 'salt': 'cw==', 'iv': 'aXZpdml2aXZpdml2'}
+        response = self.client.post('/api/keys/', key, content_type='application/json', **self.auth)
+        self.assertEqual(response.json(), {'status': 'ok'})
+        self.assertEqual(self.client.get('/api/keys/', **self.auth).json(), key)
+
+        for iv in ('not base64', 'aQ=='):
+            key['iv'] = iv
+            response = self.client.post('/api/keys/', key, content_type='application/json', **self.auth)
+            self.assertEqual(response.status_code, 400)
+
+
+@override_settings(ROOT_URLCONF=SyncHotViewURLs)
+class SyncApiViewTests(AsyncApiViewTests):
+    pass
+
+
+class SerializationTests(TestCase):
+    def test_fast_paths_match_the_drf_output(self):
+        author = User.objects.create(username='author')
+        chat = Chat.objects.create(user1=author, user2=User.objects.create(username='peer'))
+        message = GroupMessage.objects.create_in_sequence(group=chat, author=author, body=b'ct', iv=b'iv')
+        row = GroupMessage.objects.values(*MESSAGE_VALUES).get(id=message.id)
+        self.assertEqual(message_data(row), ChatMessageSerializer(message).data)
+
+        data = {'messages': [message_data(row)], 'at': message.created, 'text': 'caf\u00e9 \u2028'}
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        with unittest.mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_stream_frame_reuses_the_encoded_message(self):
+        event = {'chat_id': 7, 'ct': b'ct', 'iv': b'iv', 'author': 'author', 'seq': 3}
+        frame = json.loads(protocol.encode_stream_json(dict(event, json=protocol.encode_json(event))))
+        self.assertEqual(frame, {'chat_id': 7, 'ct': 'Y3Q=', 'iv': 'aXY=', 'author': 'author', 'seq': 3})
+
+    def test_ivs_of_another_length_are_refused(self):
+        self.assertEqual(protocol.decode_json('{"ct": "Y3Q=", "iv": "aXZpdml2aXZpdml2"}').iv, b'iviviviviviv')
+        with self.assertRaisesRegex(ValueError, 'iv must be 12 bytes'):
+            protocol.decode_json('{"ct": "Y3Q=", "iv": "aXY="}')
+        # Would otherwise go out zero-padded to binary peers
+        with self.assertRaisesRegex(ValueError, 'iv must be 12 bytes'):
+            protocol.encode_binary({'ct': b'ct', 'iv': b'iv', 'author_id': 1})
+
+
+@override_settings(METRICS_ENABLED=True, METRICS_TOKEN='scrape')
+class MetricsTests(TestCase):
+    def test_request_latency_by_route(self):
+        user = User.objects.create(username='owner')
+        chat = Chat.objects.create(user1=user, user2=User.objects.create(username='peer'))
+        route = {'route': 'api/chat/<int:chat_id>/history/', 'method': 'GET'}
+        before = registry.get_sample_value('messenger_request_seconds_count', route) or 0
+
+        auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(user)}'}
+        self.client.get(f'/api/chat/{chat.id}/history/', **auth)
+        self.assertEqual(registry.get_sample_value('messenger_request_seconds_count', route), before + 1)
+
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertIn(b'messenger_open_sockets', response.content)
+        self.assertIn(b'messenger_channel_layer_queued_messages 0.0', response.content)
+
+    @unittest.skipUnless(settings.DB_POOL, "DB_POOL is off")
+    def test_database_pool(self):
+        before = registry.get_sample_value('messenger_db_connect_seconds_count') or 0
+        count = async_to_sync(db_sync_to_async(lambda: User.objects.count()))()
+        self.assertEqual(count, 0)  # Another connection, outside the test transaction
+        self.assertEqual(registry.get_sample_value('messenger_db_connect_seconds_count'), before + 1)
+        self.assertGreaterEqual(registry.get_sample_value('messenger_db_pool_connections', {'state': 'open'}), 1)
+        self.assertIsNotNone(registry.get_sample_value('messenger_db_pool_wait_seconds_total'))
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_off_by_default(self):
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape').status_code, 404)
+
+
+def reset_replica_state():
+    replicas._lag.clear()
+    replicas._pinned.clear()
+    cache.clear()
+
+
+# 'default' stands in for a replica; it is not a standby, so it never lags
+@override_settings(DB_REPLICAS=['default'], DB_REPLICA_LAG_CHECK_SECONDS=60)
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        reset_replica_state()
+
+    def test_recent_writers_and_lagging_replicas_use_the_primary(self):
+        self.assertEqual(replicas.read_database(1), 'default')
+        replicas.pin(1)
+        self.assertIsNone(replicas.read_database(1))
+        self.assertEqual(replicas.read_database(2), 'default')
+
+        replicas._lag.clear()
+        with unittest.mock.patch.object(replicas, 'replica_lag', return_value=5.0) as lag:
+            self.assertIsNone(replicas.read_database(2))
+            self.assertIsNone(replicas.read_database(2))
+        # Checked once per DB_REPLICA_LAG_CHECK_SECONDS, not per request
+        self.assertEqual(lag.call_count, 1)
+
+    @override_settings(DATABASE_ROUTERS=['backend.replicas.ReplicaRouter'])
+    def test_only_reads_inside_reads_from_are_routed(self):
+        with replicas.reads_from('replica'):
+            self.assertEqual(router.db_for_read(GroupMessage), 'replica')
+            self.assertEqual(router.db_for_write(GroupMessage), 'default')
+        self.assertEqual(router.db_for_read(GroupMessage), 'default')
+
+
+def wait_for_replica(alias, timeout=10):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_current_wal_lsn()")
+        (lsn,) = cursor.fetchone()
+    deadline = time.monotonic() + timeout
+    with connections[alias].cursor() as cursor:
+        while time.monotonic() < deadline:
+            # NULL when the replica database is not a standby, as in a test mirror
+            cursor.execute("SELECT COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, true)", [lsn])
+            if cursor.fetchone()[0]:
+                return
+    raise AssertionError(f'{alias} did not catch up within {timeout}s')
+
+
+@unittest.skipUnless(settings.DB_REPLICAS, "DB_REPLICA_HOSTS is not set")
+@override_settings(DB_REPLICAS=settings.DB_REPLICAS[:1], DB_REPLICA_LAG_CHECK_SECONDS=60)
+class ReplicaReadTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        reset_replica_state()
+        self.user = User.objects.create(username='owner')
+        self.chat = Chat.objects.create(user1=self.user, user2=User.objects.create(username='peer'))
+        GroupMessage.objects.create_in_sequence(group=self.chat, author=self.user, body=b'ct', iv=b'iv')
+        self.replica = settings.DB_REPLICAS[0]
+        wait_for_replica(self.replica)
+        # Lag is checked now, so the requests below only run their own queries
+        self.assertEqual(replicas.usable_replicas(), [self.replica])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def replica_queries(self, path):
+        with CaptureQueriesContext(connections[self.replica]) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_reads_move_to_the_primary_after_a_write(self):
+        for path in ('/api/chat/', f'/api/chat/{self.chat.id}/history/', '/users/?q=pe'):
+            self.assertGreater(self.replica_queries(path), 0, path)
+
+        key = {'public_key': {'kty': 'RSA'}, 'encrypted_private_key': 'eA==', 'salt': 'cw==', 'iv': 'aXZpdml2aXZpdml2'}
+        self.assertEqual(self.client.post('/api/keys/', key, format='json').status_code, 200)
+        # Read back from the primary, whether or not the replica has it yet
+        self.assertEqual(self.replica_queries('/api/keys/'), 0)
+        self.assertEqual(self.replica_queries(f'/api/chat/{self.chat.id}/history/'), 0)
+
+
+@override_settings(ROOT_URLCONF=SyncHotViewURLs)
+class SyncReplicaReadTests(ReplicaReadTests):
+    pass
+
+
+@override_settings(SYNC_MAX_MESSAGES=2, SYNC_OVERLAP_SECONDS=0)
+class SyncViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.peer = User.objects.create(username='peer')
+        UserKey.objects.create(user=self.peer, public_key={'kty': 'RSA'}, encrypted_private_key=b'x', salt=b's', iv=b'i')
+        self.chat = Chat.objects.create(user1=self.user, user2=self.peer)
+        ChatKey.objects.create(chat=self.chat, user=self.user, encrypted_key=b'k', iv=b'i')
+        self.quiet = Chat.objects.create(user1=self.user, user2=User.objects.create(username='quiet'))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    async def fetch(self, cursor):
+        response = await self.async_client.get(
+            '/api/sync/', {'cursor': cursor} if cursor else {},
+            headers={'Authorization': f'Bearer {AccessToken.for_user(self.user)}'},
+        )
+        # Streamed under ASGI, not read into memory before the first line
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    def sync(self, cursor=None):
+        records = [json.loads(line) for line in async_to_sync(self.fetch)(cursor).splitlines()]
+        self.assertEqual(records[-1]['type'], 'cursor')
+        return records[:-1], records[-1]
+
+    def test_cold_start_then_deltas(self):
+        records, end = self.sync()
+        self.assertEqual(
+            sorted((r['type'], r.get('id') or r.get('chat_id') or r.get('user')) for r in records),
+            [('chat', self.chat.id), ('chat', self.quiet.id), ('chat_key', self.chat.id), ('public_key', 'peer')]
+        )
+        self.assertFalse(end['more'])
+
+        records, end = self.sync(end['cursor'])
+        self.assertEqual(records, [])
+
+        for i in range(3):
+            GroupMessage.objects.create_in_sequence(group=self.chat, author=self.peer, body=f'ct{i}'.encode(), iv=b'iv')
+        records, end = self.sync(end['cursor'])
+        self.assertEqual([r['type'] for r in records], ['chat', 'message', 'message'])
+        self.assertEqual(records[0]['unread_count'], 3)
+        self.assertTrue(end['more'])
+
+        records, end = self.sync(end['cursor'])
+        self.assertEqual([(r['type'], r['seq']) for r in records], [('message', 3)])
+        self.assertFalse(end['more'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/sync/', {'cursor': 'nope'}).status_code, 400)
+
+
+class ChatExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.peer = User.objects.create(username='peer')
+        self.chat = Chat.objects.create(user1=self.user, user2=self.peer)
+        GroupMessage.objects.bulk_create_in_sequence([
+            GroupMessage(group=self.chat, author=self.peer, body=bytes([i % 256]) * 8, iv=b'iv')
+            for i in range(2500)
+        ])
+
+    async def test_streams_every_message_in_order(self):
+        response = await self.async_client.get(
+            f'/api/chat/{self.chat.id}/export/',
+            headers={'Authorization': f'Bearer {AccessToken.for_user(self.user)}'},
+        )
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        lines = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        self.assertEqual(lines[0]['type'], 'chat')
+        self.assertEqual([line['seq'] for line in lines[1:]], list(range(1, 2501)))
+        self.assertEqual(lines[1]['author'], 'peer')
+        # Header, then a chunk per EXPORT_CHUNK_SIZE rows
+        self.assertEqual(len(chunks), 3)
+
+    def test_other_users_cannot_export(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username='stranger'))
+        self.assertEqual(client.get(f'/api/chat/{self.chat.id}/export/').status_code, 403)
+
+
+class MessagePartitionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.chat = Chat.objects.create(user1=self.user, user2=User.objects.create(username='peer'))
+        self.now = timezone.now()
+
+    def message_in(self, months):
+        message = GroupMessage.objects.create_in_sequence(group=self.chat, author=self.user, body=b'ct', iv=b'iv')
+        GroupMessage.objects.filter(id=message.id).update(created=month_start(self.now, months))
+        return message
+
+    def partition_of(self, message):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text FROM api_groupmessage WHERE id = %s', [message.id])
+            return cursor.fetchone()[0]
+
+    def test_rows_move_out_of_default_when_their_month_is_created(self):
+        ahead = self.message_in(2)
+        late = self.message_in(6)
+        self.assertEqual(self.partition_of(ahead), f'api_groupmessage_p{month_start(self.now, 2):%Y_%m}')
+        self.assertEqual(self.partition_of(late), 'api_groupmessage_default')
+
+        name = f'api_groupmessage_p{month_start(self.now, 6):%Y_%m}'
+        self.assertIn(name, ensure_partitions(6))
+        self.assertEqual(self.partition_of(late), name)
+        self.assertEqual(ensure_partitions(6), [])
+
+    def test_history_skips_partitions_older_than_the_chat(self):
+        Chat.objects.filter(id=self.chat.id).update(created_at=month_start(self.now, 2))
+        self.chat.refresh_from_db()
+        plan = GroupMessage.objects.in_chat(self.chat).order_by('-created', '-id')[:50].explain()
+        self.assertIn(f'api_groupmessage_p{month_start(self.now, 2):%Y_%m}', plan)
+        self.assertNotIn('api_groupmessage_legacy', plan)
+
+    def test_archive_detaches_old_partitions(self):
+        old = self.message_in(0)
+        kept = self.message_in(2)
+        self.assertEqual(archive_partitions(month_start(self.now, 1)), ['api_groupmessage_legacy'])
+        self.assertEqual(list(GroupMessage.objects.in_chat(self.chat).values_list('id', flat=True)), [kept.id])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM archive.api_groupmessage_legacy WHERE id = %s", [old.id])
+            self.assertEqual(cursor.fetchone()[0], 1)
+        # Sequences carry on past the archived messages
+        self.assertEqual(GroupMessage.objects.create_in_sequence(group=self.chat, author=self.user, body=b'ct', iv=b'iv').seq, 3)
+
+
+class MessageSequenceTests(TransactionTestCase):
+    # The partitioned table cannot keep (group, seq) unique; ChatSequence has to
+    def test_concurrent_writers_never_share_a_seq(self):
+        user = User.objects.create(username='owner')
+        chat = Chat.objects.create(user1=user, user2=User.objects.create(username='peer'))
+        start = threading.Barrier(8)
+
+        def write(writer):
+            start.wait()
+            try:
+                for i in range(5):
+                    if writer % 2:
+                        GroupMessage.objects.create_in_sequence(group=chat, author=user, body=b'ct', iv=b'iv')
+                    else:
+                        GroupMessage.objects.bulk_create_in_sequence([
+                            GroupMessage(group=chat, author=user, body=b'ct', iv=b'iv') for _ in range(2)
+                        ])
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write, args=(writer,)) for writer in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        seqs = sorted(GroupMessage.objects.filter(group=chat).values_list('seq', flat=True))
+        self.assertEqual(seqs, list(range(1, 61)))
+
+
+class JWTAuthMiddlewareTests(TransactionTestCase):
+    async def connect(self, token):
+        from backend.asgi import application
+        communicator = WebsocketCommunicator(application, f'/ws/stream/?token={token}')
+        connected, _ = await communicator.connect()
+        await communicator.disconnect()
+        return connected
+
+    def test_bad_tokens_are_refused_and_lookup_errors_raised(self):
+        failures = registry.get_sample_value('messenger_jwt_auth_failures_total') or 0
+        self.assertFalse(async_to_sync(self.connect)('not-a-token'))
+        with override_settings(METRICS_ENABLED=True):
+            self.assertFalse(async_to_sync(self.connect)('not-a-token'))
+        self.assertEqual(registry.get_sample_value('messenger_jwt_auth_failures_total'), failures + 1)
+
+        token = AccessToken.for_user(User.objects.create(username='owner'))
+        with unittest.mock.patch('backend.middleware.jwt_auth.get_user', side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                async_to_sync(self.connect)(token)
+
+
+@override_settings(MESSAGE_RESUME_BATCH_SIZE=100, READ_RECEIPT_DELAY_MS=50)
+class ChatroomSocketTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username='sender')
+        self.user = User.objects.create(username='reader')
+        self.chat = Chat.objects.create(user1=self.sender, user2=self.user)
+        GroupMessage.objects.bulk_create_in_sequence([
+            GroupMessage(group=self.chat, author=self.sender, body=f'ct{i}'.encode(), iv=b'iv')
+            for i in range(450)
+        ])
+
+    async def connect(self, user, query=''):
+        from backend.asgi import application
+        communicator = WebsocketCommunicator(
+            application, f'/ws/chatroom/{self.chat.id}/?token={AccessToken.for_user(user)}{query}'
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def session(self, last_seq, expected):
+        communicator = await self.connect(self.user, f'&last_seq={last_seq}')
+        frames = [json.loads(await communicator.receive_from()) for _ in range(expected)]
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+        return frames
+
+    def test_replays_only_missed_messages_in_order(self):
+        frames = async_to_sync(self.session)(310, 140)
+        self.assertEqual([frame['seq'] for frame in frames], list(range(311, 451)))
+        self.assertEqual(frames[0]['author'], 'sender')
+
+    def test_up_to_date_client_gets_nothing(self):
+        self.assertEqual(async_to_sync(self.session)(450, 0), [])
+
+    def test_sequence_continues_after_bulk_insert(self):
+        message = GroupMessage.objects.create_in_sequence(group=self.chat, author=self.user, body=b'ct', iv=b'iv')
+        self.assertEqual(message.seq, 451)
+        self.assertEqual(ChatReadState.objects.get(chat=self.chat, user=self.user).read_seq, 451)
+
+    async def read_marks(self):
+        sender = await self.connect(self.sender)
+        reader = await self.connect(self.user)
+        for seq in (100, 300, 200, 1000):
+            await reader.send_to(text_data=json.dumps({'read': seq}))
+        receipts = [json.loads(await sender.receive_from())]
+        self.assertTrue(await sender.receive_nothing())
+        await reader.disconnect()
+        await sender.disconnect()
+        return receipts
+
+    async def send_message(self):
+        communicator = await self.connect(self.sender)
+        await communicator.send_to(text_data=json.dumps({'ct': 'Y3Q=', 'iv': 'aXZpdml2aXZpdml2'}))
+        await communicator.receive_from()
+        await communicator.disconnect()
+
+    @override_settings(METRICS_ENABLED=True, MESSAGE_WRITE_BEHIND=False)
+    def test_message_path_metrics(self):
+        names = ['messenger_message_broadcast_seconds_count', 'messenger_save_message_seconds_count']
+        before = [registry.get_sample_value(name) for name in names]
+        sends = registry.get_sample_value('messenger_group_send_seconds_count', {'type': 'chat_message'}) or 0
+        async_to_sync(self.send_message)()
+        self.assertEqual([registry.get_sample_value(name) for name in names], [count + 1 for count in before])
+        self.assertEqual(registry.get_sample_value('messenger_group_send_seconds_count', {'type': 'chat_message'}), sends + 1)
+        self.assertEqual(registry.get_sample_value('messenger_open_sockets', {'consumer': 'ChatroomConsumer'}), 0)
+
+    def test_read_marks_are_coalesced_and_capped(self):
+        self.assertEqual(async_to_sync(self.read_marks)(), [{'read': 450, 'user': 'reader'}])
+        self.assertEqual(ChatReadState.objects.get(chat=self.chat, user=self.user).read_seq, 450)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        chats = client.get('/api/chat/').json()['chats']
+        self.assertEqual(chats[0]['unread_count'], 0)
+        client.force_authenticate(self.sender)
+        chats = client.get('/api/chat/').json()['chats']
+        self.assertEqual(chats[0]['unread_count'], 0)
+
+
+@override_settings(MESSAGE_WRITE_BEHIND=True)
+class WriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username='sender')
+        self.user = User.objects.create(username='reader')
+        self.chat = Chat.objects.create(user1=self.sender, user2=self.user)
+        self.save = GroupMessage.objects.bulk_create_in_sequence
+
+    def tearDown(self):
+        # Each test runs its own event loop; the writer must not keep the last one's queue
+        message_writer.queue = message_writer.flusher = None
+
+    async def connect(self, user):
+        from backend.asgi import application
+        communicator = WebsocketCommunicator(
+            application, f'/ws/chatroom/{self.chat.id}/?token={AccessToken.for_user(user)}'
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def send(self, communicator, client_id):
+        await communicator.send_to(text_data=json.dumps({'ct': 'Y3Q=', 'iv': 'aXZpdml2aXZpdml2', 'client_id': client_id}))
+
+    async def receive(self, communicator, key):
+        # Next frame carrying `key`, skipping the others
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout=5))
+            if key in frame:
+                return frame
+
+    @db_sync_to_async
+    def stored(self):
+        return list(GroupMessage.objects.filter(group=self.chat).order_by('seq').values_list('seq', flat=True))
+
+    async def broadcast_then_ack(self):
+        release = threading.Event()
+
+        def blocked(messages):
+            release.wait(5)
+            return self.save(messages)
+
+        sender, reader = await self.connect(self.sender), await self.connect(self.user)
+        with unittest.mock.patch.object(GroupMessage.objects, 'bulk_create_in_sequence', side_effect=blocked):
+            await self.send(sender, 7)
+            frame = await self.receive(reader, 'ct')
+            # Delivered while the write is still held up
+            self.assertEqual((frame['author'], await self.stored()), ('sender', []))
+            release.set()
+            ack = await self.receive(sender, 'ack')
+        self.assertEqual((ack['client_id'], ack['seq']), (7, 1))
+        self.assertEqual(await self.stored(), [1])
+        # The recipient learns the seq it needs for resuming and read marks
+        self.assertEqual(await self.receive(reader, 'stored'), {'stored': ack['ack'], 'seq': 1})
+        await message_writer.close()
+        await sender.disconnect()
+        await reader.disconnect()
+
+    def test_broadcasts_before_the_write_and_acknowledges_after(self):
+        async_to_sync(self.broadcast_then_ack)()
+
+    async def failed_write(self):
+        sender = await self.connect(self.sender)
+        with unittest.mock.patch.object(
+            GroupMessage.objects, 'bulk_create_in_sequence', side_effect=DatabaseError('disk full'),
+        ):
+            await self.send(sender, 7)
+            error = await self.receive(sender, 'error')
+        self.assertEqual(error, {'error': 'Message was not saved: disk full', 'client_id': 7})
+        await message_writer.close()
+        await sender.disconnect()
+
+    def test_failed_write_is_reported_to_the_sender(self):
+        async_to_sync(self.failed_write)()
+
+    async def close_flushes(self):
+        sender = await self.connect(self.sender)
+        # Nothing would be written for a minute without close()
+        with unittest.mock.patch.object(message_writer, 'interval', 60):
+            for client_id in (1, 2, 3):
+                await self.send(sender, client_id)
+                await self.receive(sender, 'ct')
+            self.assertEqual(await self.stored(), [])
+            await message_writer.close()
+        self.assertEqual(await self.stored(), [1, 2, 3])
+        acks = [(await self.receive(sender, 'ack'))['client_id'] for _ in range(3)]
+        self.assertEqual(acks, [1, 2, 3])
+        self.assertIsNone(message_writer.queue)
+        await sender.disconnect()
+
+    def test_close_writes_the_batch_in_flight(self):
+        async_to_sync(self.close_flushes)()
+
+
+@unittest.skipUnless(settings.CHANNEL_REDIS_HOSTS, "CHANNEL_REDIS_HOSTS is not set")
+class ShardedChannelLayerTests(TransactionTestCase):
+    """
+    Runs two ASGI worker processes against the configured Redis shards and
+    checks that a burst sent through one reaches a socket held by the other.
+    """
+    count = 500
+
+    def probe(self, role, user, chat):
+        env = dict(os.environ, DB_NAME=connection.settings_dict['NAME'])
+        return subprocess.Popen(
+            [sys.executable, 'manage.py', 'layer_probe', role,
+             '--chat', str(chat.id), '--token', str(AccessToken.for_user(user)),
+             '--count', str(self.count)],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, text=True,
+        )
+
+    def test_cross_process_delivery(self):
+        sender = User.objects.create(username='sender')
+        recipient = User.objects.create(username='recipient')
+        chat = Chat.objects.create(user1=sender, user2=recipient)
+
+        receiver = self.probe('receive', recipient, chat)
+        self.assertEqual(receiver.stdout.readline().strip(), 'ready')
+        sending = self.probe('send', sender, chat)
+
+        sent_out, _ = sending.communicate(timeout=60)
+        received_out, _ = receiver.communicate(timeout=60)
+        sent = json.loads(sent_out.strip().splitlines()[-1])
+        received = json.loads(received_out.strip().splitlines()[-1])
+
+        self.assertEqual(sent['received'], self.count)
+        self.assertEqual(received['received'], self.count)
+        self.assertEqual(GroupMessage.objects.filter(group=chat).count(), self.count)
+        sys.stderr.write(
+            f"\ncross-process fan-out: {received['messages_per_second']} msg/s received, "
+            f"{sent['messages_per_second']} msg/s sent\n"
+        )
@@ -1,11 +1,25 @@
+from django.conf import settings
 from django.urls import path
 from rest_framework.authtoken.views import obtain_auth_token
-from .views import ChatView, CreateChatView, ChatHistoryView, UserKeyView, ChatKeyView
-
-urlpatterns = [
-    path('chat/', ChatView.as_view(), name='chat'),
-    path('chat/create/', CreateChatView.as_view(), name='create-chat'),
-    path('chat/<int:chat_id>/history/', ChatHistoryView.as_view(), name='chat-history'),
-    path('keys/', UserKeyView.as_view(), name='user-keys'),
-    path('chat/<int:chat_id>/key/', ChatKeyView.as_view(), name='chat-key'),
-]
+from . import async_views, views
+from .views import CreateChatView, SyncView, ChatExportView
+
+
+def urlpatterns_for(hot):
+    """
+    The app's routes, with the hot endpoints served from `hot`: async_views or
+    views.
+    """
+    return [
+        path('chat/', hot.ChatView.as_view(), name='chat'),
+        path('chat/create/', CreateChatView.as_view(), name='create-chat'),
+        path('chat/<int:chat_id>/history/', hot.ChatHistoryView.as_view(), name='chat-history'),
+        path('chat/<int:chat_id>/export/', ChatExportView.as_view(), name='chat-export'),
+        path('keys/', hot.UserKeyView.as_view(), name='user-keys'),
+        path('chat/<int:chat_id>/key/', hot.ChatKeyView.as_view(), name='chat-key'),
+        path('sync/', SyncView.as_view(), name='sync'),
+    ]
+
+
+# Native async handlers for the hot endpoints under daphne
+urlpatterns = urlpatterns_for(async_views if settings.ASYNC_API_VIEWS else views)
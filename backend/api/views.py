@@ -3,52 +3,116 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
-from .models import Chat, GroupMessage, UserKey, ChatKey
-from .serializers import ChatMessageSerializer, ChatSerializer, UserKeySerializer, ChatKeySerializer
+from .models import Chat, ChatReadState, GroupMessage, InboxEntry, InboxVersion, UserKey, ChatKey
+from .serializers import (
+    MESSAGE_VALUES, ChatSerializer, UserKeySerializer, ChatKeySerializer, inbox_entry_data, message_data,
+)
+from .pagination import InvalidCursor, paginate_messages, parse_page_size
+from .chat_keys import ensure_chat_keys
+from .sync import decode_sync_cursor, sync_lines, sync_records
+from .export import export_lines
+from .conditional import not_modified, with_validators
+from .consumers import user_group
+from backend.replicas import pin, replica_reads
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.contrib.auth.models import User
-import os, base64
-from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend
+from django.db.models import F, OuterRef, Subquery
+from django.http import Http404, StreamingHttpResponse
 from rest_framework import generics
 
 
+# Chat key rows are never changed once written
+CHAT_KEY_MAX_AGE = 24 * 3600
+
+
+def user_key_etag(user_key):
+    return f"{user_key.pk}.{user_key.updated_at.timestamp():.6f}"
+
+
+def inbox_entries(user, since=None):
+    """
+    The user's inbox rows, newest activity first, from the (user, last_activity)
+    index; with `since` only the rows changed after that version. Raises
+    ValueError for a malformed version.
+    """
+    entries = (
+        InboxEntry.objects.filter(user=user)
+        .select_related('chat__user1__user_key', 'chat__user2__user_key', 'last_message__author')
+        .order_by('-last_activity')
+    )
+    if since is not None:
+        entries = entries.filter(version__gt=int(since))
+    return entries
+
+
+def history_chats():
+    """
+    Chats with their participants, last seq and both read watermarks: every
+    history page changes only when one of those does, so together they are the
+    page's validator, read in the same indexed lookup as the chat.
+    """
+    read_seq = ChatReadState.objects.filter(chat=OuterRef('pk'))
+    return Chat.objects.select_related('user1', 'user2').annotate(
+        last_seq=F('sequence__last_seq'),
+        user1_read_seq=Subquery(read_seq.filter(user=OuterRef('user1')).values('read_seq')),
+        user2_read_seq=Subquery(read_seq.filter(user=OuterRef('user2')).values('read_seq')),
+    )
+
+
+def history_etag(chat, user):
+    # Per user, since the page names the other participant
+    return f"{user.id}.{chat.last_seq or 0}.{chat.user1_read_seq or 0}.{chat.user2_read_seq or 0}"
+
+
+def history_data(chat, user, messages, prev_cursor, next_cursor):
+    # Get the other user
+    other_user = chat.user2 if chat.user1_id == user.id else chat.user1
+
+    # Read watermarks of both participants, for read ticks in the client
+    read_seq = {
+        chat.user1.username: chat.user1_read_seq or 0,
+        chat.user2.username: chat.user2_read_seq or 0,
+    }
+
+    return {
+        'status': 'success',
+        'chat_id': chat.id,
+        'user1': chat.user1.username,
+        'user2': chat.user2.username,
+        'other_user': other_user.username,
+        'created_at': chat.created_at,
+        'messages': [message_data(row) for row in messages],
+        'read_seq': read_seq,
+        'prev_cursor': prev_cursor,
+        'next_cursor': next_cursor,
+    }
+
+
 class ChatView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @replica_reads
     def get(self, request):
         # Get the authenticated user
         user = request.user
-        
-        # Find all chats where the user is either user1 or user2
-        chats = Chat.objects.filter(user1=user) | Chat.objects.filter(user2=user)
-        
-        # Format response
-        chat_data = []
-        for chat in chats:
-            # Get the other user in the chat
-            other_user = chat.user2 if chat.user1 == user else chat.user1
-            
-            # Get latest messages for this chat
-            messages = chat.chat_messages.all().order_by('-created')[:1]
-            message_data = ChatMessageSerializer(messages, many=True).data
-            
-            # Get public key (JSONField yields dict) or None
-            try:
-                public_key = other_user.user_key.public_key
-            except UserKey.DoesNotExist:
-                public_key = None
-
-            chat_data.append({
-                'id': chat.id,
-                'other_user': other_user.username,
-                'public_key': public_key,
-                'latest_message': message_data
-            })
-        
+
+        # Read first: rows changing after this are sent again next time, never skipped
+        version = InboxVersion.objects.filter(user=user).values_list('version', flat=True).first() or 0
+
+        try:
+            entries = inbox_entries(user, request.query_params.get('since'))
+        except ValueError:
+            return Response({
+                'status': 'error',
+                'message': 'Invalid version'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        chat_data = [inbox_entry_data(entry, user) for entry in entries]
+
         return Response({
             'status': 'success',
+            'version': version,
             'chats': chat_data
         })
 
@@ -56,36 +120,41 @@ class ChatView(APIView):
 class ChatHistoryView(APIView):
     permission_classes = [IsAuthenticated]
     
+    @replica_reads
     def get(self, request, chat_id):
         # Get the authenticated user
         user = request.user
         
         try:
             # Get the chat and ensure the user is a participant
-            chat = Chat.objects.get(id=chat_id)
-            if user != chat.user1 and user != chat.user2:
+            chat = history_chats().get(id=chat_id)
+            if user.id != chat.user1_id and user.id != chat.user2_id:
                 return Response({
                     'status': 'error',
                     'message': 'You are not a participant in this chat'
                 }, status=status.HTTP_403_FORBIDDEN)
-                
-            # Get all messages for this chat
-            messages = chat.chat_messages.all().order_by('created')
-            message_data = ChatMessageSerializer(messages, many=True).data
-            
-            # Get the other user
-            other_user = chat.user2 if chat.user1 == user else chat.user1
-            
-            return Response({
-                'status': 'success',
-                'chat_id': chat.id,
-                'user1': chat.user1.username,
-                'user2': chat.user2.username,
-                'other_user': other_user.username,
-                'created_at': chat.created_at,
-                'messages': message_data
-            })
-            
+
+            etag = history_etag(chat, user)
+            response = not_modified(request, etag)
+            if response is not None:
+                return with_validators(response, etag, no_cache=True)
+
+            # One bounded page of messages, newest page unless a cursor is given
+            try:
+                messages, prev_cursor, next_cursor = paginate_messages(
+                    GroupMessage.objects.in_chat(chat).values(*MESSAGE_VALUES),
+                    before=request.query_params.get('before'),
+                    after=request.query_params.get('after'),
+                    limit=parse_page_size(request.query_params.get('limit')),
+                )
+            except InvalidCursor:
+                return Response({
+                    'status': 'error',
+                    'message': 'Invalid cursor'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            response = Response(history_data(chat, user, messages, prev_cursor, next_cursor))
+            return with_validators(response, etag, no_cache=True)
+
         except Chat.DoesNotExist:
             return Response({
                 'status': 'error',
@@ -93,6 +162,24 @@ class ChatHistoryView(APIView):
             }, status=status.HTTP_404_NOT_FOUND)
 
 
+class ChatExportView(APIView):
+    """
+    Whole chat history as a stream of JSON lines; see api/export.py.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, chat_id):
+        chat = get_object_or_404(Chat.objects.select_related('user1', 'user2'), id=chat_id)
+        if request.user.id not in (chat.user1_id, chat.user2_id):
+            return Response({
+                'status': 'error',
+                'message': 'You are not a participant in this chat'
+            }, status=status.HTTP_403_FORBIDDEN)
+        response = StreamingHttpResponse(export_lines(chat), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="chat-{chat.id}.ndjson"'
+        return response
+
+
 class CreateChatView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -103,27 +190,15 @@ class CreateChatView(APIView):
         if serializer.is_valid():
             chat = serializer.save()
             # Generate symmetric key for chat and encrypt for both participants
-            sym_key = os.urandom(32)  # 256-bit AES key
-            for user in [chat.user1, chat.user2]:
-                # load user's public key from JWK
-                jwk = user.user_key.public_key
-                # decode e and n from base64url
-                e = int.from_bytes(base64.urlsafe_b64decode(jwk['e'] + '=='), 'big')
-                n = int.from_bytes(base64.urlsafe_b64decode(jwk['n'] + '=='), 'big')
-                pub_numbers = rsa.RSAPublicNumbers(e=e, n=n)
-                pub_key = pub_numbers.public_key(default_backend())
-                # encrypt symmetric key
-                encrypted = pub_key.encrypt(
-                    sym_key,
-                    asym_padding.OAEP(
-                        mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
+            ensure_chat_keys(chat)
+            # Let open stream sockets of both users pick up the chat
+            channel_layer = get_channel_layer()
+            for user_id in (chat.user1_id, chat.user2_id):
+                # Both are told about it now, so both must find it in their next reads
+                pin(user_id)
+                async_to_sync(channel_layer.group_send)(
+                    user_group(user_id), {'type': 'chat_created', 'chat_id': chat.id}
                 )
-                encrypted_b64 = base64.b64encode(encrypted).decode()
-                iv = base64.b64encode(os.urandom(12)).decode()
-                ChatKey.objects.create(chat=chat, user=user, encrypted_key=encrypted_b64, iv=iv)
             return Response({
                 'status': 'success',
                 'chat': {
@@ -143,10 +218,16 @@ class CreateChatView(APIView):
 class UserKeyView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @replica_reads
     def get(self, request):
-        user_key = request.user.user_key
-        serializer = UserKeySerializer(user_key)
-        return Response(serializer.data)
+        user_key = get_object_or_404(UserKey, user=request.user)
+        etag = user_key_etag(user_key)
+        response = (
+            not_modified(request, etag, user_key.updated_at)
+            or Response(UserKeySerializer(user_key).data)
+        )
+        # Replaced by POST, so clients revalidate every time
+        return with_validators(response, etag, user_key.updated_at, no_cache=True)
 
     def post(self, request):
         serializer = UserKeySerializer(data=request.data)
@@ -155,6 +236,7 @@ class UserKeyView(APIView):
                 user=request.user,
                 defaults=serializer.validated_data
             )
+            pin(request.user.id)
             return Response({'status': 'ok'})
         return Response(serializer.errors, status=400)
 
@@ -163,37 +245,37 @@ class ChatKeyView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, chat_id):
-        chat = get_object_or_404(Chat, id=chat_id)
-        # Ensure symmetric key exists for this chat and both users
-        keys = ChatKey.objects.filter(chat=chat)
-        if not keys.exists():
-            # generate new symmetric key and encrypt for both participants
-            import os, base64
-            from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
-            from cryptography.hazmat.primitives import hashes
-            from cryptography.hazmat.primitives.asymmetric import rsa
-            from cryptography.hazmat.backends import default_backend
-            sym_key = os.urandom(32)
-            participants = [chat.user1, chat.user2]
-            for user in participants:
-                jwk = user.user_key.public_key
-                e = int.from_bytes(base64.urlsafe_b64decode(jwk['e'] + '=='), 'big')
-                n = int.from_bytes(base64.urlsafe_b64decode(jwk['n'] + '=='), 'big')
-                pub = rsa.RSAPublicNumbers(e=e, n=n).public_key(default_backend())
-                enc_key = pub.encrypt(
-                    sym_key,
-                    asym_padding.OAEP(
-                        mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
-                )
-                ChatKey.objects.create(
-                    chat=chat,
-                    user=user,
-                    encrypted_key=base64.b64encode(enc_key).decode(),
-                    iv=base64.b64encode(os.urandom(12)).decode()
-                )
-        key_obj = get_object_or_404(ChatKey, chat_id=chat_id, user=request.user)
-        serializer = ChatKeySerializer(key_obj)
-        return Response(serializer.data)
\ No newline at end of file
+        key_obj = ChatKey.objects.filter(chat_id=chat_id, user=request.user).first()
+        if key_obj is None:
+            chat = get_object_or_404(
+                Chat.objects.select_related('user1__user_key', 'user2__user_key'),
+                id=chat_id
+            )
+            if request.user.id not in (chat.user1_id, chat.user2_id):
+                raise Http404
+            # Ensure symmetric key exists for this chat and both users
+            keys = ensure_chat_keys(chat)
+            key_obj = next(key for key in keys if key.user_id == request.user.id)
+        etag = str(key_obj.pk)
+        response = not_modified(request, etag) or Response(ChatKeySerializer(key_obj).data)
+        return with_validators(response, etag, max_age=CHAT_KEY_MAX_AGE)
+
+
+class SyncView(APIView):
+    """
+    Everything a client needs on app open in one request; see api/sync.py.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            version, since, after = decode_sync_cursor(request.query_params.get('cursor'))
+        except InvalidCursor:
+            return Response({
+                'status': 'error',
+                'message': 'Invalid cursor'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        return StreamingHttpResponse(
+            sync_lines(sync_records(request.user, version, since, after)),
+            content_type='application/x-ndjson',
+        )
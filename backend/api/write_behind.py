@@ -0,0 +1,156 @@
+import asyncio
+import atexit
+import sys
+
+from backend.db import db_sync_to_async
+from django.conf import settings
+
+from .models import GroupMessage
+
+
+class MessageWriteBehind:
+    """
+    Per-process buffer that persists chat messages in batches.
+
+    Consumers broadcast first and hand the unsaved GroupMessage to `add`, which
+    returns a future resolved with the row's (id, seq) once the batch
+    containing it is committed. A batch is written with one bulk_create when it reaches
+    `batch_size` messages or `interval` seconds after its first message.
+    The queue holds at most `max_pending` messages; beyond that `add` waits,
+    which pushes back on the sending sockets instead of growing memory.
+
+    `close` persists everything buffered, including a batch being written,
+    and runs when the server shuts down (see `on_server_shutdown`).
+    """
+
+    def __init__(self, batch_size, interval, max_pending):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.queue = None
+        self.flusher = None
+        self.hooked = False
+
+    def _start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.max_pending)
+        if not self.hooked:
+            on_server_shutdown(self.close)
+            self.hooked = True
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.get_running_loop().create_task(self._run())
+
+    async def add(self, message):
+        self._start()
+        durable = asyncio.get_running_loop().create_future()
+        await self.queue.put((message, durable))
+        return durable
+
+    async def _run(self):
+        # Ends at the None that `close` queues, after writing what came before it
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+            if stop:
+                return
+
+    async def _write(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            await db_sync_to_async(GroupMessage.objects.bulk_create_in_sequence)(messages)
+        except Exception as e:
+            for _, durable in batch:
+                if not durable.done():
+                    durable.set_exception(e)
+        else:
+            for message, durable in batch:
+                if not durable.done():
+                    durable.set_result((message.id, message.seq))
+
+    async def close(self):
+        """
+        Stop the flusher once the batch in flight and everything queued before
+        this call are committed, and resolve their futures. Messages added
+        afterwards start a new flusher.
+        """
+        if self.queue is None:
+            return
+        queue, flusher = self.queue, self.flusher
+        if flusher is not None and not flusher.done():
+            await queue.put(None)
+            await flusher
+        # Left behind by a flusher that died, or added while it stopped
+        while not queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    batch.append(item)
+            if batch:
+                await self._write(batch)
+        if self.queue is queue and queue.empty():
+            # A fresh queue next time, bound to whichever loop runs then
+            self.queue = self.flusher = None
+
+    def drain(self):
+        """
+        Synchronously persist whatever is still queued. A last resort at exit
+        for servers that gave `close` no chance to run: the event loop is gone
+        by then, so these messages are saved but never acknowledged.
+        """
+        if self.queue is None:
+            return
+        messages = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if item is not None:
+                messages.append(item[0])
+        for start in range(0, len(messages), self.batch_size):
+            GroupMessage.objects.bulk_create_in_sequence(messages[start:start + self.batch_size])
+
+
+def on_server_shutdown(close):
+    """
+    Await the coroutine function `close` when daphne (which also serves
+    runserver) shuts down, while its event loop still runs. Servers speaking
+    the ASGI lifespan protocol reach it through backend.asgi.lifespan instead.
+    """
+    # Only when daphne has installed its reactor; importing it here would install another
+    if 'twisted.internet.reactor' not in sys.modules:
+        return
+    from twisted.internet import defer, reactor
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown', lambda: defer.Deferred.fromFuture(asyncio.ensure_future(close()))
+    )
+
+
+message_writer = MessageWriteBehind(
+    batch_size=settings.MESSAGE_FLUSH_BATCH_SIZE,
+    interval=settings.MESSAGE_FLUSH_INTERVAL_MS / 1000,
+    max_pending=settings.MESSAGE_BUFFER_SIZE,
+)
+atexit.register(message_writer.drain)
@@ -21,10 +21,26 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
 django_application = get_asgi_application()
 
 from api import routing
+from api.write_behind import message_writer
+
+
+async def lifespan(scope, receive, send):
+    # For servers with ASGI lifespan support; daphne has none, see api/write_behind.py
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Buffered write-behind messages are saved before the process exits
+            await message_writer.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
 
 application = ProtocolTypeRouter({
     'http': django_application,
     "websocket": JWTAuthMiddleware(
          URLRouter(routing.websocket_urlpatterns)
     ),
+    'lifespan': lifespan,
 })
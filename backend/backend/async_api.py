@@ -0,0 +1,78 @@
+"""
+Async counterpart of DRF's APIView for the hot read endpoints under daphne.
+
+DRF views are synchronous, so Django runs each request on a worker thread.
+Views built on AsyncAPIView run on the event loop instead: JWT access tokens
+are verified in-process and users come from the same cache as WebSocket
+connections, so an authenticated request needs no thread and no query until
+the handler touches the async ORM.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from backend.middleware.jwt_auth import get_user, load_user
+from backend.renderers import ORJSONRenderer
+
+
+_renderer = ORJSONRenderer()
+
+
+def json_response(data, status=200):
+    # The sync views' renderer, so the bytes are the same as theirs
+    return HttpResponse(_renderer.render(data), status=status, content_type='application/json')
+
+
+async def authenticate(request):
+    """
+    User of a `Authorization: Bearer <access token>` header, or None.
+    """
+    # Set by APIClient.force_authenticate() in tests
+    forced = getattr(request, '_force_auth_user', None)
+    if forced is not None:
+        return forced
+
+    header = request.headers.get('Authorization', '').split()
+    if len(header) != 2 or header[0] not in api_settings.AUTH_HEADER_TYPES:
+        return None
+    try:
+        user_id = AccessToken(header[1])[api_settings.USER_ID_CLAIM]
+    except (TokenError, KeyError):
+        return None
+    user = await get_user(user_id, load=sync_to_async(load_user))
+    return user if user.is_authenticated else None
+
+
+class AsyncAPIView(View):
+    """
+    Authenticated JSON endpoint with `async def get/post(self, request, ...)`
+    handlers returning a response from `json_response`.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token authentication, so no CSRF cookie is involved (as in DRF)
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        user = await authenticate(request)
+        if user is None:
+            return json_response({'detail': 'Authentication credentials were not provided.'}, status=401)
+        request.user = user
+
+        handler = getattr(self, request.method.lower(), None)
+        if request.method.lower() not in self.http_method_names or handler is None:
+            return await self.http_method_not_allowed(request, *args, **kwargs)
+        return await handler(request, *args, **kwargs)
+
+    def parse_json(self, request):
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return None
@@ -0,0 +1,48 @@
+"""
+Database access from async code on a dedicated, sized thread pool.
+
+channels' database_sync_to_async runs every call on asgiref's one
+thread-sensitive thread, so a slow query holds up every socket of the process.
+db_sync_to_async runs them on DB_EXECUTOR_WORKERS threads instead. Each thread
+has its own Django connection, released around every call as
+database_sync_to_async does: back to the pool with DB_POOL on, closed (or kept
+for CONN_MAX_AGE) without it. Keep DB_POOL_MAX_SIZE above the worker count so
+request threads still find connections.
+"""
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from backend import metrics
+
+
+executor = ThreadPoolExecutor(max_workers=settings.DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+
+def _on_executor(func):
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        # Inside the call's own context, where its connection lives; channels
+        # closes connections outside it, which misses them on executor threads
+        close_old_connections()
+        try:
+            start = metrics.clock()
+            if start is not None:
+                # Pool checkout, or a new connection without the pool
+                connection.ensure_connection()
+                metrics.observe(metrics.db_connect_seconds, start)
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return call
+
+
+def db_sync_to_async(func):
+    """
+    database_sync_to_async on the database executor; works as a decorator of
+    functions and methods alike.
+    """
+    return SyncToAsync(_on_executor(func), thread_sensitive=False, executor=executor)
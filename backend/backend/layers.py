@@ -0,0 +1,40 @@
+import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that spreads groups and channels over several Redis
+    instances with a consistent hash ring.
+
+    The stock layer maps a key to a host by slicing a CRC range, so adding a
+    shard moves about half of all `chat_<id>` groups to another instance. Here
+    every host owns `replicas` points on a ring keyed by its address, which
+    keeps the host order in settings irrelevant and moves only ~1/N of the keys
+    when a shard is added or removed.
+    """
+
+    def __init__(self, hosts=None, replicas=160, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        ring = []
+        for index, host in enumerate(self.hosts):
+            name = host.get('address') or repr(sorted(host.items()))
+            for replica in range(replicas):
+                ring.append((self._hash(f"{name}#{replica}"), index))
+        ring.sort()
+        self._ring_points = [point for point, _ in ring]
+        self._ring_hosts = [index for _, index in ring]
+
+    @staticmethod
+    def _hash(value):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        return int.from_bytes(hashlib.md5(value, usedforsecurity=False).digest()[:8], 'big')
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        position = bisect.bisect(self._ring_points, self._hash(value))
+        return self._ring_hosts[position % len(self._ring_points)]
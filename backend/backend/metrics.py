@@ -0,0 +1,160 @@
+"""
+Prometheus metrics of the message path, the JWT middleware and the REST views,
+served in text format at /metrics when METRICS_ENABLED is on.
+
+Values are per process. With metrics off, `clock()` returns None without
+reading the clock and `observe()` returns right away, so instrumented code
+pays one settings lookup per call and nothing is recorded.
+"""
+import hmac
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import Http404, HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+registry = CollectorRegistry(auto_describe=True)
+
+# Milliseconds to seconds, for in-process work, single queries and Redis round trips
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+message_broadcast_seconds = Histogram(
+    'messenger_message_broadcast_seconds',
+    'Time from receiving a chat message to the end of its group_send',
+    buckets=FAST_BUCKETS, registry=registry,
+)
+save_message_seconds = Histogram(
+    'messenger_save_message_seconds',
+    'Database time of saving one message outside write-behind',
+    buckets=FAST_BUCKETS, registry=registry,
+)
+group_send_seconds = Histogram(
+    'messenger_group_send_seconds',
+    'Time of one channel layer group_send from a consumer',
+    ['type'], buckets=FAST_BUCKETS, registry=registry,
+)
+jwt_auth_seconds = Histogram(
+    'messenger_jwt_auth_seconds',
+    'Time JWTAuthMiddleware spends authenticating a WebSocket connect',
+    buckets=FAST_BUCKETS, registry=registry,
+)
+jwt_auth_failures = Counter(
+    'messenger_jwt_auth_failures',
+    'WebSocket connects with a token that did not authenticate',
+    registry=registry,
+)
+request_seconds = Histogram(
+    'messenger_request_seconds',
+    'REST request latency by route',
+    ['route', 'method'], registry=registry,
+)
+open_sockets = Gauge(
+    'messenger_open_sockets',
+    'Accepted WebSockets open in this process',
+    ['consumer'], registry=registry,
+)
+channel_layer_queued = Gauge(
+    'messenger_channel_layer_queued_messages',
+    'Messages waiting in this process for delivery to its sockets',
+    registry=registry,
+)
+
+
+def queued_messages():
+    # Read at scrape time only
+    layer = get_channel_layer()
+    # InMemoryChannelLayer keeps queues in `channels`, the Redis layers in `receive_buffer`
+    queues = layer.receive_buffer if hasattr(layer, 'receive_buffer') else getattr(layer, 'channels', {})
+    return sum(queue.qsize() for queue in list(queues.values()))
+
+
+channel_layer_queued.set_function(queued_messages)
+
+db_connect_seconds = Histogram(
+    'messenger_db_connect_seconds',
+    'Time a database executor call waits for its connection: pool checkout, or connecting without the pool',
+    buckets=FAST_BUCKETS, registry=registry,
+)
+
+
+db_replica_lag_seconds = Gauge(
+    'messenger_db_replica_lag_seconds',
+    'Replay lag of each read replica at its last check; NaN while it cannot be reached',
+    ['database'], registry=registry,
+)
+db_read_routing = Counter(
+    'messenger_db_read_routing',
+    'Requests that may read from a replica, by where they read: replica, or the primary as pinned or lagging',
+    ['outcome'], registry=registry,
+)
+
+
+class DatabasePoolCollector:
+    """
+    State of this process's psycopg pool, read at scrape time; nothing while
+    DB_POOL is off.
+    """
+
+    def describe(self):
+        # Keeps registration from calling collect(), which would create the
+        # pool at import time, before the test runner points it at its database
+        return []
+
+    def collect(self):
+        if not settings.DB_POOL:
+            return
+        stats = connections[DEFAULT_DB_ALIAS].pool.get_stats()
+        connections_by_state = GaugeMetricFamily(
+            'messenger_db_pool_connections', 'Pooled database connections', labels=['state'],
+        )
+        connections_by_state.add_metric(['open'], stats.get('pool_size', 0))
+        connections_by_state.add_metric(['idle'], stats.get('pool_available', 0))
+        yield connections_by_state
+        yield GaugeMetricFamily(
+            'messenger_db_pool_waiting', 'Threads waiting for a pooled connection',
+            value=stats.get('requests_waiting', 0),
+        )
+        yield CounterMetricFamily(
+            'messenger_db_pool_wait_seconds', 'Time spent waiting for pooled connections',
+            value=stats.get('requests_wait_ms', 0) / 1000,
+        )
+        yield CounterMetricFamily(
+            'messenger_db_pool_errors', 'Connection requests that failed, mostly after waiting DB_POOL_TIMEOUT',
+            value=stats.get('requests_errors', 0),
+        )
+        yield CounterMetricFamily(
+            'messenger_db_pool_connections_lost', 'Pooled connections the health check found broken',
+            value=stats.get('connections_lost', 0),
+        )
+
+
+registry.register(DatabasePoolCollector())
+
+
+def clock():
+    """
+    Start time for `observe`, or None while metrics are off.
+    """
+    return time.perf_counter() if settings.METRICS_ENABLED else None
+
+
+def observe(histogram, start, *labels):
+    if start is None:
+        return
+    if labels:
+        histogram = histogram.labels(*labels)
+    histogram.observe(time.perf_counter() - start)
+
+
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    # Optional shared secret for scrapers: `Authorization: Bearer <METRICS_TOKEN>`
+    if settings.METRICS_TOKEN:
+        expected = f'Bearer {settings.METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return HttpResponse(status=401)
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -8,37 +8,69 @@ from urllib.parse import parse_qs
 from channels.middleware import BaseMiddleware
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from rest_framework_simplejwt.tokens import UntypedToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from jwt import decode as jwt_decode
+from rest_framework_simplejwt.settings import api_settings
 from django.conf import settings
-from channels.db import database_sync_to_async
+from backend.db import db_sync_to_async
+from backend.cache import TTLCache
+from backend import metrics
 
 User = get_user_model()
 
+# Authenticated users by id, so reconnect storms do not repeat the same lookups
+user_cache = TTLCache(maxsize=settings.JWT_USER_CACHE_SIZE, ttl=settings.JWT_USER_CACHE_TTL)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_changed_user(sender, instance, **kwargs):
+    # Covers deactivation and password changes, which both save the user
+    user_cache.invalidate(instance.pk)
+
+
+def load_user(user_id):
+    try:
+        user = User.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+    except User.DoesNotExist:
+        return AnonymousUser()
+    return user if user.is_active else AnonymousUser()
+
+
+async def get_user(user_id, load=db_sync_to_async(load_user)):
+    """
+    Active user by id through the cache, or AnonymousUser. Shared by the
+    WebSocket middleware and the async REST views, which pass a plain
+    sync_to_async loader since Django manages their connections per request.
+    """
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await load(user_id)
+        if user.is_authenticated:
+            user_cache.set(user_id, user)
+    return user
+
+
 class JWTAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
         query_string = scope["query_string"].decode()
         query_params = parse_qs(query_string)
         token = query_params.get("token")
 
+        start = metrics.clock()
+        scope["user"] = AnonymousUser()
         if token:
             try:
-                UntypedToken(token[0])  # Check validity
-                decoded = jwt_decode(token[0], settings.SECRET_KEY, algorithms=["HS256"])
-                user_id = decoded.get("user_id")
-                scope["user"] = await self.get_user(user_id)
-            except (InvalidToken, TokenError, KeyError, Exception) as e:
-                print("JWT error:", str(e))
-                scope["user"] = AnonymousUser()
-        else:
-            scope["user"] = AnonymousUser()
+                # Verifies signature and expiry in a single decode
+                user_id = UntypedToken(token[0])[api_settings.USER_ID_CLAIM]
+            except (InvalidToken, TokenError, KeyError):
+                if settings.METRICS_ENABLED:
+                    metrics.jwt_auth_failures.inc()
+            else:
+                # Outside the try: a failing lookup is an error, not a bad token
+                scope["user"] = await get_user(user_id)
+        metrics.observe(metrics.jwt_auth_seconds, start)
 
         return await super().__call__(scope, receive, send)
-
-    @database_sync_to_async
-    def get_user(self, user_id):
-        try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return AnonymousUser()
\ No newline at end of file
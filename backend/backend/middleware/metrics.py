@@ -0,0 +1,37 @@
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+
+from backend.metrics import clock, observe, request_seconds
+
+
+def route_of(request):
+    # The URL pattern, e.g. api/chat/<int:chat_id>/history/, so labels stay bounded
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+
+@sync_and_async_middleware
+def MetricsMiddleware(get_response):
+    """
+    Request latency per route for sync and async views alike. Left out of the
+    middleware chain entirely while METRICS_ENABLED is off.
+    """
+    if not settings.METRICS_ENABLED:
+        raise MiddlewareNotUsed
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = clock()
+            response = await get_response(request)
+            observe(request_seconds, start, route_of(request), request.method)
+            return response
+    else:
+        def middleware(request):
+            start = clock()
+            response = get_response(request)
+            observe(request_seconds, start, route_of(request), request.method)
+            return response
+
+    return middleware
@@ -0,0 +1,168 @@
+"""
+Read replicas for the read-heavy endpoints.
+
+DB_REPLICA_HOSTS adds a `replica<n>` database per streaming replica of
+`default` (settings.DB_REPLICAS). ReplicaRouter sends writes, and reads
+outside `reads_from()`, to the primary. View methods decorated with
+`replica_reads` (chat list, history, user keys, user search) pick a database
+once per request and run all their queries on it.
+
+A request stays on the primary when its user wrote recently or when no
+replica is close enough behind. `pin()` is called after a user sends a
+message, marks one read, creates a chat or replaces their keys, and keeps
+their reads on the primary for DB_REPLICA_STICKY_SECONDS, so they see their
+own writes. Pins live in Django's cache, which has to be shared
+(CACHE_REDIS_URL) for a pin to reach the other processes. Each process checks
+a replica's replay lag at most every DB_REPLICA_LAG_CHECK_SECONDS and skips
+it above DB_REPLICA_MAX_LAG; a replica that cannot be queried counts as
+lagging until the next check.
+"""
+import contextvars
+import functools
+import math
+import random
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from backend import metrics
+from backend.cache import TTLCache
+
+
+# Seconds of WAL received but not replayed yet; 0 when all of it is replayed,
+# also on a server that is not a standby at all
+LAG_SQL = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE COALESCE(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+_database = contextvars.ContextVar('read_database', default=None)
+
+# alias -> (monotonic time of the check, lag in seconds or None if unreachable)
+_lag = {}
+
+# Users this process pinned within the last half window; their pin is not
+# written again until then, so a busy sender costs a cache write every few seconds
+_pinned = TTLCache(maxsize=10000, ttl=settings.DB_REPLICA_STICKY_SECONDS / 2)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # None leaves the choice to Django: the primary, or the instance's own database
+        return _database.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def reads_from(alias):
+    """
+    Route reads made inside the block to `alias`; None keeps them on the primary.
+    """
+    token = _database.set(alias)
+    try:
+        yield
+    finally:
+        _database.reset(token)
+
+
+def pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+def pin(user_id):
+    """
+    Keep `user_id`'s reads on the primary for DB_REPLICA_STICKY_SECONDS.
+    """
+    if not settings.DB_REPLICAS or _pinned.get(user_id):
+        return
+    # Half a window longer, since this process does not renew it for that long
+    cache.set(pin_key(user_id), True, math.ceil(settings.DB_REPLICA_STICKY_SECONDS * 1.5))
+    _pinned.set(user_id, True)
+
+
+async def apin(user_id):
+    if settings.DB_REPLICAS and not _pinned.get(user_id):
+        await sync_to_async(pin, thread_sensitive=False)(user_id)
+
+
+def replica_lag(alias):
+    """
+    Seconds `alias` is behind the primary, or None when it cannot be queried.
+    """
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            return float(cursor.fetchone()[0])
+    except DatabaseError:
+        return None
+
+
+def usable_replicas():
+    """
+    Replicas within DB_REPLICA_MAX_LAG of the primary, by their last check.
+    """
+    now = time.monotonic()
+    usable = []
+    for alias in settings.DB_REPLICAS:
+        checked, lag = _lag.get(alias, (None, None))
+        if checked is None or now - checked >= settings.DB_REPLICA_LAG_CHECK_SECONDS:
+            # Other threads keep using the last result meanwhile, rather than
+            # all waiting on a replica that does not answer
+            _lag[alias] = (now, lag)
+            lag = replica_lag(alias)
+            _lag[alias] = (time.monotonic(), lag)
+            if settings.METRICS_ENABLED:
+                metrics.db_replica_lag_seconds.labels(alias).set(lag if lag is not None else math.nan)
+        if lag is not None and lag <= settings.DB_REPLICA_MAX_LAG:
+            usable.append(alias)
+    return usable
+
+
+def read_database(user_id):
+    """
+    Replica alias for `user_id`'s reads, or None for the primary.
+    """
+    if not settings.DB_REPLICAS:
+        return None
+    if cache.get(pin_key(user_id)):
+        outcome, alias = 'pinned', None
+    else:
+        replicas = usable_replicas()
+        outcome, alias = ('replica', random.choice(replicas)) if replicas else ('lagging', None)
+    if settings.METRICS_ENABLED:
+        metrics.db_read_routing.labels(outcome).inc()
+    return alias
+
+
+def replica_reads(handler):
+    """
+    Run a view method's queries on the database `read_database` picks for
+    request.user; for sync and async methods alike.
+    """
+    if iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def view(self, request, *args, **kwargs):
+            if not settings.DB_REPLICAS:
+                return await handler(self, request, *args, **kwargs)
+            alias = await sync_to_async(read_database)(request.user.id)
+            with reads_from(alias):
+                return await handler(self, request, *args, **kwargs)
+    else:
+        @functools.wraps(handler)
+        def view(self, request, *args, **kwargs):
+            with reads_from(read_database(request.user.id)):
+                return handler(self, request, *args, **kwargs)
+    return view
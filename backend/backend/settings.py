@@ -60,10 +60,21 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ],
+    # orjson when installed (pip install orjson), DRF's stdlib JSON otherwise
+    'DEFAULT_RENDERER_CLASSES': [
+        'backend.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'backend.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 
 MIDDLEWARE = [
+    'backend.middleware.metrics.MetricsMiddleware',  # Outermost, times the whole request
     'corsheaders.middleware.CorsMiddleware',  # Add this at the top
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -102,13 +113,73 @@ TEMPLATES = [
 
 # WSGI_APPLICATION = "backend.wsgi.application"
 ASGI_APPLICATION = "backend.asgi.application"
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': "channels.layers.InMemoryChannelLayer"
-        }
+
+# Serve ChatView, ChatHistoryView, ChatKeyView, UserKeyView and GetUserView with
+# native async handlers; turn off when running under WSGI
+ASYNC_API_VIEWS = os.environ.get('ASYNC_API_VIEWS', 'True') == 'True'
+
+# Collect Prometheus metrics and serve them at /metrics; when off nothing is
+# recorded and the route returns 404
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'False') == 'True'
+# If set, scrapers must send `Authorization: Bearer <METRICS_TOKEN>`
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Comma-separated Redis URLs; `chat_<id>` groups are sharded over them by
+# consistent hashing. Without it the single-process in-memory layer is used.
+CHANNEL_REDIS_HOSTS = [host for host in os.environ.get('CHANNEL_REDIS_HOSTS', '').split(',') if host]
+
+if CHANNEL_REDIS_HOSTS:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': "backend.layers.ShardedRedisChannelLayer",
+            'CONFIG': {
+                'hosts': CHANNEL_REDIS_HOSTS,
+                # Messages buffered per channel before group sends start dropping
+                'capacity': int(os.environ.get('CHANNEL_LAYER_CAPACITY', '1000')),
+                # Seconds an undelivered message is kept
+                'expiry': int(os.environ.get('CHANNEL_LAYER_EXPIRY', '30')),
+                # Seconds a socket stays in a group without re-joining
+                'group_expiry': int(os.environ.get('CHANNEL_LAYER_GROUP_EXPIRY', '86400')),
+                'prefix': os.environ.get('CHANNEL_LAYER_PREFIX', 'messenger'),
+            },
+        },
     }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': "channels.layers.InMemoryChannelLayer"
+            }
+        }
 
 
+# Write-behind persistence of WebSocket messages: broadcast first, then save in
+# batches of up to MESSAGE_FLUSH_BATCH_SIZE rows every MESSAGE_FLUSH_INTERVAL_MS,
+# acknowledging each message to its sender once the row is committed.
+MESSAGE_WRITE_BEHIND = os.environ.get('MESSAGE_WRITE_BEHIND', 'False') == 'True'
+MESSAGE_FLUSH_INTERVAL_MS = int(os.environ.get('MESSAGE_FLUSH_INTERVAL_MS', '50'))
+MESSAGE_FLUSH_BATCH_SIZE = int(os.environ.get('MESSAGE_FLUSH_BATCH_SIZE', '500'))
+# Messages queued per process before senders have to wait
+MESSAGE_BUFFER_SIZE = int(os.environ.get('MESSAGE_BUFFER_SIZE', '10000'))
+# Authenticated users cached per process by the WebSocket JWT middleware;
+# the TTL bounds how long a change made by another process can go unnoticed.
+JWT_USER_CACHE_SIZE = int(os.environ.get('JWT_USER_CACHE_SIZE', '10000'))
+JWT_USER_CACHE_TTL = int(os.environ.get('JWT_USER_CACHE_TTL', '60'))
+# Messages per query when a chatroom socket replays what it missed (?last_seq=)
+MESSAGE_RESUME_BATCH_SIZE = int(os.environ.get('MESSAGE_RESUME_BATCH_SIZE', '200'))
+# Read marks a socket receives within this window are written and broadcast once
+READ_RECEIPT_DELAY_MS = int(os.environ.get('READ_RECEIPT_DELAY_MS', '500'))
+# /api/sync/: messages per response, and how far back before the previous sync
+# it looks for messages and keys committed late
+SYNC_MAX_MESSAGES = int(os.environ.get('SYNC_MAX_MESSAGES', '1000'))
+SYNC_OVERLAP_SECONDS = int(os.environ.get('SYNC_OVERLAP_SECONDS', '60'))
+# Monthly message partitions kept ready ahead of the current month
+MESSAGE_PARTITION_MONTHS_AHEAD = int(os.environ.get('MESSAGE_PARTITION_MONTHS_AHEAD', '3'))
+# archive_message_partitions: months of messages kept online, and the schema
+# older partitions are moved to
+MESSAGE_HOT_MONTHS = int(os.environ.get('MESSAGE_HOT_MONTHS', '12'))
+MESSAGE_ARCHIVE_SCHEMA = os.environ.get('MESSAGE_ARCHIVE_SCHEMA', 'archive')
+# Largest page of /users/ search results a client may ask for
+USER_SEARCH_MAX_RESULTS = int(os.environ.get('USER_SEARCH_MAX_RESULTS', '50'))
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -120,10 +191,95 @@ DATABASES = {
         'USER': os.environ.get('DB_USER', 'messenger'),
         'PASSWORD': os.environ.get('DB_PASSWORD', 'development'),
         'HOST': os.environ.get('DB_HOST', 'db'),
-        'PORT': os.environ.get('DB_PORT', '5432')
+        'PORT': os.environ.get('DB_PORT', '5432'),
+        # Connections are tested before reuse, pooled or persistent
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Each process keeps a psycopg pool of DB_POOL_MIN_SIZE to DB_POOL_MAX_SIZE
+# connections, shared by request threads and the DB_EXECUTOR_WORKERS threads
+# consumers run queries on (backend/db.py); waiting longer than
+# DB_POOL_TIMEOUT seconds for one fails the query. With DB_POOL=False every
+# request and query opens its own connection, or keeps it DB_CONN_MAX_AGE seconds.
+DB_POOL = os.environ.get('DB_POOL', 'True') == 'True'
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '4'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '20'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_EXECUTOR_WORKERS = int(os.environ.get('DB_EXECUTOR_WORKERS', '10'))
+
+if DB_POOL:
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'name': 'messenger',
+            'min_size': DB_POOL_MIN_SIZE,
+            'max_size': DB_POOL_MAX_SIZE,
+            'timeout': DB_POOL_TIMEOUT,
+            # Replaced now and then, so server-side memory does not build up
+            'max_lifetime': 1800,
+            'max_idle': 300,
+        },
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DB_CONN_MAX_AGE', '0'))
+
+# Comma-separated host[:port] of streaming replicas of the default database.
+# Each becomes a `replica<n>` database that the chat list, history, user keys
+# and user search read from (backend/replicas.py); writes and every other read
+# stay on the primary.
+DB_REPLICA_HOSTS = [host for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if host]
+# Replicas replaying more than DB_REPLICA_MAX_LAG seconds behind are skipped;
+# each process checks at most every DB_REPLICA_LAG_CHECK_SECONDS
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', '2'))
+DB_REPLICA_LAG_CHECK_SECONDS = float(os.environ.get('DB_REPLICA_LAG_CHECK_SECONDS', '1'))
+# Users who just wrote read from the primary this long; keep it above DB_REPLICA_MAX_LAG
+DB_REPLICA_STICKY_SECONDS = int(os.environ.get('DB_REPLICA_STICKY_SECONDS', '5'))
+# Seconds to wait for a replica connection before the request fails; the
+# next lag check then leaves the replica out
+DB_REPLICA_CONNECT_TIMEOUT = int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', '2'))
+
+DB_REPLICAS = []
+for number, replica_host in enumerate(DB_REPLICA_HOSTS, 1):
+    alias = f'replica{number}'
+    replica_host, _, replica_port = replica_host.partition(':')
+    replica_options = {'connect_timeout': DB_REPLICA_CONNECT_TIMEOUT}
+    if DB_POOL:
+        replica_options['pool'] = {
+            **DATABASES['default']['OPTIONS']['pool'],
+            'name': f'messenger-{alias}',
+            'timeout': DB_REPLICA_CONNECT_TIMEOUT,
+        }
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': replica_host,
+        'PORT': replica_port or DATABASES['default']['PORT'],
+        'OPTIONS': replica_options,
+        # Tests read their test database through the replica, not a copy
+        'TEST': {'MIRROR': 'default'},
+    }
+    DB_REPLICAS.append(alias)
+
+if DB_REPLICAS:
+    DATABASE_ROUTERS = ['backend.replicas.ReplicaRouter']
+
+# Django's cache, which holds the read replica pins. Without CACHE_REDIS_URL
+# each process has its own, so a pin only covers the process that set it.
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', '')
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -16,37 +16,18 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from django.contrib.auth.models import User
-from rest_framework import routers, serializers, viewsets, permissions
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-
-# Serializers define the API representation.
-class UserSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = User
-        # fields = ['url', 'username', 'email', 'is_staff']
-        fields = ['id', 'username', 'email', 'groups']
-
-# ViewSets define the view behavior.
-class UserViewSet(viewsets.ModelViewSet):
-    # queryset = User.objects.all()
-    # serializer_class = UserSerializer
-    queryset = User.objects.all().order_by('-date_joined')
-    serializer_class = UserSerializer
-    permission_classes = [permissions.IsAuthenticated]
-
-# Routers provide an easy way of automatically determining the URL conf.
-router = routers.DefaultRouter()
-router.register(r'users', UserViewSet)
-
+from accounts.views import UserSearchView
+from backend.metrics import metrics_view
 
 
 urlpatterns = [
     path("admin/", admin.site.urls),
-    path('', include(router.urls)),
+    path('users/', UserSearchView.as_view(), name='user-search'),
     # path('api-auth/', include('rest_framework.urls', namespace='rest_framework'))
     path('auth/', include('accounts.urls')),
     path('api/', include('api.urls')),
+    path('metrics', metrics_view, name='metrics'),
     # path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     # path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh_pair')
 ]
@@ -37,8 +37,11 @@ function Chat() {
   } = useContacts(selectedContactId, setSelectedContactId);
   const {
     loading: messagesLoading,
+    loadingOlder,
     error: messagesError,
+    hasOlderMessages,
     fetchChatMessages,
+    fetchOlderMessages,
   } = useChatMessages(contacts, setContacts, selectedContactId, symKey);
   const { addingChat, createNewChat } = useAddChat(
     setContacts,
@@ -403,6 +406,9 @@ useEffect(() => {
                     error={messagesError}
                     isMobile={isMobile}
                     onBack={handleBackToList}
+                    hasOlder={hasOlderMessages}
+                    loadingOlder={loadingOlder}
+                    onLoadOlder={() => fetchOlderMessages(selectedContactId)}
                   />
                 )
               ) : (
@@ -515,6 +521,9 @@ useEffect(() => {
                 error={messagesError}
                 isMobile={isMobile}
                 onBack={handleBackToList}
+                hasOlder={hasOlderMessages}
+                loadingOlder={loadingOlder}
+                onLoadOlder={() => fetchOlderMessages(selectedContactId)}
               />
             )
           ) : (
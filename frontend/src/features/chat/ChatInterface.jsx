@@ -1,4 +1,4 @@
-import { useState, useRef, useEffect } from "react";
+import { useState, useRef, useEffect, useLayoutEffect } from "react";
 import {
   Input,
   Button,
@@ -19,9 +19,16 @@ export default function ChatInterface({
   onSendMessage,
   isMobile,
   onBack,
+  hasOlder,
+  loadingOlder,
+  onLoadOlder,
 }) {
   const [messageText, setMessageText] = useState("");
   const messagesEndRef = useRef(null);
+  const messagesContainerRef = useRef(null);
+  // Distance from the bottom to keep while an older page is prepended
+  const restoreFromBottomRef = useRef(null);
+  const lastMessageIdRef = useRef(null);
   const currentUsername = sessionStorage.getItem("username");
   const { token } = theme.useToken();
 
@@ -32,12 +39,33 @@ export default function ChatInterface({
     });
   };
 
+  useLayoutEffect(() => {
+    const container = messagesContainerRef.current;
+    // Once the older page is in, or has failed, keep the view where it was
+    if (container && !loadingOlder && restoreFromBottomRef.current !== null) {
+      container.scrollTop = container.scrollHeight - restoreFromBottomRef.current;
+      restoreFromBottomRef.current = null;
+    }
+  }, [messages, loadingOlder]);
+
   useEffect(() => {
+    // Only a new message scrolls down; polls and older pages leave the view be
+    const lastId = messages.length ? messages[messages.length - 1].id : null;
+    if (lastId === lastMessageIdRef.current) return;
+    lastMessageIdRef.current = lastId;
     if (messagesEndRef.current) {
       messagesEndRef.current.scrollIntoView({ behavior: "smooth" });
     }
   }, [messages]);
 
+  const handleScroll = (e) => {
+    const container = e.currentTarget;
+    if (container.scrollTop < 100 && hasOlder && !loadingOlder && onLoadOlder) {
+      restoreFromBottomRef.current = container.scrollHeight - container.scrollTop;
+      onLoadOlder();
+    }
+  };
+
   const handleSend = () => {
     if (messageText.trim() && contact) {
       onSendMessage(messageText.trim());
@@ -131,6 +159,8 @@ export default function ChatInterface({
       {/* Messages */}
       <Flex
         vertical
+        ref={messagesContainerRef}
+        onScroll={handleScroll}
         style={{
           flex: 1,
           padding: isMobile ? "8px" : token.padding,
@@ -139,6 +169,11 @@ export default function ChatInterface({
           backgroundColor: token.colorBgContainer,
         }}
       >
+        {loadingOlder && (
+          <Text type="secondary" style={{ textAlign: "center" }}>
+            Loading older messages...
+          </Text>
+        )}
         <List
           itemLayout="horizontal"
           dataSource={uniqueMessages}
@@ -1,16 +1,54 @@
 // src/components/Chat/hooks/useChatMessages.js
-import { useState, useCallback } from "react";
+import { useState, useCallback, useRef } from "react";
 import { message } from "antd";
 import { fetchWithAuth } from "./api";
 import { decryptMessageAES } from "../../../utilities/crypto";
 
 export function useChatMessages(contacts, setContacts, selectedContactId, symKey) {
   const [loading, setLoading] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const [error, setError] = useState(null);
+  // chat id -> cursor of the page before the oldest loaded message, null once
+  // the start of the chat is loaded
+  const olderCursors = useRef({});
+  const [hasOlder, setHasOlder] = useState({});
+  // Scroll events keep coming while a page loads; one request at a time
+  const loadingOlderRef = useRef(false);
 
   const currentUsername = sessionStorage.getItem("username");
   const MAX_RETRY_COUNT = 3;
 
+  const decryptMessages = useCallback(
+    (messages) =>
+      // Decrypt each message using AES-GCM
+      Promise.all(
+        messages.map(async (msg) => {
+          let plaintext = msg.body;
+          if (msg.iv && msg.body) {
+            try {
+              plaintext = await decryptMessageAES(msg.body, msg.iv, symKey);
+            } catch (err) {
+              console.error('Error decrypting message', msg.id, err);
+            }
+          }
+          return {
+            id: msg.id,
+            text: plaintext,
+            sender: msg.author,
+            timestamp: new Date(msg.timestamp),
+            isFromCurrentUser: msg.author === currentUsername,
+          };
+        })
+      ),
+    [currentUsername, symKey]
+  );
+
+  const setOlderCursor = (chatId, cursor) => {
+    olderCursors.current[chatId] = cursor;
+    setHasOlder((prev) => ({ ...prev, [chatId]: cursor !== null }));
+  };
+
+  // Newest page of the chat; older pages already loaded stay in front of it
   const fetchChatMessages = useCallback(
     async (chatId, retryCount = 0) => {
       if (!chatId) return;
@@ -27,30 +65,22 @@ export function useChatMessages(contacts, setContacts, selectedContactId, symKey
             `Loaded ${data.messages.length} messages for chat #${chatId}`
           );
 
-          // Decrypt each message using AES-GCM
-          const decrypted = await Promise.all(
-            data.messages.map(async (msg) => {
-              let plaintext = msg.body;
-              if (msg.iv && msg.body) {
-                try {
-                  plaintext = await decryptMessageAES(msg.body, msg.iv, symKey);
-                } catch (err) {
-                  console.error('Error decrypting message', msg.id, err);
-                }
-              }
-              return {
-                id: msg.id,
-                text: plaintext,
-                sender: msg.author,
-                timestamp: new Date(msg.timestamp),
-                isFromCurrentUser: msg.author === currentUsername,
-              };
-            })
-          );
+          const decrypted = await decryptMessages(data.messages);
+          // Set once; later polls must not forget older pages already loaded
+          if (!(chatId in olderCursors.current)) {
+            setOlderCursor(chatId, data.prev_cursor);
+          }
           setContacts((prev) =>
-            prev.map((contact) =>
-              contact.id === chatId ? { ...contact, messages: decrypted } : contact
-            )
+            prev.map((contact) => {
+              if (contact.id !== chatId) return contact;
+              const first = decrypted[0];
+              const older = first
+                ? (contact.messages || []).filter(
+                    (msg) => new Date(msg.timestamp) < first.timestamp
+                  )
+                : [];
+              return { ...contact, messages: [...older, ...decrypted] };
+            })
           );
         } else {
           throw new Error("Invalid response format from server");
@@ -70,12 +100,56 @@ export function useChatMessages(contacts, setContacts, selectedContactId, symKey
         setLoading(false);
       }
     },
-    [currentUsername, setContacts, symKey]
+    [decryptMessages, setContacts, symKey]
+  );
+
+  // The page before the oldest loaded message, prepended to the chat
+  const fetchOlderMessages = useCallback(
+    async (chatId) => {
+      const cursor = olderCursors.current[chatId];
+      if (!chatId || !symKey || !cursor || loadingOlderRef.current) return;
+      loadingOlderRef.current = true;
+      setLoadingOlder(true);
+
+      try {
+        const data = await fetchWithAuth(
+          `/chat/${chatId}/history/?before=${encodeURIComponent(cursor)}`
+        );
+        if (data.status !== "success" || !Array.isArray(data.messages)) {
+          throw new Error("Invalid response format from server");
+        }
+        const decrypted = await decryptMessages(data.messages);
+        setOlderCursor(chatId, data.prev_cursor);
+        setContacts((prev) =>
+          prev.map((contact) => {
+            if (contact.id !== chatId) return contact;
+            const loaded = new Set((contact.messages || []).map((msg) => msg.id));
+            return {
+              ...contact,
+              messages: [
+                ...decrypted.filter((msg) => !loaded.has(msg.id)),
+                ...(contact.messages || []),
+              ],
+            };
+          })
+        );
+      } catch (err) {
+        console.error("Error fetching older messages:", err);
+        message.error("Failed to load older messages.");
+      } finally {
+        loadingOlderRef.current = false;
+        setLoadingOlder(false);
+      }
+    },
+    [decryptMessages, setContacts, symKey]
   );
 
   return {
     loading,
+    loadingOlder,
     error,
+    hasOlderMessages: !!hasOlder[selectedContactId],
     fetchChatMessages,
+    fetchOlderMessages,
   };
 }
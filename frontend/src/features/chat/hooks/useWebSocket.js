@@ -5,6 +5,8 @@ import { decryptMessageAES, decryptMessageRSA } from "../../../utilities/crypto"
 
 export function useWebSocket(chatId, contacts, setContacts, symKey) {
   const wsRef = useRef(null);
+  // Highest message seq seen per chat, so a reconnect only replays what was missed
+  const lastSeqRef = useRef({});
   const accessToken = sessionStorage.getItem("accessToken");
   const currentUsername = sessionStorage.getItem("username");
   const API_BASE_URL = import.meta.env.VITE_API_URL;
@@ -20,8 +22,10 @@ export function useWebSocket(chatId, contacts, setContacts, symKey) {
     }
 
     // Create new connection
+    const lastSeq = lastSeqRef.current[chatId];
+    const resume = lastSeq ? `&last_seq=${lastSeq}` : "";
     const ws = new WebSocket(
-      `${WS_BASE_URL}/chatroom/${chatId}/?token=${accessToken}`
+      `${WS_BASE_URL}/chatroom/${chatId}/?token=${accessToken}${resume}`
     );
 
     wsRef.current = ws;
@@ -39,6 +43,17 @@ export function useWebSocket(chatId, contacts, setContacts, symKey) {
         console.error('Invalid WS message format:', event.data);
         return;
       }
+      // Delivery acknowledgements for our own messages carry no content
+      if (data.ack) return;
+      // Read receipts of the other participant
+      if (data.read !== undefined) return;
+      if (data.seq) {
+        lastSeqRef.current[chatId] = Math.max(lastSeqRef.current[chatId] || 0, data.seq);
+        // The chat is open, so whatever arrives is read; the server coalesces these
+        ws.send(JSON.stringify({ read: data.seq }));
+      }
+      // Seq of a message that was delivered before it was saved; nothing to show
+      if (data.stored) return;
       // Support both AES (ct+iv) or legacy RSA (message)
       const encrypted = data.ct || data.message;
       const iv = data.iv;